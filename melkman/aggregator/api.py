@@ -1,12 +1,13 @@
 from giblets import Component, implements
 import logging
+from melkman.claimcheck import check_in
 from melkman.context import IRunDuringBootstrap
 from melkman.messaging import MessageDispatch
 
 
 log = logging.getLogger(__name__)
 
-__all__ = ['BUCKET_MODIFIED', 'UPDATE_SUBSCRIPTION',
+__all__ = ['BUCKET_MODIFIED', 'UPDATE_SUBSCRIPTION', 'SUBSCRIPTIONS_CHANGED',
            'notify_bucket_modified', 'update_subscription', 
            'AggregatorSetup']
 
@@ -14,12 +15,16 @@ __all__ = ['BUCKET_MODIFIED', 'UPDATE_SUBSCRIPTION',
 BUCKET_MODIFIED = 'melkman.bucket_modified'
 UPDATE_SUBSCRIPTION = 'melkman.update_subscription'
 
+# event bus channels
+SUBSCRIPTIONS_CHANGED = 'melkman.subscriptions_changed'
+
 def notify_bucket_modified(bucket, context, **kw):
     message = {
         'bucket_id': bucket.id,
         'bucket_types': bucket.document_types,
     }
     message.update(kw)
+    check_in(message, ['updated_items', 'removed_items'], context)
     MessageDispatch(context).send(message, BUCKET_MODIFIED)
 
 def update_subscription(composite, bucket, context, **kw):
@@ -44,6 +49,9 @@ class AggregatorSetup(Component):
         types = (BUCKET_MODIFIED, UPDATE_SUBSCRIPTION)
         
         log.info("Setting up aggregator queues...")
+        from melkman.aggregator.partition import partition_count, partition_message_type
+        types += tuple([partition_message_type(p) for p in range(partition_count(context))])
+
         dispatch = MessageDispatch(context)
         for t in types:
             dispatch.declare(t)
@@ -0,0 +1,219 @@
+# Copyright (C) 2009 The Open Planning Project
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the
+# Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor,
+# Boston, MA  02110-1301
+# USA
+
+from __future__ import with_statement
+from couchdb import ResourceConflict
+from eventlet import spawn, sleep
+from eventlet.semaphore import Semaphore
+import logging
+import traceback
+
+from melkman.db.composite import Composite
+
+log = logging.getLogger(__name__)
+
+__all__ = ['CompositeCache']
+
+DEFAULT_MAX_COMPOSITES = 1000
+
+class _CachedComposite(object):
+    def __init__(self, composite, last_used):
+        self.composite = composite
+        self.last_used = last_used
+        self.dirty = False
+
+class CompositeCache(object):
+    """
+    keeps loaded Composites, including their entries, between
+    updates.  a cached composite is used again only if it is still
+    the latest revision in the database, which is checked without
+    loading it.  at most max_composites are kept, the least
+    recently used are dropped first.
+
+    if write_back is greater than 0, saves are delayed and made
+    every write_back seconds (and when a composite is dropped) so
+    that several updates are saved together.  N.B. changes that
+    have not been written yet are lost if the process exits
+    abnormally.
+
+    composites from the cache must not be updated by more than
+    one greenlet at a time, and must be locked (see lock) while
+    they are updated so that they are not written back at the
+    same time.
+    """
+
+    def __init__(self, context, max_composites=DEFAULT_MAX_COMPOSITES, write_back=0):
+        self.context = context
+        self.max_composites = max_composites
+        self.write_back = write_back
+
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.evictions = 0
+        self.writes = 0
+
+        self._composites = {}
+        self._locks = {}
+        self._clock = 0
+        self._flusher = None
+
+    def get(self, composite_id):
+        """
+        returns the Composite with the id given,
+        or None if there is none.
+        """
+        self._clock += 1
+        cached = self._composites.get(composite_id)
+        if cached is not None:
+            # unsaved changes are newer than the database
+            if (cached.dirty or
+                Composite.latest_rev_for_id(composite_id, self.context) == cached.composite.rev):
+                self.hits += 1
+                cached.last_used = self._clock
+                return cached.composite
+            self.stale += 1
+            del self._composites[composite_id]
+
+        self.misses += 1
+        composite = Composite.get(composite_id, self.context)
+        if composite is None or not 'Composite' in composite.document_types:
+            return composite
+
+        if self.max_composites > 0:
+            while len(self._composites) >= self.max_composites:
+                if not self._evict():
+                    # everything is being updated, go over for now
+                    break
+            self._composites[composite_id] = _CachedComposite(composite, self._clock)
+        return composite
+
+    def lock(self, composite_id):
+        """
+        wait until no other greenlet holds the composite
+        with the id given, and hold it.
+        """
+        entry = self._locks.get(composite_id)
+        if entry is None:
+            entry = [Semaphore(1), 0]
+            self._locks[composite_id] = entry
+        entry[1] += 1
+        entry[0].acquire()
+
+    def unlock(self, composite_id):
+        entry = self._locks[composite_id]
+        entry[0].release()
+        entry[1] -= 1
+        if entry[1] == 0:
+            del self._locks[composite_id]
+
+    def save(self, composite):
+        """
+        save the composite given now, or soon if
+        writing back.
+        """
+        cached = self._composites.get(composite.id)
+        if self.write_back > 0 and cached is not None and cached.composite is composite:
+            cached.dirty = True
+            if self._flusher is None:
+                self._flusher = spawn(self._run_flush)
+        else:
+            self._save(composite)
+
+    def invalidate(self, composite_id):
+        self._composites.pop(composite_id, None)
+
+    def flush(self):
+        """
+        write all composites with unsaved changes.
+        """
+        for cached in self._composites.values():
+            if not cached.dirty:
+                continue
+            cid = cached.composite.id
+            self.lock(cid)
+            try:
+                if cached.dirty:
+                    cached.dirty = False
+                    self._save(cached.composite)
+            except:
+                log.error("Error saving composite %s: %s" %
+                          (cid, traceback.format_exc()))
+            finally:
+                self.unlock(cid)
+
+    def stats(self):
+        lookups = self.hits + self.misses + self.stale
+        return {'composites': len(self._composites),
+                'hits': self.hits,
+                'misses': self.misses,
+                'stale': self.stale,
+                'evictions': self.evictions,
+                'writes': self.writes,
+                'hit_rate': lookups and float(self.hits) / lookups or 0.0}
+
+    def _save(self, composite):
+        self.writes += 1
+        try:
+            composite.save()
+        except ResourceConflict:
+            # not a big deal in this case. This basically means
+            # our timestamp did not become the latest -- we
+            # have made no alterations other than adding items.
+            # Our additions succeed/fail independently of this as they
+            # are separate documents.  Our copy is out of date though.
+            self.invalidate(composite.id)
+        except:
+            self.invalidate(composite.id)
+            raise
+
+    def _evict(self):
+        """
+        drop the least recently used composite which is not
+        being updated, returns False if there is none.
+        """
+        idle = [c for c in self._composites.values()
+                if not c.composite.id in self._locks]
+        if len(idle) == 0:
+            return False
+        oldest = min(idle, key=lambda c: c.last_used)
+        cid = oldest.composite.id
+        del self._composites[cid]
+        self.evictions += 1
+        if oldest.dirty:
+            # held so that the next update of the composite
+            # loads it after these changes are saved.
+            self.lock(cid)
+            try:
+                self._save(oldest.composite)
+            except:
+                log.error("Error saving evicted composite %s: %s" %
+                          (cid, traceback.format_exc()))
+            finally:
+                self.unlock(cid)
+        return True
+
+    def _run_flush(self):
+        try:
+            sleep(self.write_back)
+        finally:
+            self._flusher = None
+        with self.context:
+            self.flush()
+        log.debug("composite cache: %s" % self.stats())
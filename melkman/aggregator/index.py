@@ -0,0 +1,115 @@
+# Copyright (C) 2009 The Open Planning Project
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the
+# Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor,
+# Boston, MA  02110-1301
+# USA
+
+import logging
+import time
+
+from melkman.db.composite import view_composites_by_subscription
+from melkman.db.util import batched_view_iter
+
+log = logging.getLogger(__name__)
+
+__all__ = ['SubscriberIndex']
+
+DEFAULT_MAX_BUCKETS = 10000
+DEFAULT_MAX_AGE = 300
+
+class SubscriberIndex(object):
+    """
+    in memory index of the composites subscribed to each bucket,
+    filled in from view_composites_by_subscription as buckets
+    are looked up.
+
+    entries are dropped when subscriptions to the bucket change
+    (see invalidate) or after max_age seconds.  at most max_buckets
+    buckets are remembered, the least recently used are dropped 
+    first.
+    """
+
+    def __init__(self, context, max_buckets=DEFAULT_MAX_BUCKETS,
+                 max_age=DEFAULT_MAX_AGE):
+        self.context = context
+        self.max_buckets = max_buckets
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._subscribers = {} # bucket_id -> entry
+        # circular list of [prev, next, bucket_id, expires, composite ids]
+        # most recently used first.
+        self._head = [None, None, None, None, None]
+        self._head[0] = self._head[1] = self._head
+
+    def subscribers(self, bucket_id):
+        """
+        returns a list of the ids of the composites
+        subscribed to the bucket given.
+        """
+        now = time.time()
+        entry = self._subscribers.get(bucket_id)
+        if entry is not None and entry[3] > now:
+            self.hits += 1
+            self._unlink(entry)
+            self._link_first(entry)
+            return entry[4]
+
+        self.misses += 1
+        composite_ids = self._lookup(bucket_id)
+        if self.max_buckets > 0:
+            self.invalidate([bucket_id])
+            while len(self._subscribers) >= self.max_buckets:
+                self.invalidate([self._head[0][2]])
+                self.evictions += 1
+            entry = [None, None, bucket_id, now + self.max_age, composite_ids]
+            self._subscribers[bucket_id] = entry
+            self._link_first(entry)
+        return composite_ids
+
+    def invalidate(self, bucket_ids):
+        """
+        forget the subscribers to the buckets given.
+        """
+        for bucket_id in bucket_ids:
+            entry = self._subscribers.pop(bucket_id, None)
+            if entry is not None:
+                self._unlink(entry)
+
+    def clear(self):
+        self._subscribers = {}
+        self._head[0] = self._head[1] = self._head
+
+    def _lookup(self, bucket_id):
+        query = {
+            'startkey': bucket_id,
+            'endkey': bucket_id,
+            'include_docs': False
+        }
+        return [r.id for r in batched_view_iter(self.context.db, view_composites_by_subscription,
+                                                1000, **query)]
+
+    def _link_first(self, entry):
+        first = self._head[1]
+        entry[0] = self._head
+        entry[1] = first
+        first[0] = entry
+        self._head[1] = entry
+
+    def _unlink(self, entry):
+        entry[0][1] = entry[1]
+        entry[1][0] = entry[0]
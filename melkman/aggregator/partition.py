@@ -0,0 +1,157 @@
+# Copyright (C) 2009 The Open Planning Project
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the
+# Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor,
+# Boston, MA  02110-1301
+# USA
+
+"""
+partitioning of composite updates between aggregator processes.
+
+with partitioning turned on, eg:
+
+aggregator: {
+    partitions: 64,
+    member_heartbeat: 5
+}
+
+update_subscription messages for a composite are always sent to
+the same one of 'partitions' queues, chosen by a hash of the
+composite id.  each partition is consumed by a single live aggregator
+process, so usually only one process at a time updates a given 
+composite.  
+
+this is not guaranteed while partitions move: members may disagree 
+about who is live for up to member_heartbeat * MISSED_HEARTBEATS 
+seconds, and updates already taken by the old owner carry on after 
+it stops consuming.  to make overlap unlikely, a process only starts 
+consuming a partition it gains once it has owned it for 
+HANDOFF_HEARTBEATS heartbeats, which gives the old owner time to 
+notice and finish its work.
+
+aggregator processes announce themselves on the event bus every
+member_heartbeat seconds.  partitions are assigned to the live
+processes by rendezvous hashing, so when processes come and go
+only the partitions of the processes that changed move.
+"""
+
+from eventlet import sleep
+from hashlib import md5
+import logging
+import time
+from uuid import uuid1
+
+from melkman.aggregator.api import UPDATE_SUBSCRIPTION
+from melkman.messaging import EventBus
+
+log = logging.getLogger(__name__)
+
+__all__ = ['partition_count', 'partition_for', 'partition_message_type',
+           'assign_partitions', 'PartitionMembership', 'DEFAULT_HEARTBEAT',
+           'HANDOFF_HEARTBEATS']
+
+# event bus channel for membership heartbeats
+AGGREGATOR_MEMBERS = 'melkman.aggregator_members'
+
+DEFAULT_HEARTBEAT = 5
+# members not heard from in this many heartbeats are gone
+MISSED_HEARTBEATS = 3
+# gained partitions are consumed after this many heartbeats
+HANDOFF_HEARTBEATS = 2
+
+def _hash(key):
+    if isinstance(key, unicode):
+        key = key.encode('utf-8')
+    return long(md5(key).hexdigest()[:16], 16)
+
+def partition_count(context):
+    """
+    the configured number of partitions, 0 if
+    partitioning is turned off.
+    """
+    return int(context.config.get('aggregator', {}).get('partitions', 0))
+
+def partition_for(composite_id, partitions):
+    return _hash(composite_id) % partitions
+
+def partition_message_type(partition):
+    return '%s.%d' % (UPDATE_SUBSCRIPTION, partition)
+
+def assign_partitions(members, partitions):
+    """
+    returns a dictionary mapping each member to the
+    list of partitions it owns.
+    """
+    assignment = dict([(m, []) for m in members])
+    if len(members) == 0:
+        return assignment
+    for p in range(partitions):
+        owner = max(members, key=lambda m: _hash('%s:%d' % (m, p)))
+        assignment[owner].append(p)
+    return assignment
+
+class PartitionMembership(object):
+    """
+    tracks the live aggregator processes and the
+    partitions owned by this one.
+    """
+
+    def __init__(self, context, partitions, heartbeat=DEFAULT_HEARTBEAT):
+        self.context = context
+        self.partitions = partitions
+        self.heartbeat = heartbeat
+        self.member_id = uuid1().hex
+        self._members = {self.member_id: time.time()}
+        self._event_bus = None
+
+    def start(self):
+        """
+        begin announcing this process and listening for others.
+        waits one heartbeat so that the other members are known
+        before partitions are claimed.
+        """
+        self._event_bus = EventBus(self.context)
+        self._event_bus.add_listener(AGGREGATOR_MEMBERS, self._heard)
+        self.announce()
+        sleep(self.heartbeat)
+
+    def stop(self):
+        if self._event_bus is not None:
+            self._event_bus.send(AGGREGATOR_MEMBERS, {'member_id': self.member_id,
+                                                      'leaving': True})
+            self._event_bus.kill()
+            self._event_bus = None
+
+    def announce(self):
+        self._event_bus.send(AGGREGATOR_MEMBERS, {'member_id': self.member_id})
+
+    def members(self):
+        cutoff = time.time() - self.heartbeat * MISSED_HEARTBEATS
+        for member_id, last_seen in self._members.items():
+            if last_seen < cutoff and member_id != self.member_id:
+                del self._members[member_id]
+        return sorted(self._members.keys())
+
+    def owned_partitions(self):
+        return assign_partitions(self.members(), self.partitions)[self.member_id]
+
+    def _heard(self, event):
+        member_id = event.get('member_id')
+        if member_id is None or member_id == self.member_id:
+            return
+        if event.get('leaving', False):
+            self._members.pop(member_id, None)
+        else:
+            self._members[member_id] = time.time()
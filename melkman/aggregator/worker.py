@@ -2,43 +2,92 @@ from __future__ import with_statement
 from copy import deepcopy
 from couchdb import ResourceConflict, ResourceNotFound
 from eventlet import spawn, sleep
+from eventlet.event import Event
 from eventlet.support.greenlets import GreenletExit
 from giblets import Component, implements
+from datetime import timedelta
 import logging
+import time
 import traceback
 
 from melkman.aggregator.api import *
+from melkman.aggregator.cache import CompositeCache, DEFAULT_MAX_COMPOSITES
+from melkman.aggregator.index import SubscriberIndex, DEFAULT_MAX_BUCKETS, DEFAULT_MAX_AGE
+from melkman.aggregator.partition import *
+from melkman.claimcheck import CLAIMS, check_in, claimed, release_claims
 from melkman.db.bucket import NewsBucket, NewsItemRef
-from melkman.db.composite import Composite, view_composites_by_subscription
+from melkman.db.composite import Composite, DEFAULT_BACKFILL_DEPTH, DEFAULT_BACKFILL_PAGE_SIZE
 from melkman.db.remotefeed import RemoteFeed
-from melkman.db.util import batched_view_iter
 from melkman.fetch.api import request_feed_index
 from melkman.green import waitall, killall, Pool
-from melkman.messaging import MessageDispatch, always_ack, pooled
-from melkman.worker import IWorkerProcess
+from melkman.messaging import EventBus, MessageDispatch, always_ack, pooled
+from melkman.worker import IWorkerProcess, pool_settings
 
 log = logging.getLogger(__name__)
 
-def _handle_bucket_modified(message_data, message, context):
+DEFAULT_FANOUT_BATCH_SIZE = 100
+DEFAULT_COALESCE_WINDOW = 0.1
+DEFAULT_BACKFILL_TIME_BUDGET = 10
+DEFAULT_BACKFILL_CONCURRENCY = 10
+
+def _handle_bucket_modified(message_data, message, context, subscribers=None):
     """
     main aggregator handler for the 'bucket_modified' message
     """
 
-    # the 'bucket' was a Composite, and there are new
-    # subscriptions to update.
-    if ('Composite' in message_data.get('bucket_types', []) and 
-        len(message_data.get('new_subscriptions', [])) > 0):
-        _handle_new_subscriptions(message_data, message, context)
+    if 'Composite' in message_data.get('bucket_types', []):
+        # let all aggregators know the subscriptions changed
+        changed_subs = (message_data.get('new_subscriptions', []) + 
+                        message_data.get('removed_subscriptions', []))
+        if len(changed_subs) > 0 and not message_data.get('backfill', False):
+            if subscribers is not None:
+                subscribers.invalidate(changed_subs)
+            EventBus(context).send(SUBSCRIPTIONS_CHANGED, {'bucket_ids': changed_subs})
+
+        # the 'bucket' was a Composite, and there are new
+        # subscriptions to update.
+        if len(message_data.get('new_subscriptions', [])) > 0:
+            _handle_new_subscriptions(message_data, message, context)
 
     # there are new items that have been put into the bucket, 
     # notify anyone who is subscribed to this bucket.
-    if len(message_data.get('updated_items', [])) > 0:
-        _notify_subscribers(message_data, message, context)
+    try:
+        if len(claimed(message_data, 'updated_items', context, [])) > 0:
+            _notify_subscribers(message_data, message, context, subscribers)
+    finally:
+        release_claims(message_data, context)
+
+def backfill_settings(context):
+    """
+    returns keyword arguments for Composite.backfill_subscription 
+    and the time budget for backfilling in a single message from 
+    the settings, eg:
+
+    aggregator: {
+        backfill_depth: 50,        # items per subscription
+        backfill_window: 86400,    # seconds back
+        backfill_page_size: 50,    # items read at once
+        backfill_time_budget: 10   # seconds per message
+    }
+    """
+    cfg = context.config.get('aggregator', {})
+    kw = {
+        'depth': int(cfg.get('backfill_depth', DEFAULT_BACKFILL_DEPTH)),
+        'window': timedelta(seconds=int(cfg.get('backfill_window', 86400))),
+        'page_size': int(cfg.get('backfill_page_size', DEFAULT_BACKFILL_PAGE_SIZE))
+    }
+    budget = float(cfg.get('backfill_time_budget', DEFAULT_BACKFILL_TIME_BUDGET))
+    return kw, budget
 
 def _handle_new_subscriptions(message_data, message, context):
     """
     helper handler called when new subscriptions are added to 
     a composite.
+
+    the most recent items of each new subscription are added to 
+    the composite until the time budget runs out.  progress is 
+    saved on the composite and the remaining subscriptions are 
+    sent again as a new message.
     """
     try:
         new_subscriptions = message_data.get('new_subscriptions', [])
@@ -56,34 +105,72 @@ def _handle_new_subscriptions(message_data, message, context):
             log.error("Ignoring subscription update for non-existent composite %s" % cid)
             return
         
-        new_feeds = []
-        updates = 0
+        backfill_kw, budget = backfill_settings(context)
+        deadline = time.time() + budget
+
+        candidates = []
         for sub in new_subscriptions:
             if not sub in composite.subscriptions:
                 log.warn("ignoring subscription %s -> %s, not in composite" % (sub, cid))
                 continue
-            
-            bucket = NewsBucket.get(sub, context)
-            if bucket is None:
+            candidates.append(sub)
+
+        # look up all the subscribed buckets at once
+        buckets = {}
+        if candidates:
+            for r in context.db.view('_all_docs', keys=candidates, include_docs=True):
+                if r.get('doc') is not None:
+                    buckets[r.key] = r.doc
+
+        new_feeds = []
+        to_read = []
+        for sub in candidates:
+            bucket = buckets.get(sub)
+            if bucket is None or not 'NewsBucket' in bucket.get('document_types', []):
                 log.warn("Ignoring init subscription to unknown object (%s)" % composite.subscriptions[sub])
                 continue
 
             #  try 'casting' to a RemoteFeed
-            if 'RemoteFeed' in bucket.document_types:
-                rf = RemoteFeed.from_doc(bucket.unwrap(), context)
+            if 'RemoteFeed' in bucket['document_types']:
+                rf = RemoteFeed.from_doc(bucket, context)
                 # mark as needing immediate fetch if 
                 # there is no history for this feed. 
                 if len(rf.update_history) == 0:
                     new_feeds.append(rf.url)
                     continue
+            to_read.append(sub)
 
+        # read the initial items of each subscription concurrently,
+        # subscriptions not started before the deadline are left 
+        # for later (but the first is always read).
+        def read_backfill(args):
+            i, sub = args
+            if i > 0 and time.time() >= deadline:
+                return sub, False, []
             try:
-                log.debug("init subscription %s -> %s" % (sub, cid))
-                updates += composite.init_subscription(sub)
-                sleep(0) # yield control
+                with context:
+                    log.debug("init subscription %s -> %s" % (sub, cid))
+                    done, items = composite.read_backfill(sub, deadline=deadline, **backfill_kw)
+                    return sub, done, items
             except:
                 log.error("Error initializing subscription %s -> %s: %s" % (sub, cid, traceback.format_exc()))
-        if updates > 0:
+                return sub, True, []
+
+        cfg = context.config.get('aggregator', {})
+        pool = Pool(int(cfg.get('backfill_concurrency', DEFAULT_BACKFILL_CONCURRENCY)))
+        remaining = []
+        initial_items = []
+        checkpointed = len(composite.backfill_progress) > 0
+        for sub, done, items in pool.imap(read_backfill, enumerate(to_read)):
+            initial_items += items
+            if not done:
+                remaining.append(sub)
+
+        updates = 0
+        if initial_items:
+            updates = composite.filtered_update(initial_items)
+
+        if updates > 0 or remaining or checkpointed:
             try:
                 composite.save()
             except ResourceConflict: 
@@ -94,6 +181,11 @@ def _handle_new_subscriptions(message_data, message, context):
                 # are separate documents.
                 pass
 
+        # pick up the rest later
+        if remaining:
+            log.debug("continuing init of %d subscriptions to %s later" % (len(remaining), cid))
+            notify_bucket_modified(composite, context, new_subscriptions=remaining, backfill=True)
+
         # request that we start indexing anything new...
         for url in new_feeds:
             request_feed_index(url, context)
@@ -101,10 +193,25 @@ def _handle_new_subscriptions(message_data, message, context):
         log.error("Error handling init_subscrition %s: %s" % (message_data, traceback.format_exc()))
         raise
 
-def _notify_subscribers(message_data, message, context):
+def _notify_subscribers(message_data, message, context, subscribers=None):
     """
     helper handler called to notify subscribers to a bucket
     of an update.
+
+    by default, one update_subscription message carrying the 
+    updated items is sent for each subscribed composite.  with the 
+    setting:
+
+    aggregator: {
+        batched_fanout: true
+    }
+
+    one message is sent for each batch of subscribed composites 
+    instead.  these refer to the updated items by id rather than 
+    copying them, the items are read back from the bucket when the 
+    update is handled.  older aggregators ignore these messages, so 
+    this should only be turned on once every aggregator has been 
+    upgraded.
     """
     try:
         bucket_id = message_data.get('bucket_id', None)
@@ -113,88 +220,341 @@ def _notify_subscribers(message_data, message, context):
             message.ack()
             return
 
-        out_message = deepcopy(message_data)
-        out_message['command'] = 'update_subscription'
+        if subscribers is None:
+            subscribers = SubscriberIndex(context, max_buckets=0)
+        composite_ids = subscribers.subscribers(bucket_id)
+        if len(composite_ids) == 0:
+            return
 
+        cfg = context.config.get('aggregator', {})
         publisher = MessageDispatch(context)
-        # iterate subscribed composites.
-        query = {
-            'startkey': bucket_id,
-            'endkey': bucket_id,
-            'include_docs': False
-        }
-        # send a message for each subscribed composite that indicates the
-        # need to update from the changed bucket.
-        for r in batched_view_iter(context.db, view_composites_by_subscription, 100, **query):
-            log.debug("notify %s of update to %s" % (r.id, out_message['bucket_id']))
-            out_message['composite_id'] = r.id
-            publisher.send(out_message, UPDATE_SUBSCRIPTION)
+        partitions = partition_count(context)
+
+        if not cfg.get('batched_fanout', False):
+            claimed(message_data, 'removed_items', context)
+            base_message = deepcopy(message_data)
+            base_message.pop(CLAIMS, None)
+            base_message['command'] = 'update_subscription'
+            # send a message for each subscribed composite that indicates the
+            # need to update from the changed bucket.
+            for cid in composite_ids:
+                log.debug("notify %s of update to %s" % (cid, bucket_id))
+                out_message = dict(base_message)
+                out_message['composite_id'] = cid
+                # each message holds its own claim on the items
+                check_in(out_message, ['updated_items', 'removed_items'], context)
+                publisher.send(out_message, _update_message_type(cid, partitions))
+            return
+
+        out_message = dict([(k, v) for k, v in message_data.items() 
+                            if k not in ('updated_items', 'removed_items', CLAIMS)])
+        out_message['command'] = 'update_subscription'
+        out_message['updated_item_ids'] = [item['item_id'] for item in message_data['updated_items']]
+
+        # composites in the same partition are sent together
+        by_type = {}
+        for cid in composite_ids:
+            by_type.setdefault(_update_message_type(cid, partitions), []).append(cid)
+
+        batch_size = int(cfg.get('fanout_batch_size', DEFAULT_FANOUT_BATCH_SIZE))
+        for message_type, cids in by_type.items():
+            batches = []
+            for start in range(0, len(cids), batch_size):
+                batch = dict(out_message)
+                batch['composite_ids'] = cids[start:start + batch_size]
+                batches.append(batch)
+            log.debug("notify %d composites of update to %s" % (len(cids), bucket_id))
+            publisher.send_many(batches, message_type)
     except:
         log.error("Error dispatching composite updates: %s" % traceback.format_exc())
         raise
 
+def _update_message_type(composite_id, partitions):
+    if partitions > 0:
+        return partition_message_type(partition_for(composite_id, partitions))
+    return UPDATE_SUBSCRIPTION
 
-def _handle_update_subscription(message_data, message, context):
+def _handle_update_subscription(message_data, message, context, coalescer=None):
     """
     main aggregator handler for the 'update_subscription' message
+
+    if an UpdateCoalescer is given, the updates are merged with other
+    updates to the same composites and this returns once they have 
+    been saved.  if they could not be saved, the message is requeued.
     """
+    requeued = False
     try:
-        updated_items = message_data.get('updated_items', [])
-        if len(updated_items) == 0:
+        updated_items = claimed(message_data, 'updated_items', context, [])
+        updated_item_ids = message_data.get('updated_item_ids', [])
+        if len(updated_items) == 0 and len(updated_item_ids) == 0:
             log.debug('Ignoring subscription update with no updated items...')
             return
 
-        cid = message_data.get('composite_id', None)
-        if cid is None:
+        cids = message_data.get('composite_ids', None)
+        if cids is None and message_data.get('composite_id', None) is not None:
+            cids = [message_data['composite_id']]
+        if not cids:
             log.debug('Ignoring subscription update with no composite id...')
             return
         
         bid = message_data.get('bucket_id', None)
         if bid is None:
-            log.debug('Ignoring subscription update to %s with no bucket id...' % cid)
+            log.debug('Ignoring subscription update to %s with no bucket id...' % cids)
             return
 
-        composite = Composite.get(cid, context)
-        if composite is None or not 'Composite' in composite.document_types:
-            log.error("Ignoring subscription update for non-existent composite %s" % cid)                
+        if len(updated_items) > 0:
+            updated_refs = []
+            for item in updated_items:
+                ref = dict([(str(k), v) for k, v in item.items()])
+                updated_refs.append(NewsItemRef.from_doc(ref, context))
+        else:
+            updated_refs = _load_updated_refs(bid, updated_item_ids, context)
+            if len(updated_refs) == 0:
+                log.debug('Ignoring subscription update, items in %s no longer exist' % bid)
+                return
+
+        if coalescer is not None:
+            pending = [coalescer.update(cid, bid, updated_refs) for cid in cids]
+            failed = [p.composite_id for p in pending if not p.wait()]
+            if len(failed) > 0:
+                log.warn("Requeueing subscription update to %s from %s" % (failed, bid))
+                message.requeue()
+                requeued = True
             return
 
-        # check source 
-        if not bid in composite.subscriptions:
-            log.warn('Ignoring subscription update to %s for non-subscribed bucket %s' % (cid, bid))
-        
-        log.debug("updating %s (from bucket %s)" % (cid, bid))
-        updated_refs = []
-        for item in updated_items:
-            ref = dict([(str(k), v) for k, v in item.items()])
-            updated_refs.append(NewsItemRef.from_doc(ref, context))
-        count = composite.filtered_update(updated_refs)
-        if count > 0:
+        for cid in cids:
             try:
-                composite.save()
-            except ResourceConflict:
-                # not a big deal in this case. This basically means
-                # our timestamp did not become the latest -- we 
-                # have made no alterations other than adding items.
-                # Our additions succeed/fail independently of this as they
-                # are separate documents.
-                pass
+                _update_composite(cid, [bid], updated_refs, context)
+            except:
+                log.error("Error updating composite %s from %s: %s" % 
+                          (cid, bid, traceback.format_exc()))
     except:
         log.error("Error updating composite subscription %s: %s" % 
                   (message_data, traceback.format_exc()))
         raise
+    finally:
+        # the claims are needed again when the message is redelivered
+        if not requeued:
+            release_claims(message_data, context)
+
+def _load_updated_refs(bucket_id, item_ids, context):
+    """
+    read back the NewsItemRefs for the items given 
+    from the bucket given.
+    """
+    keys = [NewsItemRef.dbid(bucket_id, iid) for iid in item_ids]
+    refs = []
+    for r in context.db.view('_all_docs', keys=keys, include_docs=True):
+        if r.get('doc') is not None:
+            refs.append(NewsItemRef.from_doc(r.doc, context))
+    return refs
+
+def _update_composite(cid, bucket_ids, updated_refs, context, cache=None):
+    if cache is not None:
+        composite = cache.get(cid)
+    else:
+        composite = Composite.get(cid, context)
+    if composite is None or not 'Composite' in composite.document_types:
+        log.error("Ignoring subscription update for non-existent composite %s" % cid)                
+        return
+
+    # check source 
+    for bid in bucket_ids:
+        if not bid in composite.subscriptions:
+            log.warn('Ignoring subscription update to %s for non-subscribed bucket %s' % (cid, bid))
+    
+    log.debug("updating %s (from buckets %s)" % (cid, ', '.join(bucket_ids)))
+    try:
+        count = composite.filtered_update(updated_refs)
+    except:
+        # don't keep a partially updated copy around
+        if cache is not None:
+            cache.invalidate(cid)
+        raise
+    if count > 0 and cache is not None:
+        cache.save(composite)
+    elif count > 0:
+        try:
+            composite.save()
+        except ResourceConflict:
+            # not a big deal in this case. This basically means
+            # our timestamp did not become the latest -- we 
+            # have made no alterations other than adding items.
+            # Our additions succeed/fail independently of this as they
+            # are separate documents.
+            pass
 
+class _PendingUpdate(object):
+    """
+    the updates to a single composite waiting to be 
+    applied, see UpdateCoalescer
+    """
+    def __init__(self, composite_id):
+        self.composite_id = composite_id
+        self.bucket_ids = []
+        self.refs = {}
+        self.failed = False
+        self.done = Event()
+
+    def add(self, bucket_id, refs):
+        if not bucket_id in self.bucket_ids:
+            self.bucket_ids.append(bucket_id)
+        for ref in refs:
+            current = self.refs.get(ref.item_id)
+            if current is None or ref.supersedes(current):
+                self.refs[ref.item_id] = ref
+
+    def wait(self):
+        """
+        returns True if the updates were saved, False if
+        they failed.
+        """
+        self.done.wait()
+        return not self.failed
+
+class UpdateCoalescer(object):
+    """
+    merges the subscription updates to each composite that arrive 
+    within window seconds of each other so that the composite is 
+    loaded, filtered and saved once for all of them.  when the same 
+    item arrives more than once, the newest version is used.
+
+    updates to a composite are applied one batch at a time, a batch 
+    does not start until the previous batch for the composite is saved.
+    this also makes it safe to use a CompositeCache for the updates.
+    """
+
+    def __init__(self, context, window=DEFAULT_COALESCE_WINDOW, cache=None):
+        self.context = context
+        self.window = window
+        self.cache = cache
+        self._pending = {}
+        self._flushing = {}
+
+    def update(self, composite_id, bucket_id, refs):
+        """
+        add updated items from the bucket given to the next update 
+        of the composite given.  returns an object with a wait method 
+        which returns once the update has been applied, or returns 
+        False if it could not be.
+        """
+        pending = self._pending.get(composite_id)
+        if pending is None:
+            pending = _PendingUpdate(composite_id)
+            self._pending[composite_id] = pending
+            spawn(self._run_flush, pending)
+        pending.add(bucket_id, refs)
+        return pending
+
+    def _run_flush(self, pending):
+        cid = pending.composite_id
+        previous = self._flushing.get(cid)
+        self._flushing[cid] = pending.done
+        try:
+            sleep(self.window)
+            if self._pending.get(cid) is pending:
+                del self._pending[cid]
+            if previous is not None:
+                previous.wait()
+
+            with self.context:
+                log.debug("applying %d coalesced updates to %s" % (len(pending.refs), cid))
+                if self.cache is not None:
+                    # not while the cache is writing it back
+                    self.cache.lock(cid)
+                try:
+                    _update_composite(cid, pending.bucket_ids, pending.refs.values(), 
+                                      self.context, self.cache)
+                finally:
+                    if self.cache is not None:
+                        self.cache.unlock(cid)
+        except:
+            pending.failed = True
+            log.error("Error updating composite %s from %s: %s" % 
+                      (cid, pending.bucket_ids, traceback.format_exc()))
+        finally:
+            if self._flushing.get(cid) is pending.done:
+                del self._flushing[cid]
+            pending.done.send(True)
+
+def _run_partition_consumers(membership, handler, prefetch_count, context):
+    """
+    consume the update_subscription partitions owned by this 
+    process, following changes in membership.  partitions gained
+    are only consumed once they have been owned for 
+    HANDOFF_HEARTBEATS heartbeats.
+    """
+    dispatcher = MessageDispatch(context)
+    consumers = {}
+    handoff = membership.heartbeat * HANDOFF_HEARTBEATS
+    gaining = {} # partition -> when it was first owned
+    try:
+        while True:
+            now = time.time()
+            owned = set(membership.owned_partitions())
+            lost = [p for p in consumers if not p in owned]
+            for p in gaining.keys():
+                if not p in owned:
+                    del gaining[p]
+            for p in owned:
+                if not p in consumers and not p in gaining:
+                    gaining[p] = now
+            gained = [p for p, since in gaining.items() if now - since >= handoff]
+            for p in gained:
+                del gaining[p]
+            if lost or gained:
+                log.info("aggregator %s now owns %d of %d partitions (+%d, -%d)" % 
+                         (membership.member_id, len(owned), membership.partitions,
+                          len(gained), len(lost)))
+            for p in lost:
+                consumers.pop(p).kill()
+            for p in gained:
+                consumers[p] = dispatcher.start_worker(partition_message_type(p), handler,
+                                                       prefetch_count=prefetch_count)
+            sleep(membership.heartbeat)
+            membership.announce()
+    finally:
+        killall(consumers.values())
+        waitall(consumers.values())
 
 def run_aggregator(context):
     try:
-        worker_pool = Pool()
+        procs = []
+        event_bus = None
+        membership = None
+        cache = None
+        pool_size, prefetch_count = pool_settings(context, 'aggregator')
+        worker_pool = Pool(pool_size)
+
+        cfg = context.config.get('aggregator', {})
+        subscribers = SubscriberIndex(context,
+                                      max_buckets=int(cfg.get('subscriber_cache_size', DEFAULT_MAX_BUCKETS)),
+                                      max_age=int(cfg.get('subscriber_cache_max_age', DEFAULT_MAX_AGE)))
+        def subscriptions_changed(event):
+            subscribers.invalidate(event.get('bucket_ids', []))
+
+        # merging updates to the same composite holds pool 
+        # slots for up to the window, the messages are only 
+        # acknowledged after their update is saved.  off unless
+        # a window is configured.
+        window = float(cfg.get('coalesce_window', 0))
+        cache_size = int(cfg.get('composite_cache_size', DEFAULT_MAX_COMPOSITES))
+        if window > 0:
+            # composites are only cached when updates to each
+            # are serialized by the coalescer.
+            if cache_size > 0:
+                cache = CompositeCache(context, cache_size, 
+                                       float(cfg.get('composite_cache_write_back', 0)))
+            coalescer = UpdateCoalescer(context, window, cache)
+        else:
+            coalescer = None
 
         @pooled(worker_pool)
         @always_ack
         def bucket_modified_handler(message_data, message):
             try:
                 with context:
-                    _handle_bucket_modified(message_data, message, context)
+                    _handle_bucket_modified(message_data, message, context, subscribers)
             except GreenletExit:
                 pass
             except: 
@@ -206,17 +566,29 @@ def run_aggregator(context):
         def update_subscription_handler(message_data, message):
             try:
                 with context:
-                    _handle_update_subscription(message_data, message, context)
+                    _handle_update_subscription(message_data, message, context, coalescer)
             except GreenletExit:
                 pass
             except: 
                 log.error("Unexpected error handling update subscription message: %s" % traceback.format_exc())
 
-        procs = []
         with context:
+            event_bus = EventBus(context)
+            event_bus.add_listener(SUBSCRIPTIONS_CHANGED, subscriptions_changed)
+
             dispatcher = MessageDispatch(context)
-            procs.append(dispatcher.start_worker(BUCKET_MODIFIED, bucket_modified_handler))
-            procs.append(dispatcher.start_worker(UPDATE_SUBSCRIPTION, update_subscription_handler))
+            procs.append(dispatcher.start_worker(BUCKET_MODIFIED, bucket_modified_handler,
+                                                 prefetch_count=prefetch_count))
+            procs.append(dispatcher.start_worker(UPDATE_SUBSCRIPTION, update_subscription_handler,
+                                                 prefetch_count=prefetch_count))
+
+            partitions = partition_count(context)
+            if partitions > 0:
+                membership = PartitionMembership(context, partitions,
+                                                 float(cfg.get('member_heartbeat', DEFAULT_HEARTBEAT)))
+                membership.start()
+                procs.append(spawn(_run_partition_consumers, membership, 
+                                   update_subscription_handler, prefetch_count, context))
     
         waitall(procs)
     except GreenletExit:
@@ -227,6 +599,15 @@ def run_aggregator(context):
         # stop accepting work
         killall(procs)
         waitall(procs)
+        if event_bus is not None:
+            event_bus.kill()
+        if membership is not None:
+            with context:
+                membership.stop()
+        if cache is not None:
+            with context:
+                cache.flush()
+            log.info("composite cache: %s" % cache.stats())
         # stop working on existing work
         worker_pool.killall()
         worker_pool.waitall()
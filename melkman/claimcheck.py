@@ -0,0 +1,331 @@
+# Copyright (C) 2009 The Open Planning Project
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the
+# Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor,
+# Boston, MA  02110-1301
+# USA
+
+"""
+claim checks for large message fields.
+
+with claim checks turned on, eg:
+
+messaging: {
+    claim_check_threshold: 65536,
+    claim_check_store: couchdb,  # or filesystem
+    claim_check_path: /var/lib/melkman/claims, # for filesystem
+    claim_check_ttl: 86400
+}
+
+fields of a message (see check_in) whose serialized value is longer
+than claim_check_threshold bytes are written to a blob store named
+by the hash of their contents, and only the hash is sent in the
+message.  the consumer loads a field when it asks for it (see
+claimed) and releases the blobs once it is done with the message.
+
+workers read claim checked fields from the configured store even
+when claim_check_threshold is 0, so claim checks can be turned on 
+or off while messages are in flight.
+
+blobs that are never released are removed claim_check_ttl seconds
+after they were last stored by ClaimCheckReclaimer.  The
+filesystem store must be shared by the processes sending and
+receiving the messages, and only reclaims by age.
+"""
+
+from __future__ import with_statement
+from base64 import b64encode
+from couchdb import ResourceConflict, ResourceNotFound
+from eventlet import sleep
+from eventlet.support.greenlets import GreenletExit
+from giblets import Component, implements
+from hashlib import sha1
+import logging
+import os
+from simplejson import dumps, loads
+import time
+import traceback
+from uuid import uuid1
+
+from melkman.worker import IWorkerProcess
+
+log = logging.getLogger(__name__)
+
+__all__ = ['check_in', 'claimed', 'has_claimed', 'release_claims', 'claim_store',
+           'FilesystemClaimStore', 'CouchDBClaimStore', 'ClaimCheckReclaimer']
+
+# message key holding the claims, field -> blob key
+CLAIMS = 'claim_checks'
+
+DEFAULT_TTL = 86400
+DEFAULT_RECLAIM_INTERVAL = 600
+
+class FilesystemClaimStore(object):
+    """
+    keeps blobs as files in a directory.
+    """
+
+    def __init__(self, path, ttl=DEFAULT_TTL):
+        self.path = path
+        self.ttl = ttl
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def put(self, data):
+        key = sha1(data).hexdigest()
+        filename = self._filename(key)
+        if os.path.exists(filename):
+            # already stored, just extend its life
+            os.utime(filename, None)
+            return key
+        tmp = '%s.%s.tmp' % (filename, uuid1().hex)
+        f = open(tmp, 'wb')
+        try:
+            f.write(data)
+        finally:
+            f.close()
+        os.rename(tmp, filename)
+        return key
+
+    def get(self, key):
+        try:
+            f = open(self._filename(key), 'rb')
+        except IOError:
+            return None
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+    def release(self, key):
+        # other messages may refer to the same blob,
+        # it is left to expire.
+        pass
+
+    def reclaim(self):
+        cutoff = time.time() - self.ttl
+        removed = 0
+        for name in os.listdir(self.path):
+            filename = os.path.join(self.path, name)
+            try:
+                if os.path.getmtime(filename) < cutoff:
+                    os.remove(filename)
+                    removed += 1
+            except OSError:
+                pass
+        return removed
+
+    def _filename(self, key):
+        return os.path.join(self.path, key)
+
+class CouchDBClaimStore(object):
+    """
+    keeps each blob as an attachment to a document counting
+    the messages that refer to it.  the document is deleted
+    when the count drops to zero.
+    """
+
+    ID_PREFIX = 'claim_check:'
+
+    def __init__(self, context, ttl=DEFAULT_TTL):
+        self.context = context
+        self.ttl = ttl
+
+    def put(self, data):
+        key = sha1(data).hexdigest()
+        docid = self._docid(key)
+        db = self.context.db
+        while True:
+            doc = db.get(docid)
+            if doc is None:
+                doc = {'_id': docid,
+                       'refs': 1,
+                       'expires': time.time() + self.ttl,
+                       '_attachments': {'data': {'content_type': 'application/octet-stream',
+                                                 'data': b64encode(data)}}}
+            else:
+                doc['refs'] = doc.get('refs', 0) + 1
+                doc['expires'] = time.time() + self.ttl
+            try:
+                db[docid] = doc
+                return key
+            except ResourceConflict:
+                pass
+
+    def get(self, key):
+        data = self.context.db.get_attachment(self._docid(key), 'data')
+        if hasattr(data, 'read'):
+            data = data.read()
+        return data
+
+    def release(self, key):
+        docid = self._docid(key)
+        db = self.context.db
+        while True:
+            doc = db.get(docid)
+            if doc is None:
+                return
+            try:
+                if doc.get('refs', 0) <= 1:
+                    db.delete(doc)
+                else:
+                    doc['refs'] -= 1
+                    db[docid] = doc
+                return
+            except ResourceConflict:
+                pass
+            except ResourceNotFound:
+                return
+
+    def reclaim(self):
+        now = time.time()
+        db = self.context.db
+        removed = 0
+        for r in db.view('_all_docs', startkey=self.ID_PREFIX, endkey=self.ID_PREFIX + u'\ufff0',
+                         include_docs=True):
+            if r.doc is not None and r.doc.get('expires', 0) < now:
+                try:
+                    db.delete(r.doc)
+                    removed += 1
+                except (ResourceConflict, ResourceNotFound):
+                    pass
+        return removed
+
+    def _docid(self, key):
+        return self.ID_PREFIX + key
+
+def _settings(context):
+    return context.config.get('messaging', {})
+
+def _threshold(context):
+    return int(_settings(context).get('claim_check_threshold', 0))
+
+def claim_store(context):
+    """
+    the configured claim check store, whether or not fields
+    are being checked in (see claim_check_threshold).  None 
+    if there is no store to use.
+    """
+    cfg = _settings(context)
+    ttl = int(cfg.get('claim_check_ttl', DEFAULT_TTL))
+    store_type = cfg.get('claim_check_store', 'couchdb')
+    if store_type == 'couchdb':
+        return CouchDBClaimStore(context, ttl=ttl)
+    elif store_type == 'filesystem':
+        path = cfg.get('claim_check_path')
+        if path is None:
+            if _threshold(context) <= 0:
+                return None
+            raise ValueError("claim_check_path must be set for the filesystem claim check store")
+        return FilesystemClaimStore(path, ttl=ttl)
+    else:
+        raise ValueError("unknown claim check store: %s" % store_type)
+
+def check_in(message, fields, context):
+    """
+    moves any of the fields given which are larger than
+    the claim check threshold into the claim check store.
+    modifies and returns the message given.
+    """
+    threshold = _threshold(context)
+    if threshold <= 0:
+        return message
+
+    store = claim_store(context)
+    for field in fields:
+        if not field in message:
+            continue
+        data = dumps(message[field])
+        if len(data) <= threshold:
+            continue
+        key = store.put(data)
+        message.setdefault(CLAIMS, {})[field] = key
+        del message[field]
+    return message
+
+def has_claimed(message, field):
+    """
+    True if the message has the field given,
+    whether or not it is claim checked.
+    """
+    return field in message or field in message.get(CLAIMS, {})
+
+def claimed(message, field, context, default=None):
+    """
+    returns the value of the field given, loading it from the
+    claim check store if needed.  the value is kept in the
+    message once it has been loaded.
+    """
+    if field in message:
+        return message[field]
+
+    key = message.get(CLAIMS, {}).get(field)
+    if key is None:
+        return default
+
+    store = claim_store(context)
+    data = None
+    if store is not None:
+        data = store.get(key)
+    if data is None:
+        raise ValueError("claim checked field %s (%s) is not available" % (field, key))
+
+    value = loads(data)
+    message[field] = value
+    return value
+
+def release_claims(message, context):
+    """
+    the message is done with, release any
+    claim checked fields it refers to.
+    """
+    claims = message.get(CLAIMS)
+    if not claims:
+        return
+    store = claim_store(context)
+    if store is None:
+        return
+    for key in claims.values():
+        try:
+            store.release(key)
+        except:
+            log.error("Error releasing claim check %s: %s" % (key, traceback.format_exc()))
+
+class ClaimCheckReclaimer(Component):
+    """
+    periodically removes claim checked blobs which
+    outlived claim_check_ttl.
+    """
+    implements(IWorkerProcess)
+
+    def run(self, context):
+        try:
+            while True:
+                with context:
+                    interval = int(_settings(context).get('claim_check_reclaim_interval',
+                                                          DEFAULT_RECLAIM_INTERVAL))
+                    try:
+                        store = claim_store(context)
+                        if store is not None:
+                            removed = store.reclaim()
+                            if removed > 0:
+                                log.info("Reclaimed %d expired claim checks" % removed)
+                    except GreenletExit:
+                        raise
+                    except:
+                        log.error("Error reclaiming claim checks: %s" % traceback.format_exc())
+                sleep(interval)
+        except GreenletExit:
+            pass
@@ -19,6 +19,7 @@ from melk.util.dibject import Dibject, dibjectify, json_wake
 from melk.util.typecheck import is_dicty, asbool
 
 from melkman.green import GreenAMQPBackend
+from melkman.httppool import HTTPPool
 
 log = logging.getLogger(__name__)
 
@@ -70,6 +71,12 @@ class Context(object):
         self._local = green_local()
         find_plugins_by_entry_point(MELKMAN_PLUGIN_ENTRY_POINT)
         self._broker = None
+        self._publisher_pool = None
+        self._confirmed_publisher = None
+        self._consumer_multiplexer = None
+        self._http_pool = None
+        self._bulk_writer = None
+        self._filter_chain_cache = None
 
     def __enter__(self):
         self._refcount += 1
@@ -117,6 +124,22 @@ class Context(object):
         """
         closes shared resources
         """
+        if self._consumer_multiplexer is not None:
+            old_mux = self._consumer_multiplexer
+            self._consumer_multiplexer = None
+            try:
+                old_mux.close()
+            except:
+                log.error("Error closing consumers: %s" % traceback.format_exc())
+
+        if self._publisher_pool is not None:
+            old_pool = self._publisher_pool
+            self._publisher_pool = None
+            try:
+                old_pool.close()
+            except:
+                log.error("Error closing publishers: %s" % traceback.format_exc())
+
         if self._broker is not None:
             old_broker = self._broker
             self._broker = None
@@ -125,6 +148,13 @@ class Context(object):
             except:
                 log.error("Error closing broker connection: %s" % traceback.format_exc())
 
+        if self._http_pool is not None:
+            old_pool = self._http_pool
+            self._http_pool = None
+            try:
+                old_pool.close()
+            except:
+                log.error("Error closing http pool: %s" % traceback.format_exc())
 
     @property
     def _locals_by_greenlet(self):
@@ -153,6 +183,25 @@ class Context(object):
                       (self.config.couchdb.database, self.db_server_address, traceback.format_exc()))
             raise
 
+    @property
+    def bulk_writer(self):
+        """
+        a BulkWriter shared by all greenlets using this context
+        """
+        if self._bulk_writer is None:
+            self._bulk_writer = self.create_bulk_writer()
+        return self._bulk_writer
+
+    def create_bulk_writer(self):
+        from melkman.db.bulk import BulkWriter
+        kargs = {}
+        cfg = self.config.couchdb
+        if 'bulk_max_docs' in cfg:
+            kargs['max_docs'] = int(cfg.bulk_max_docs)
+        if 'bulk_max_delay' in cfg:
+            kargs['max_delay'] = float(cfg.bulk_max_delay)
+        return BulkWriter(self, **kargs)
+
     @property
     def db_server_address(self):
         return 'http://%s:%d' % (self.config.couchdb.hostname, int(self.config.couchdb.port))
@@ -177,6 +226,97 @@ class Context(object):
         kargs['backend_cls'] = GreenAMQPBackend
         return BrokerConnection(**kargs)
 
+    @property
+    def publisher_pool(self):
+        """
+        a PublisherPool shared by all greenlets using this context
+        """
+        if self._publisher_pool is None:
+            self._publisher_pool = self.create_publisher_pool()
+        return self._publisher_pool
+
+    def create_publisher_pool(self):
+        from melkman.messaging import PublisherPool, message_encoder
+        kargs = {'encoder': message_encoder(self)}
+        cfg = self.config.get('messaging', {})
+        if 'max_idle_publishers' in cfg:
+            kargs['max_idle'] = int(cfg.max_idle_publishers)
+        return PublisherPool(**kargs)
+
+    @property
+    def consumer_multiplexer(self):
+        """
+        a ConsumerMultiplexer shared by all greenlets using this context
+        """
+        if self._consumer_multiplexer is None:
+            from melkman.messaging import ConsumerMultiplexer
+            self._consumer_multiplexer = ConsumerMultiplexer(self)
+        return self._consumer_multiplexer
+
+    @property
+    def confirmed_publisher(self):
+        """
+        a ConfirmedPublisher shared by all greenlets using this context
+        """
+        if self._confirmed_publisher is None:
+            self._confirmed_publisher = self.create_confirmed_publisher()
+        return self._confirmed_publisher
+
+    def create_confirmed_publisher(self):
+        from melkman.messaging import ConfirmedPublisher
+        kargs = {}
+        cfg = self.config.get('messaging', {})
+        if 'confirm_max_batch' in cfg:
+            kargs['max_batch'] = int(cfg.confirm_max_batch)
+        if 'confirm_max_delay' in cfg:
+            kargs['max_delay'] = float(cfg.confirm_max_delay)
+        if 'confirm_max_outstanding' in cfg:
+            kargs['max_outstanding'] = int(cfg.confirm_max_outstanding)
+        return ConfirmedPublisher(self, **kargs)
+
+
+    ######################
+    # HTTP
+    ######################
+    @property
+    def http_pool(self):
+        if self._http_pool is None:
+            self._http_pool = self.create_http_pool()
+        return self._http_pool
+
+    def create_http_pool(self):
+        cfg = self.config.get('http', {})
+        kargs = {}
+        if 'cache' in cfg:
+            kargs['cache'] = cfg.cache
+        if 'max_connections_per_host' in cfg:
+            kargs['max_per_host'] = int(cfg.max_connections_per_host)
+        if 'max_idle_time' in cfg:
+            kargs['max_idle'] = int(cfg.max_idle_time)
+        return HTTPPool(**kargs)
+
+    ##################################
+    # Filters
+    ##################################
+    @property
+    def filter_chain_cache(self):
+        """
+        a FilterChainCache shared by all greenlets using this 
+        context, or None if chain caching is turned off.
+        """
+        if self._filter_chain_cache is None:
+            self._filter_chain_cache = self.create_filter_chain_cache()
+        return self._filter_chain_cache
+
+    def create_filter_chain_cache(self):
+        from melkman.filters import FilterChainCache
+        from melkman.filters import DEFAULT_CHAIN_CACHE_SIZE, DEFAULT_CHAIN_CACHE_MAX_BYTES
+        cfg = self.config.get('filters', {})
+        max_chains = int(cfg.get('chain_cache_size', DEFAULT_CHAIN_CACHE_SIZE))
+        max_size = int(cfg.get('chain_cache_max_bytes', DEFAULT_CHAIN_CACHE_MAX_BYTES))
+        if max_chains > 0 and max_size > 0:
+            return FilterChainCache(max_chains, max_size)
+        return None
 
     ##################################
     # Components
@@ -31,7 +31,7 @@ import logging
 log = logging.getLogger(__name__)
 
 __all__ = ['NewsItem', 'NewsBucket',
-           'immediate_add',
+           'immediate_add', 'prefetch_full_items',
            'view_entries',
            'view_entries_by_timestamp',
            'view_entries_by_add_time']
@@ -52,6 +52,7 @@ class NewsItem(DocumentHelper):
     source_title = TextField()
     source_url = TextField()
     summary = TextField()
+    fingerprint = TextField()
 
     details = DibjectField()
 
@@ -78,14 +79,45 @@ class NewsItemRef(DocumentHelper):
     source_title = TextField()
     source_url = TextField()
     summary = TextField()
+    fingerprint = TextField()
+
+    def __init__(self, *args, **kw):
+        DocumentHelper.__init__(self, *args, **kw)
+        self._full_item = None
+        self._full_item_loaded = False
     
     def load_full_item(self):
-        return NewsItem.lookup_by_id(self.item_id, self._context)
+        """
+        returns the NewsItem this refers to or None if it 
+        cannot be found.  the item is only loaded once.
+        """
+        if not self._full_item_loaded:
+            self._set_full_item(NewsItem.get(self.item_id, self._context))
+        return self._full_item
+
+    def _set_full_item(self, item):
+        self._full_item = item
+        self._full_item_loaded = True
 
     def update_from(self, other_item):
         for field in _REPLICATE_FIELDS:
             val = getattr(other_item, field)
             setattr(self, field, val)
+        self.fingerprint = getattr(other_item, 'fingerprint', None)
+
+    def supersedes(self, other_item):
+        """
+        True if this item is a newer version of the other item given: 
+        either its timestamp is later, or the timestamps are equal 
+        and the content fingerprint has changed.
+        """
+        if self.timestamp is None:
+            return False
+        if self.timestamp > other_item.timestamp:
+            return True
+        return (self.timestamp == other_item.timestamp and 
+                self.fingerprint is not None and
+                self.fingerprint != other_item.fingerprint)
 
     @classmethod
     def create_from_info(cls, context, bucket_id, **kw):
@@ -105,6 +137,7 @@ class NewsItemRef(DocumentHelper):
         
         for field in _REPLICATE_FIELDS:
             instance[field] = item[field]
+        instance['fingerprint'] = item.get('fingerprint', None)
 
         return instance
 
@@ -137,6 +170,8 @@ class NewsBucket(DocumentHelper):
         
         DocumentHelper.__init__(self, *args, **kw)
         self._entries = None # lazy load
+        self._partial_entries = False
+        self._checked_ids = set()
         self._removed = {}
         self._updated = {}
 
@@ -159,12 +194,20 @@ class NewsBucket(DocumentHelper):
         return super(NewsBucket, cls).create(context, *args, **kw)
 
     def _lazy_load_entries(self, force=False):
-        if force or self._entries is None:
+        if force or self._entries is None or self._partial_entries:
+            # unsaved changes to partially loaded entries 
+            # are carried over to the full set.
+            pending = []
+            if self._partial_entries and not force:
+                pending = self._updated.values()
+
             self._entries = nldict(self.maxlen, SORTKEY)
             self._entries.observers.append(self)
+            self._partial_entries = False
+            self._checked_ids = set()
             
             # saved in db
-            if not (self.id is None or self.rev is None):
+            if not self._is_unsaved():
                 query = {
                     'startkey': self.id,
                     'endkey': self.id + '0',
@@ -174,6 +217,55 @@ class NewsBucket(DocumentHelper):
                     ref = NewsItemRef.from_doc(r.doc, self._context)
                     self._entries[ref.item_id] = ref
 
+            for ref in pending:
+                self._entries[ref.item_id] = ref
+
+    def _load_entries_for(self, item_ids):
+        """
+        if all entries have not been loaded, loads only the 
+        entries for the item ids given using their ref ids.
+        """
+        if self._is_unsaved() or (self._entries is not None and not self._partial_entries):
+            self._lazy_load_entries()
+            return
+
+        if self._entries is None:
+            # no maxlen here, trimming is done 
+            # incrementally when saved.
+            self._entries = nldict(None, SORTKEY)
+            self._entries.observers.append(self)
+            self._partial_entries = True
+
+        ref_ids = [NewsItemRef.dbid(self.id, iid) for iid in item_ids 
+                   if not iid in self._checked_ids]
+        self._checked_ids.update(item_ids)
+        if len(ref_ids) == 0:
+            return
+
+        for r in self._context.db.view('_all_docs', keys=ref_ids, include_docs=True):
+            if r.get('doc') is not None:
+                ref = NewsItemRef.from_doc(r.doc, self._context)
+                self._entries[ref.item_id] = ref
+
+    def lookup_entries(self, item_ids):
+        """
+        returns a dictionary mapping the item ids given to 
+        entries in this bucket for those that are present.  
+        
+        unlike accessing 'entries', this does not require 
+        loading every entry in the bucket.
+        """
+        self._load_entries_for(item_ids)
+        found = {}
+        for iid in item_ids:
+            ref = self._entries.get(iid)
+            if ref is not None:
+                found[iid] = ref
+        return found
+
+    def _is_unsaved(self):
+        return self.id is None or self.rev is None
+
     @property
     def entries(self):
         self._lazy_load_entries()
@@ -194,7 +286,6 @@ class NewsBucket(DocumentHelper):
         self._removed_item(val)
 
     def add_news_item(self, item):
-        self._lazy_load_entries()
         if isinstance(item, basestring):
             item = NewsItemRef.create_from_info(self._context, self.id, item_id=item)
         elif isinstance(item, NewsItem) or isinstance(item, NewsItemRef):
@@ -202,13 +293,18 @@ class NewsBucket(DocumentHelper):
         else:
             item = NewsItemRef.create_from_info(self._context, self.id, **item)
 
+        if self._partial_entries:
+            self._load_entries_for([item.item_id])
+        else:
+            self._lazy_load_entries()
+
         # if this item has already been added,
-        # only consider it an update if the 
-        # timestamp is strictly greater than the 
-        # timestamp we already have for it.
+        # only consider it an update if it
+        # supersedes the version we already have
+        # for it.
         if item.item_id in self._entries:
             current_item = self._entries[item.item_id]
-            if item.timestamp is None or item.timestamp <= current_item.timestamp:
+            if not item.supersedes(current_item):
                 return False
             current_item.update_from(item)
             self._updated_item(current_item)
@@ -266,6 +362,8 @@ class NewsBucket(DocumentHelper):
         self._updated = {}
         self._removed = {}
         self._entries = None
+        self._partial_entries = False
+        self._checked_ids = set()
 
     def save(self):
         self.last_modification_date = datetime.utcnow()
@@ -280,7 +378,7 @@ class NewsBucket(DocumentHelper):
         for item in try_delete:
             updates.append({'_id': item.id, '_rev': item.rev, '_deleted': True})
         
-        results = self._context.db.update(updates)
+        results = self._write_docs(updates)
 
         (main_doc_saved, main_doc_id, main_doc_result) = results.pop(0)
         if main_doc_saved:
@@ -304,6 +402,14 @@ class NewsBucket(DocumentHelper):
                 successful_deletes.append(item)
             else:
                 conflicts = True
+
+        if self._partial_entries and self.maxlen:
+            trimmed = self._trim_saved_entries()
+            # an entry saved and trimmed right away is only removed
+            trimmed_ids = set([x.item_id for x in trimmed])
+            successful_updates = [x for x in successful_updates 
+                                  if not x.item_id in trimmed_ids]
+            successful_deletes += trimmed
         
         kw = {}
         if successful_updates:
@@ -317,11 +423,47 @@ class NewsBucket(DocumentHelper):
         if conflicts:
             # require reload
             self._entries = None
+            self._partial_entries = False
+            self._checked_ids = set()
 
         if not main_doc_saved:
             raise main_doc_result
 
 
+    def _trim_saved_entries(self):
+        """
+        deletes the oldest saved entries beyond maxlen.  used 
+        in place of trimming in memory when the entries are 
+        only partially loaded.  returns the removed entries.
+        """
+        query = {
+            'startkey': [self.id, {}],
+            'endkey': [self.id],
+            'descending': True,
+            'skip': self.maxlen,
+            'include_docs': True,
+        }
+        trims = [NewsItemRef.from_doc(r.doc, self._context) for r in 
+                 view_entries_by_timestamp(self._context.db, **query)]
+        if len(trims) == 0:
+            return []
+
+        dels = [{'_id': ref.id, '_rev': ref.rev, '_deleted': True} for ref in trims]
+        removed = []
+        for ref, (deleted, ref_id, info) in zip(trims, self._context.db.update(dels)):
+            if deleted:
+                removed.append(ref)
+                if ref.item_id in self._entries:
+                    del self._entries[ref.item_id]
+        return removed
+
+    def _write_docs(self, docs):
+        """
+        writes the documents given as part of a save, returning
+        results in the form given by couchdb.Database.update
+        """
+        return self._context.db.update(docs)
+
     def _send_modified_event(self, *args, **kw):
         notify_bucket_modified(self, self._context, **kw)
 
@@ -365,6 +507,26 @@ class NewsBucket(DocumentHelper):
         self._context.db.update(dels)
 
 
+def prefetch_full_items(items, context):
+    """
+    loads the full NewsItems for any NewsItemRefs given in 
+    a single request.  load_full_item on these refs will 
+    then return the prefetched items without further requests.
+    """
+    refs = [x for x in items if isinstance(x, NewsItemRef) and 
+            not x._full_item_loaded]
+    if len(refs) == 0:
+        return
+
+    item_ids = list(set([ref.item_id for ref in refs]))
+    full_items = {}
+    for r in context.db.view('_all_docs', keys=item_ids, include_docs=True):
+        if r.get('doc') is not None:
+            full_items[r.key] = NewsItem.from_doc(r.doc, context)
+
+    for ref in refs:
+        ref._set_full_item(full_items.get(ref.item_id, None))
+
 def immediate_add(bucket, item, context, notify=True):
     """
     immediately commit the addition of an item to the 
@@ -386,7 +548,7 @@ def immediate_add(bucket, item, context, notify=True):
     current_item = NewsItemRef.get(item.id, context)
     if current_item is None:
         current_item = item
-    elif item.timestamp is None or item.timestamp <= current_item.timestamp:
+    elif not item.supersedes(current_item):
         return False
     else:
         current_item.update_from(item)
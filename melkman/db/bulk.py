@@ -0,0 +1,184 @@
+# Copyright (C) 2009 The Open Planning Project
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the
+# Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor,
+# Boston, MA  02110-1301
+# USA
+
+from __future__ import with_statement
+from couchdb import ResourceConflict
+from eventlet import spawn, with_timeout, TimeoutError
+from eventlet.event import Event
+import logging
+import sys
+import traceback
+
+log = logging.getLogger(__name__)
+
+__all__ = ['BulkWriter']
+
+DEFAULT_MAX_DOCS = 500
+DEFAULT_MAX_DELAY = 0.05
+
+class PendingWrite(object):
+    """
+    a set of documents submitted to a BulkWriter,
+    see BulkWriter.submit
+    """
+    def __init__(self, docs, resolve_conflicts):
+        self.docs = docs
+        self.resolve_conflicts = resolve_conflicts
+        self._done = Event()
+        self._results = None
+        self._error = None
+
+    def wait(self):
+        """
+        wait for the documents to be written. returns a list
+        of (success, docid, rev_or_exc) in the same order as the
+        documents were given, like couchdb.Database.update.
+        """
+        self._done.wait()
+        if self._error is not None:
+            raise self._error[0], self._error[1], self._error[2]
+        return self._results
+
+    def _finish(self, results):
+        self._results = results
+        self._done.send(True)
+
+    def _fail(self, exc_info):
+        self._error = exc_info
+        self._done.send(True)
+
+
+class BulkWriter(object):
+    """
+    Collects document writes from many greenlets into
+    shared _bulk_docs requests.  A batch is written once
+    max_docs documents are waiting or max_delay seconds
+    after the first document arrived, whichever comes first.
+
+    eg:
+
+    results = context.bulk_writer.update(docs)
+    """
+
+    def __init__(self, context, max_docs=DEFAULT_MAX_DOCS, max_delay=DEFAULT_MAX_DELAY):
+        self.context = context
+        self.max_docs = max_docs
+        self.max_delay = max_delay
+        self._pending = []
+        self._pending_docs = 0
+        self._wakeup = None
+        self._flusher = None
+
+    def update(self, docs, resolve_conflicts=False):
+        """
+        write the documents given in the next batch and
+        wait for the results, see submit.
+        """
+        return self.submit(docs, resolve_conflicts=resolve_conflicts).wait()
+
+    def submit(self, docs, resolve_conflicts=False):
+        """
+        queue the documents given to be written in the next
+        batch. returns a PendingWrite which may be waited on
+        for the results.
+
+        if resolve_conflicts is True, documents which conflict
+        are written again over the latest revision in the
+        database.
+        """
+        write = PendingWrite(list(docs), resolve_conflicts)
+        if len(write.docs) == 0:
+            write._finish([])
+            return write
+
+        self._pending.append(write)
+        self._pending_docs += len(write.docs)
+
+        if self._flusher is None:
+            self._wakeup = Event()
+            self._flusher = spawn(self._run_flush, self._wakeup)
+        if self._pending_docs >= self.max_docs and not self._wakeup.ready():
+            self._wakeup.send(True)
+
+        return write
+
+    def _run_flush(self, wakeup):
+        try:
+            with_timeout(self.max_delay, wakeup.wait)
+        except TimeoutError:
+            pass
+
+        batch = self._pending
+        self._pending = []
+        self._pending_docs = 0
+        self._flusher = None
+
+        with self.context:
+            try:
+                self._write_batch(batch)
+            except:
+                log.error("Error writing batch of %d documents: %s" %
+                          (sum([len(w.docs) for w in batch]), traceback.format_exc()))
+                exc_info = sys.exc_info()
+                for write in batch:
+                    write._fail(exc_info)
+
+    def _write_batch(self, batch):
+        docs = []
+        resolve = []
+        for write in batch:
+            docs += write.docs
+            resolve += [write.resolve_conflicts] * len(write.docs)
+
+        results = []
+        for start in range(0, len(docs), self.max_docs):
+            chunk = docs[start:start + self.max_docs]
+            results += self.context.db.update(chunk)
+
+        # retry conflicting documents that asked for it
+        # over the latest revisions in one request
+        retry = [i for i, (ok, docid, info) in enumerate(results)
+                 if not ok and resolve[i] and isinstance(info, ResourceConflict)]
+        if retry:
+            self._resolve_conflicts(docs, results, retry)
+
+        log.debug("wrote batch of %d documents (%d conflicts retried)" % (len(docs), len(retry)))
+
+        offset = 0
+        for write in batch:
+            write._finish(results[offset:offset + len(write.docs)])
+            offset += len(write.docs)
+
+    def _resolve_conflicts(self, docs, results, retry):
+        ids = [results[i][1] for i in retry]
+        latest = {}
+        for r in self.context.db.view('_all_docs', keys=ids):
+            if 'value' in r and r.value is not None and not r.value.get('deleted', False):
+                latest[r.key] = r.value['rev']
+
+        retry_docs = []
+        for i in retry:
+            doc = docs[i]
+            rev = latest.get(results[i][1])
+            if rev is not None:
+                doc['_rev'] = rev
+            retry_docs.append(doc)
+
+        for i, result in zip(retry, self.context.db.update(retry_docs)):
+            results[i] = result
@@ -2,9 +2,11 @@ from couchdb.design import ViewDefinition
 from couchdb.schema import *
 from datetime import datetime, timedelta
 import logging
+import time
 
 from melkman.aggregator.api import notify_bucket_modified
 from melkman.db.bucket import NewsBucket, NewsItemRef, view_entries_by_timestamp
+from melkman.db.bucket import prefetch_full_items
 from melkman.db.util import DocumentHelper, DibjectField, MappingField
 
 
@@ -25,6 +27,19 @@ class Subscription(Schema):
     title = TextField()
     url = TextField()
 
+class BackfillProgress(Schema):
+    """
+    how far the initial items for a subscription have 
+    been read, see Composite.backfill_subscription
+    """
+    timestamp = TextField()
+    docid = TextField()
+    count = IntegerField(default=0)
+
+DEFAULT_BACKFILL_DEPTH = 50
+DEFAULT_BACKFILL_WINDOW = timedelta(days=1)
+DEFAULT_BACKFILL_PAGE_SIZE = 50
+
 class Composite(NewsBucket):
 
     document_types = ListField(TextField(), default=['NewsBucket', 'Composite'])
@@ -34,6 +49,9 @@ class Composite(NewsBucket):
     
     rejected_ref = TextField(default=None)
 
+    # subscriptions whose initial items are partially read
+    backfill_progress = MappingField(DictField(BackfillProgress))
+
     def __init__(self, *args, **kw):
         NewsBucket.__init__(self, *args, **kw)
         self._rejected = None
@@ -65,27 +83,95 @@ class Composite(NewsBucket):
         except KeyError:
             pass
 
-    def init_subscription(self, bucket_id):
+    def init_subscription(self, bucket_id, depth=DEFAULT_BACKFILL_DEPTH, 
+                          window=DEFAULT_BACKFILL_WINDOW,
+                          page_size=DEFAULT_BACKFILL_PAGE_SIZE):
+        """
+        add up to depth of the most recent items from the 
+        subscription given that are newer than window ago.
+        returns the number of items added.
+        """
+        done, updates = self.backfill_subscription(bucket_id, depth=depth, 
+                                                   window=window, page_size=page_size)
+        return updates
+
+    def backfill_subscription(self, bucket_id, depth=DEFAULT_BACKFILL_DEPTH, 
+                              window=DEFAULT_BACKFILL_WINDOW,
+                              page_size=DEFAULT_BACKFILL_PAGE_SIZE,
+                              deadline=None):
+        """
+        add the most recent items from the subscription given, 
+        reading page_size items at a time.  if deadline (a time.time()) 
+        passes before depth items have been read, progress is recorded 
+        in backfill_progress and a later call picks up where this one 
+        stopped.  
+
+        returns (done, number of items added) 
+        """
+        done, items = self.read_backfill(bucket_id, depth=depth, window=window,
+                                         page_size=page_size, deadline=deadline)
+        updates = 0
+        if len(items) > 0:
+            updates = self.filtered_update(items)
+        return done, updates
+
+    def read_backfill(self, bucket_id, depth=DEFAULT_BACKFILL_DEPTH, 
+                      window=DEFAULT_BACKFILL_WINDOW,
+                      page_size=DEFAULT_BACKFILL_PAGE_SIZE,
+                      deadline=None):
+        """
+        reads the items backfill_subscription would add without 
+        adding them.  the progress recorded assumes that the items 
+        will be given to filtered_update before the composite is saved.
+
+        returns (done, list of NewsItemRefs)
+        """
         sub_info = self.subscriptions.get(bucket_id, None)
-        
         if sub_info is None:
-            return 0 # not subscribed.
-        
-        stop_date = datetime.utcnow() - timedelta(days=1)
-        query = {
-            'startkey': [bucket_id, {}],
-            'endkey': [bucket_id, DateTimeField()._to_json(stop_date)],
-            'limit': 50,
-            'descending': True,
-            'include_docs': True,
-        }
-        initial_items = [NewsItemRef.from_doc(r.doc, self._context) for r in 
-                         view_entries_by_timestamp(self._context.db, **query)]
+            self._backfill_done(bucket_id)
+            return True, [] # not subscribed.
 
-        if len(initial_items) > 0:
-            return self.filtered_update(initial_items)
-        else:
-            return 0
+        stop_date = datetime.utcnow() - window
+        progress = self.backfill_progress.get(bucket_id, None)
+        count = 0
+        if progress is not None:
+            count = progress.count
+
+        items = []
+        while count < depth:
+            query = {
+                'endkey': [bucket_id, DateTimeField()._to_json(stop_date)],
+                'limit': min(page_size, depth - count),
+                'descending': True,
+                'include_docs': True,
+            }
+            if progress is not None:
+                query['startkey'] = [bucket_id, progress.timestamp]
+                query['startkey_docid'] = progress.docid
+                query['skip'] = 1
+            else:
+                query['startkey'] = [bucket_id, {}]
+            
+            rows = list(view_entries_by_timestamp(self._context.db, **query))
+            items += [NewsItemRef.from_doc(r.doc, self._context) for r in rows]
+            count += len(rows)
+            
+            if len(rows) < query['limit'] or count >= depth:
+                break
+
+            self.backfill_progress[bucket_id] = {'timestamp': rows[-1].key[1],
+                                                 'docid': rows[-1].id,
+                                                 'count': count}
+            progress = self.backfill_progress[bucket_id]
+            if deadline is not None and time.time() >= deadline:
+                return False, items
+
+        self._backfill_done(bucket_id)
+        return True, items
+
+    def _backfill_done(self, bucket_id):
+        if bucket_id in self.backfill_progress:
+            del self.backfill_progress[bucket_id]
 
     def filtered_update(self, news_items):
         return _filtered_update(self, news_items, self._context)
@@ -172,12 +258,17 @@ def bootstrap(db):
 def _filtered_update(composite, news_items, ctx):
     from melkman.filters import NewsItemFilterFactory, ACCEPT_ITEM, REJECT_ITEM
     filter_factory = NewsItemFilterFactory(ctx.component_manager)
-    filt = filter_factory.create_chain(composite.filters)
+    filt = filter_factory.cached_chain(composite.id, composite.filters)
+    news_items = list(news_items)
+
+    # load any full items the filters need up front 
+    # rather than one at a time.
+    if filt.needs_full_item:
+        prefetch_full_items(news_items, ctx)
 
     accepts = []
     rejects = []
-    for item in news_items:
-        result = filt(item)
+    for item, result in zip(news_items, filt.evaluate_batch(news_items)):
         if result == ACCEPT_ITEM:
             accepts.append(item)
         else:
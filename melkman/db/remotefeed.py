@@ -22,7 +22,7 @@ from couchdb.design import ViewDefinition
 from couchdb.schema import *
 from copy import deepcopy
 from datetime import datetime, timedelta
-
+from hashlib import md5
 from httplib2 import Http
 import logging
 
@@ -30,7 +30,7 @@ from melk.util.dibject import dibjectify
 from melk.util.hash import melk_id
 from melk.util.urlnorm import canonical_url
 
-from melkman.parse import parse_feed, item_trace, find_best_timestamp, InvalidFeedError
+from melkman.parse import parse_feed_streaming, InvalidFeedError
 from melkman.db.bucket import NewsBucket, NewsItem, NewsItemRef
 from melkman.db.util import DibjectField, MappingField
 
@@ -56,8 +56,17 @@ class HubInfo(Schema):
     next_sub_time = DateTimeField()
     enabled = BooleanField(default=True) # pubsub enabled for this feed
 
+class FetchInfo(Schema):
+    """
+    validators from the last successful fetch of 
+    a RemoteFeed, used to make conditional requests.
+    """
+    etag = TextField()
+    last_modified = TextField()
+    content_hash = TextField()
 
 MAX_HISTORY = 10
+FIND_UPDATES_BATCH_SIZE = 100
 class RemoteFeed(NewsBucket):
     """
     This class is a NewsBucket that represents a remote
@@ -89,6 +98,9 @@ class RemoteFeed(NewsBucket):
 
     # current pubsubhubbub info
     hub_info = DictField(HubInfo)
+
+    # validators for conditional fetches
+    fetch_info = DictField(FetchInfo)
     
     update_history = ListField(DictField(schema=HistoryItem))
 
@@ -101,25 +113,62 @@ class RemoteFeed(NewsBucket):
     def update_from_feed(self, content, method):
         """
         updates this feed from the unparsed feed content given. 
+        
+        if the content is identical to the content last 
+        successfully indexed, parsing is skipped entirely.
         """
+        content_hash = _content_hash(content)
+        if content_hash == self.fetch_info.content_hash:
+            self.record_update_info(success=True, updates=0, method=method)
+            return 0
+
         updated = _update_feed(self, content, self._context, method)
         self._updated_news_items.update(updated)
+        if self.update_history[0].success:
+            self.fetch_info.content_hash = content_hash
         return len(updated)
 
+    def conditional_headers(self):
+        """
+        request headers that allow the server to answer 
+        304 Not Modified if the feed has not changed since
+        the last successful fetch.
+        """
+        headers = {}
+        if self.fetch_info.etag:
+            headers['if-none-match'] = self.fetch_info.etag
+        if self.fetch_info.last_modified:
+            headers['if-modified-since'] = self.fetch_info.last_modified
+        return headers
+
+    def record_validators(self, response):
+        """
+        remember the validators given in the (successful) 
+        http response for use in the next conditional fetch.
+        """
+        self.fetch_info.etag = response.get('etag', None)
+        self.fetch_info.last_modified = response.get('last-modified', None)
+
     def reload(self):
         NewsBucket.reload(self)
         self._updated_news_items = {}
 
-    def save(self):
-        try:
-            NewsBucket.save(self)
-        except ResourceConflict:
-            raise
-        finally:
-            # just best effort here, we assume conflicts indicate better
-            # information arrived...
-            self._context.db.update(self._updated_news_items.values())
-            self._updated_news_items = {}
+    def _write_docs(self, docs):
+        # the feed, its refs and the updated news items are written 
+        # together in a shared batch.  news items are written over 
+        # any conflicting revision, the feed and refs are not.
+        news_items = self._updated_news_items.values()
+        self._updated_news_items = {}
+
+        writer = self._context.bulk_writer
+        bucket_write = writer.submit(docs)
+        items_write = writer.submit(news_items, resolve_conflicts=True)
+
+        results = bucket_write.wait()
+        for (saved, item_id, info) in items_write.wait():
+            if not saved:
+                log.warn("Unable to save news item %s: %s" % (item_id, info))
+        return results
 
     def find_hub_urls(self):
         hub_urls = []
@@ -190,26 +239,53 @@ def bootstrap(db):
     view_remote_feeds_by_next_poll_time.sync(db)
 
 
-def _find_updates(db_feed, parsed_feed):
+def _content_hash(content):
+    if isinstance(content, unicode):
+        content = content.encode('utf-8')
+    return md5(content).hexdigest()
+
+def _find_updates(db_feed, entries):
     """
     db_feed - RemoteFeed to check
-    parsed_feed - current parse of the feed
+    entries - iterable of StreamedEntry from the current parse of the feed
 
-    return a list of new/updated items items according 
+    return a list of new/updated entries according 
     to the RemoteFeed given and the parse.
     """
 
-    # locate any new or updated items
+    # locate any new or updated items. entries are checked in
+    # batches against only the matching refs in the feed.
+    updated_items = []
+    batch = []
+    for e in entries:
+        batch.append(e)
+        if len(batch) >= FIND_UPDATES_BATCH_SIZE:
+            updated_items += _find_updates_in_batch(db_feed, batch)
+            batch = []
+    if batch:
+        updated_items += _find_updates_in_batch(db_feed, batch)
+
+    return updated_items
+
+def _find_updates_in_batch(db_feed, entries):
+    existing = db_feed.lookup_entries([e.melk_id for e in entries])
+
     updated_items = []
-    for e in parsed_feed.entries:
-        existing_item = db_feed.entries.get(e.melk_id)
+    for e in entries:
+        existing_item = existing.get(e.melk_id)
         if existing_item is None:
             updated_items.append(e)
+        elif existing_item.fingerprint is not None:
+            # the fingerprint covers the timestamp and content, 
+            # so any difference is an update unless the entry 
+            # has moved back in time.
+            if e.fingerprint != existing_item.fingerprint and \
+               (e.timestamp is None or e.timestamp >= existing_item.timestamp):
+                updated_items.append(e)
         else:
             # if there is a timestamp specified, we compare.
             # if none was specified, we assume it was not updated.
-            item_timestamp = find_best_timestamp(e)
-            if item_timestamp is not None and item_timestamp > existing_item.timestamp:
+            if e.timestamp is not None and e.timestamp > existing_item.timestamp:
                 updated_items.append(e)
 
     return updated_items
@@ -224,7 +300,7 @@ def _update_feed(feed, content, context, method):
     """
         
     try:
-        fp = parse_feed(content, feed.url)
+        fp = parse_feed_streaming(content, feed.url)
     except:
         feed.record_update_info(success=False, updates=0,
                             reason='Feed could not be parsed',
@@ -233,42 +309,32 @@ def _update_feed(feed, content, context, method):
         log.error("unable to parse feed %s: %s" % (feed.url, traceback.format_exc()))
         return []
 
-    updated_items = _find_updates(feed, fp)
-
     # update feed metadata
-    feed.feed_info = deepcopy(fp.feed)
+    feed.feed_info = fp.feed
     feed.title = fp.feed.get('title', '')
+
+    # entries are examined one at a time, only 
+    # new or updated entries are retained.
+    updated_items = _find_updates(feed, fp.iter_entries())
     
     # add item to RemoteFeed, gather ids
-    iids = []
     traces = {}
     for item in updated_items:
-        trace = item_trace(item)
+        trace = item.trace
         traces[item.melk_id] = trace
         ref = {'item_id': item.melk_id}
         ref.update(trace)
         feed.add_news_item(ref)
     feed.record_update_info(success=True, updates=len(updated_items), method=method)
 
-    # grab any existing entries (need revisions to push update)...
+    # every field of a NewsItem is replaced on update, so existing
+    # items are not loaded; the bulk writer writes over the latest
+    # revision of any that already exist when the feed is saved.
     save_items = {}
-    for r in context.db.view('_all_docs', keys=traces.keys(), include_docs=True).rows:
-        if 'doc' in r:
-            save_items[r.key] = NewsItem.wrap(r.doc)
-
     for item in updated_items:
         iid = item.melk_id
-        trace = traces[iid]
-        
-        news_item = save_items.get(iid, None)
-        if news_item is None:
-            # if it is a new entry, create it
-            news_item = NewsItem(iid, **trace)
-            save_items[item.melk_id] = news_item
-        else:
-            # otherwise, just update fields
-            for k, v in trace.items():
-                setattr(news_item, k, v)
-        news_item.details = item
+        news_item = NewsItem(iid, **traces[iid])
+        news_item.details = item.details
+        save_items[iid] = news_item
 
     return save_items
@@ -23,6 +23,7 @@ import logging
 import traceback
 
 from giblets import Component, ExtensionInterface, implements
+from melkman.claimcheck import check_in
 from melkman.context import IRunDuringBootstrap
 from melkman.messaging import MessageDispatch
 from melkman.scheduler import defer_message
@@ -68,6 +69,7 @@ def push_feed_index(url, content, context, **kw):
         'content': content
     }
     message.update(kw)
+    check_in(message, ['content'], context)
 
     publisher = MessageDispatch(context)
     publisher.send(message, INDEX_FEED_COMMAND)
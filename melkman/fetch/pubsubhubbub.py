@@ -5,7 +5,6 @@ from eventlet.green import socket
 from eventlet.wsgi import server as wsgi_server
 from eventlet.support.greenlets import GreenletExit
 import hmac
-from httplib2 import Http
 import traceback
 from urllib import quote_plus, unquote_plus, urlencode
 from urlparse import urljoin
@@ -96,7 +95,7 @@ def hubbub_sub(feed, context, hub_url=None):
     ]
     body = urlencode(req)
     headers = {'content-type': 'application/x-www-form-urlencoded'}
-    return Http().request(feed.hub_info.hub_url, method="POST", body=body, headers=headers)
+    return context.http_pool.request(feed.hub_info.hub_url, method="POST", body=body, headers=headers)
 
 def hubbub_unsub(feed, context):
     """
@@ -128,7 +127,7 @@ def hubbub_unsub(feed, context):
     ]
     body = urlencode(req)
     headers = {'content-type': 'application/x-www-form-urlencoded'}
-    return Http().request(feed.hub_info.hub_url, method="POST", body=body, headers=headers)
+    return context.http_pool.request(feed.hub_info.hub_url, method="POST", body=body, headers=headers)
 
 
 class WSGISubClient(object):
@@ -1,21 +1,24 @@
 from __future__ import with_statement
 from datetime import datetime, timedelta
 from giblets import Component, ExtensionPoint, implements
-from eventlet import spawn
+from eventlet import sleep, spawn
 from eventlet.support.greenlets import GreenletExit
-from httplib2 import Http
 import logging
+import time
 import traceback
+from urlparse import urlparse
 
+from melkman.claimcheck import claimed, has_claimed, release_claims
 from melkman.db import RemoteFeed
 from melkman.fetch.api import INDEX_FEED_COMMAND
 from melkman.fetch.api import schedule_feed_index
 from melkman.fetch.api import PostIndexAction, IndexRequestFilter
 from melkman.green import Pool
 from melkman.messaging import MessageDispatch, always_ack, pooled
-from melkman.worker import IWorkerProcess
+from melkman.scheduler import defer_message
+from melkman.worker import IWorkerProcess, pool_settings
 
-__all__ = ['run_feed_indexer', 'index_feed_polling']
+__all__ = ['run_feed_indexer', 'index_feed_polling', 'HostThrottle']
 
 log = logging.getLogger(__name__)
 
@@ -96,15 +99,15 @@ def index_feed_polling(url, context, timeout=15, request_info=None):
         return
 
     reschedule = not request_info.get('skip_reschedule', False)
-    http_cache = context.config.get('http', {}).get('cache', None)
 
-    # fetch
-    http = Http(cache=http_cache, timeout=timeout)
-    http.force_exception_to_status_code = True
-    response, content = http.request(url, 'GET')
+    # fetch, conditionally if we have seen this feed before
+    response, content = context.http_pool.request(url, 'GET',
+                            headers=feed.conditional_headers(),
+                            timeout=timeout,
+                            force_exception_to_status_code=True)
 
     updated_docs = []
-    if response.fromcache:
+    if response.fromcache or response.status == 304:
         feed.record_update_info(success=True, updates=0, method=METHOD_POLL)
     elif response.status != 200:
         feed.record_update_info(success=False, updates=0, 
@@ -112,6 +115,8 @@ def index_feed_polling(url, context, timeout=15, request_info=None):
     else:
         # 200 status code, not from cache, do update...
         feed.update_from_feed(content, method=METHOD_POLL)
+        if feed.update_history[0].success:
+            feed.record_validators(response)
 
     # compute the next time to check...
     next_interval = compute_next_fetch_interval(feed.update_history)
@@ -179,11 +184,170 @@ def compute_next_fetch_interval_aimd(update_history):
     return new_interval
 
 
+#####################
+# Host politeness
+#####################
+
+DEFAULT_MAX_PER_HOST = 2
+DEFAULT_MIN_HOST_INTERVAL = 1.0
+DEFAULT_HOST_DEFER_DELAY = timedelta(minutes=2)
+DEFAULT_HOST_STATS_INTERVAL = 300
+
+class _HostState(object):
+    def __init__(self):
+        self.next_start = 0
+        self.next_retry = 0
+        self.active = 0
+        self.admitted = 0
+        self.deferred = 0
+        # polls put off and not yet back
+        self.waiting = 0
+        self.total_delay = 0.0
+        self.max_delay = 0.0
+        self.returned = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+class HostThrottle(object):
+    """
+    Admission control for polling fetches.  At most max_concurrent 
+    fetches of a single host are in flight at once and successive 
+    fetches of a host start at least min_interval seconds apart.  
+    Fetches of other hosts are unaffected.
+    
+    Admission never waits, a fetch that may not start yet should
+    be deferred (see defer_delay) so that it does not hold a worker 
+    slot that fetches of other hosts could use.  When a deferred 
+    fetch comes back, returned should be called so that the number
+    of fetches waiting and the time they waited are counted.
+    """
+
+    def __init__(self, max_concurrent=DEFAULT_MAX_PER_HOST, 
+                 min_interval=DEFAULT_MIN_HOST_INTERVAL,
+                 saturated_delay=DEFAULT_HOST_DEFER_DELAY.seconds):
+        self.max_concurrent = max_concurrent
+        self.min_interval = min_interval
+        self.saturated_delay = saturated_delay
+        self._hosts = {}
+
+    def admit(self, url):
+        """
+        returns True if a fetch of the url given may start now, in 
+        which case release(url) must be called when the fetch is 
+        complete, or False if it should be deferred.
+        """
+        state = self._state(url)
+        now = time.time()
+        if state.active >= self.max_concurrent or now < state.next_start:
+            state.deferred += 1
+            return False
+
+        state.next_start = now + self.min_interval
+        state.active += 1
+        state.admitted += 1
+        return True
+
+    def defer_delay(self, url):
+        """
+        returns the number of seconds to put off a fetch of the url 
+        given which was not admitted.  fetches put off while the host 
+        is only spacing out its fetches are given successive start 
+        slots, those put off while the host has max_concurrent fetches 
+        in flight wait saturated_delay seconds.
+        """
+        state = self._state(url)
+        now = time.time()
+        if state.active >= self.max_concurrent:
+            delay = self.saturated_delay
+        else:
+            slot = max(now, state.next_start, state.next_retry)
+            state.next_retry = slot + self.min_interval
+            delay = slot - now
+
+        state.waiting += 1
+        state.total_delay += delay
+        state.max_delay = max(state.max_delay, delay)
+        return delay
+
+    def returned(self, url, deferred_at):
+        """
+        a fetch of the url given which was first deferred at the
+        time given (see time.time) is being tried again.
+        """
+        state = self._state(url)
+        # it may have been put off by another process
+        state.waiting = max(state.waiting - 1, 0)
+        waited = max(time.time() - deferred_at, 0)
+        state.returned += 1
+        state.total_wait += waited
+        state.max_wait = max(state.max_wait, waited)
+
+    def release(self, url):
+        state = self._state(url)
+        state.active -= 1
+
+    def stats(self):
+        """
+        returns a dictionary of per host admission statistics 
+        """
+        stats = {}
+        for host, state in self._hosts.items():
+            avg_delay = 0.0
+            if state.deferred > 0:
+                avg_delay = state.total_delay / state.deferred
+            avg_wait = 0.0
+            if state.returned > 0:
+                avg_wait = state.total_wait / state.returned
+            stats[host] = {
+                'active': state.active,
+                'admitted': state.admitted,
+                'deferred': state.deferred,
+                'waiting': state.waiting,
+                'avg_delay': avg_delay,
+                'max_delay': state.max_delay,
+                'avg_wait': avg_wait,
+                'max_wait': state.max_wait,
+            }
+        return stats
+
+    def log_stats(self, max_hosts=10):
+        """
+        logs the hosts with the most deferred fetches waiting
+        """
+        stats = [(host, st) for host, st in self.stats().items() if st['deferred'] > 0]
+        stats.sort(key=lambda x: (x[1]['waiting'], x[1]['deferred']), reverse=True)
+        for host, st in stats[:max_hosts]:
+            log.info("host %s: %d waiting, %d deferred, %d active, delay avg %0.1fs max %0.1fs, "
+                     "waited avg %0.1fs max %0.1fs" % 
+                     (host, st['waiting'], st['deferred'], st['active'], 
+                      st['avg_delay'], st['max_delay'], st['avg_wait'], st['max_wait']))
+
+    def _state(self, url):
+        host = urlparse(url)[1].lower()
+        state = self._hosts.get(host)
+        if state is None:
+            state = _HostState()
+            self._hosts[host] = state
+        return state
+
+def create_host_throttle(context):
+    cfg = context.config.get('feed_indexer', {})
+    return HostThrottle(
+        max_concurrent=int(cfg.get('max_per_host', DEFAULT_MAX_PER_HOST)),
+        min_interval=float(cfg.get('min_host_interval', DEFAULT_MIN_HOST_INTERVAL)),
+        saturated_delay=_host_defer_delay(context).seconds)
+
+def _host_defer_delay(context):
+    cfg = context.config.get('feed_indexer', {})
+    if 'host_defer_delay' in cfg:
+        return timedelta(seconds=int(cfg.host_defer_delay))
+    return DEFAULT_HOST_DEFER_DELAY
+
 #####################
 # Message handling
-#####################s
+#####################
 
-def handle_message(message_data, message, context):
+def handle_message(message_data, message, context, throttle=None):
     """
     """
     try:
@@ -192,10 +356,10 @@ def handle_message(message_data, message, context):
             log.error("malformed index_feed message, no url: %s" % message)
             return
     
-        if 'content' in message_data:
+        if has_claimed(message_data, 'content'):
             _handle_push(url, message_data, message, context)
         else:
-            _handle_poll(url, message_data, message, context)
+            _handle_poll(url, message_data, message, context, throttle=throttle)
 
         log.info('Completed index of %s' % url)
         log.debug("completed handling message.")
@@ -203,40 +367,85 @@ def handle_message(message_data, message, context):
         log.error('Error handling feed indexer command (%s): %s' % 
                   (message_data, traceback.format_exc()))
 
-def _handle_poll(url, message_data, message, context):
+def _handle_poll(url, message_data, message, context, throttle=None):
     log.info('Received poll index request for %s' % url)
+
+    deferred_at = message_data.get('host_deferred_at')
+    if throttle is not None and deferred_at is not None:
+        throttle.returned(url, deferred_at)
+
+    if throttle is not None and not throttle.admit(url):
+        _defer_poll(url, message_data, throttle.defer_delay(url), context)
+        return
+
     try:
         index_feed_polling(url, context, request_info=message_data)
     except:
         log.error("Error indexing %s during poll request: %s" % (url, traceback.format_exc()))
+    finally:
+        if throttle is not None:
+            throttle.release(url)
+
+def _defer_poll(url, message_data, delay, context):
+    """
+    put off a poll of a busy host for delay seconds.
+    """
+    when = datetime.utcnow() + timedelta(seconds=delay)
+    log.info("Host busy, deferring poll of %s until %s" % (url, when))
+    options = {}
+    if not message_data.get('skip_reschedule', False):
+        # this stands in for the periodic poll of the feed
+        options['message_id'] = 'periodic_index_%s' % RemoteFeed.id_for_url(url)
+    message = dict(message_data)
+    # when it was first put off
+    message.setdefault('host_deferred_at', time.time())
+    defer_message(when, message, INDEX_FEED_COMMAND, context, **options)
 
 def _handle_push(url, message_data, message, context):
     log.info('Received push index request for %s' % url)
     try:
-        content = message_data['content']
+        content = claimed(message_data, 'content', context)
         index_feed_push(url, content, context, request_info=message_data)
     except:
         log.error("Error pushing %s: %s" % (message_data, traceback.format_exc()))
+    release_claims(message_data, context)
+
 
+def _log_host_stats(throttle, interval):
+    try:
+        while True:
+            sleep(interval)
+            throttle.log_stats()
+    except GreenletExit:
+        pass
 
 def run_feed_indexer(context):
+    stats_proc = None
     try:
-        worker_pool = Pool()
+        pool_size, prefetch_count = pool_settings(context, 'feed_indexer')
+        worker_pool = Pool(pool_size)
+        throttle = create_host_throttle(context)
 
         @pooled(worker_pool)
         @always_ack
         def cb(message_data, message):
             try:
                 with context:
-                    return handle_message(message_data, message, context)
+                    return handle_message(message_data, message, context, throttle=throttle)
             except GreenletExit:
                 pass
             except: 
                 log.error("Unexpected error handling feed indexer message: %s" % traceback.format_exc())
 
+        cfg = context.config.get('feed_indexer', {})
+        stats_interval = int(cfg.get('host_stats_interval', DEFAULT_HOST_STATS_INTERVAL))
+        if stats_interval > 0:
+            stats_proc = spawn(_log_host_stats, throttle, stats_interval)
+
         with context:
             dispatch = MessageDispatch(context)
-            proc = dispatch.start_worker(INDEX_FEED_COMMAND, cb)
+            proc = dispatch.start_worker(INDEX_FEED_COMMAND, cb,
+                                         prefetch_count=prefetch_count)
         
         proc.wait()
     except GreenletExit:
@@ -244,6 +453,8 @@ def run_feed_indexer(context):
     except: 
         log.error("Unexpected error running feed indexer: %s" % traceback.format_exc())
     finally:
+        if stats_proc is not None:
+            stats_proc.kill()
         # stop accepting work
         proc.kill()
         proc.wait()
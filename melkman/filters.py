@@ -3,13 +3,16 @@ from melk.util.typecheck import is_dicty, is_listy
 from melk.util.urlnorm import canonical_url
 from melkman.context import IContextConfigurable
 from melkman.parse import stripped_content
+from melkman.textmatch import KeywordMatcher
+from hashlib import md5
 import logging
 import re
+from simplejson import dumps
 import traceback
 
 __all__ = ['INewsItemFilterFactory', 'NewsItemFilterFactory', 
            'ACCEPT_ITEM', 'REJECT_ITEM', 'BaseMatchFilter', 
-           'SimpleFilterPlugin']
+           'SimpleFilterPlugin', 'FilterChainCache', 'optimize_chain']
 
 log = logging.getLogger(__name__)
 
@@ -37,6 +40,9 @@ class NewsItemFilterFactory(Component):
     implements(IContextConfigurable)
     
     filter_types = ExtensionPoint(INewsItemFilterFactory)
+
+    chain_cache = None
+    optimize = True
     
     def create_filter(self, filter_type, config, negative=False):
         for factory in self.filter_types:
@@ -64,8 +70,166 @@ class NewsItemFilterFactory(Component):
             chain.append(filt, cfg.action)
         return chain
 
+    def cached_chain(self, key, filter_chain):
+        """
+        like create_chain, but reuses a previously compiled chain
+        if one was created for the same key (eg a composite id)
+        and an identical list of filter configurations.
+        """
+        if self.chain_cache is None:
+            return self._compile_chain(key, filter_chain)
+        
+        serialized = _serialize_chain(filter_chain)
+        digest = md5(serialized).hexdigest()
+        chain = self.chain_cache.get(key, digest)
+        if chain is None:
+            chain = self._compile_chain(key, filter_chain)
+            self.chain_cache.put(key, digest, chain, len(serialized))
+        return chain
+
+    def _compile_chain(self, key, filter_chain):
+        chain = self.create_chain(filter_chain)
+        if self.optimize:
+            chain = optimize_chain(chain)
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug("compiled filters for %s:\n%s" % (key, chain.explain()))
+        return chain
+
     def set_context(self, context):
         self.context = context
+        cfg = context.config.get('filters', {})
+        self.optimize = cfg.get('optimize', True)
+        # the component only lives as long as the greenlet 
+        # using it, the cache is kept by the context.
+        self.chain_cache = context.filter_chain_cache
+
+def _serialize_chain(filter_chain):
+    cfgs = []
+    for cfg in filter_chain:
+        if hasattr(cfg, 'unwrap'):
+            cfg = cfg.unwrap()
+        cfgs.append(cfg)
+    return dumps(cfgs, sort_keys=True)
+
+DEFAULT_CHAIN_CACHE_SIZE = 1000
+DEFAULT_CHAIN_CACHE_MAX_BYTES = 4*1024*1024
+
+class FilterChainCache(object):
+    """
+    least recently used cache of compiled FilterChains.  
+    
+    Each key holds one chain along with a digest of the 
+    configuration it was compiled from.  A lookup with a 
+    different digest misses and the stale chain is replaced.
+    
+    The cache holds at most max_chains chains and at most
+    max_size bytes of (serialized) filter configuration, which
+    stands in for the size of the compiled filters.
+    """
+
+    def __init__(self, max_chains, max_size):
+        self.max_chains = max_chains
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._entries = {}
+        # circular list of [prev, next, key, digest, chain, size]
+        # most recently used first.
+        self._head = [None, None, None, None, None, 0]
+        self._head[0] = self._head[1] = self._head
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, digest):
+        entry = self._entries.get(key)
+        if entry is None or entry[3] != digest:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._unlink(entry)
+        self._link_first(entry)
+        return entry[4]
+
+    def put(self, key, digest, chain, size):
+        self.invalidate(key)
+        if size > self.max_size:
+            return
+
+        entry = [None, None, key, digest, chain, size]
+        self._entries[key] = entry
+        self._link_first(entry)
+        self.size += size
+
+        while len(self._entries) > self.max_chains or self.size > self.max_size:
+            self.invalidate(self._head[0][2])
+            self.evictions += 1
+
+    def invalidate(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._unlink(entry)
+            self.size -= entry[5]
+
+    def clear(self):
+        self._entries = {}
+        self._head[0] = self._head[1] = self._head
+        self.size = 0
+
+    def stats(self):
+        return {'chains': len(self._entries),
+                'size': self.size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions}
+
+    def _link_first(self, entry):
+        first = self._head[1]
+        entry[0] = self._head
+        entry[1] = first
+        first[0] = entry
+        self._head[1] = entry
+
+    def _unlink(self, entry):
+        entry[0][1] = entry[1]
+        entry[1][0] = entry[0]
+
+def needs_full_item(filt):
+    """
+    True if the filter given may call load_full_item on the items
+    it examines.  filters declare this with a 'needs_full_item' 
+    attribute, filters that do not are assumed to need them.
+    """
+    return getattr(filt, 'needs_full_item', True)
+
+# estimated relative cost of evaluating filters, see filter_cost
+FULL_ITEM_COST = 10
+UNKNOWN_FILTER_COST = 100
+
+def filter_cost(filt):
+    """
+    estimated relative cost of applying the filter given to an item.
+    filters declare this with a 'cost' attribute, filters that do not
+    are assumed to be expensive.
+    """
+    return getattr(filt, 'cost', UNKNOWN_FILTER_COST)
+
+def evaluate_batch(filt, news_items):
+    """
+    returns a list of the results of applying the filter 
+    given to each of the items given.  filters may provide 
+    an 'evaluate_batch' method to examine the items together,
+    otherwise the filter is called on each item.
+    """
+    if len(news_items) == 0:
+        return []
+    batch = getattr(filt, 'evaluate_batch', None)
+    if batch is not None:
+        return batch(news_items)
+    return [filt(item) for item in news_items]
 
 ACCEPT_ITEM = 'accept'
 REJECT_ITEM = 'reject'
@@ -81,12 +245,57 @@ class FilterChain(object):
                 return action
         return self._default
 
+    def evaluate_batch(self, news_items):
+        """
+        returns a list of the actions for each of the 
+        items given.  each filter in the chain is only 
+        applied to the items not decided by earlier filters.
+        """
+        actions = [self._default] * len(news_items)
+        pending = range(len(news_items))
+        for filt, action in self._filters:
+            if len(pending) == 0:
+                break
+            matches = evaluate_batch(filt, [news_items[i] for i in pending])
+            undecided = []
+            for i, matched in zip(pending, matches):
+                if matched:
+                    actions[i] = action
+                else:
+                    undecided.append(i)
+            pending = undecided
+        return actions
+
     def append(self, filt, action):
         self._filters.append((filt, action))
 
     def set_default_action(self, action):
         self._default = action
 
+    def explain(self):
+        """
+        returns a readable description of the filters 
+        in the chain, eg:
+
+        reject if match_author exact ['fred']
+        accept if or (cost 3, full item)
+          match_title substring ['dino']
+          match_tag exact ['bedrock']
+        otherwise accept
+        """
+        lines = []
+        for filt, action in self._filters:
+            lines += _explain(filt, '%s if ' % action, '  ')
+        lines.append('otherwise %s' % self._default)
+        return '\n'.join(lines)
+
+    @property
+    def needs_full_item(self):
+        for filt, action in self._filters:
+            if needs_full_item(filt):
+                return True
+        return False
+
 class SimpleFilterPlugin(Component):
     implements(INewsItemFilterFactory, IContextConfigurable)
     abstract = True
@@ -107,8 +316,21 @@ class Negation(object):
     def __call__(self, *args, **kw):
         return not self.filter(*args, **kw)
 
+    def evaluate_batch(self, news_items):
+        return [not x for x in evaluate_batch(self.filter, news_items)]
+
+    @property
+    def needs_full_item(self):
+        return needs_full_item(self.filter)
+
+    @property
+    def cost(self):
+        return filter_cost(self.filter)
+
 class MatchNoneFilter(object):
     filter_type = 'match_none'
+    needs_full_item = False
+    cost = 0
 
     def __init__(self, *args, **kw):
         pass
@@ -116,11 +338,16 @@ class MatchNoneFilter(object):
     def __call__(self, *args, **kw):
         return False
 
+    def evaluate_batch(self, news_items):
+        return [False] * len(news_items)
+
 class MatchNoneFilterPlugin(SimpleFilterPlugin):
     FilterType = MatchNoneFilter
 
 class MatchAllFilter(object):
     filter_type = 'match_all'
+    needs_full_item = False
+    cost = 0
 
     def __init__(self, *args, **kw):
         pass
@@ -128,6 +355,9 @@ class MatchAllFilter(object):
     def __call__(self, *args, **kw):
         return True
 
+    def evaluate_batch(self, news_items):
+        return [True] * len(news_items)
+
 class MatchAllFilterPlugin(SimpleFilterPlugin):
     FilterType = MatchAllFilter
 
@@ -145,6 +375,50 @@ class MultiFilter(object):
             if filt is not None:
                 self._filters.append(filt)
 
+    @classmethod
+    def of(cls, filters, context=None):
+        """
+        create a filter combining the (already constructed)
+        filters given.
+        """
+        filt = cls.__new__(cls)
+        filt._filters = list(filters)
+        filt.context = context
+        return filt
+
+    @property
+    def needs_full_item(self):
+        for filt in self._filters:
+            if needs_full_item(filt):
+                return True
+        return False
+
+    @property
+    def cost(self):
+        return sum([filter_cost(filt) for filt in self._filters])
+
+def _evaluate_any(filters, news_items, decider):
+    """
+    batch evaluation for 'or' (decider=True) and 'and' 
+    (decider=False).  an item is decided by the first 
+    filter that gives it the result 'decider', so each 
+    filter only examines the items that are still undecided.
+    """
+    results = [not decider] * len(news_items)
+    pending = range(len(news_items))
+    for filt in filters:
+        if len(pending) == 0:
+            break
+        matches = evaluate_batch(filt, [news_items[i] for i in pending])
+        undecided = []
+        for i, matched in zip(pending, matches):
+            if bool(matched) == decider:
+                results[i] = decider
+            else:
+                undecided.append(i)
+        pending = undecided
+    return results
+
 class OrFilter(MultiFilter):
     filter_type = 'or'
 
@@ -154,6 +428,9 @@ class OrFilter(MultiFilter):
                 return True
         return False
 
+    def evaluate_batch(self, news_items):
+        return _evaluate_any(self._filters, news_items, True)
+
 class OrFilterPlugin(SimpleFilterPlugin):
     FilterType = OrFilter
 
@@ -170,56 +447,90 @@ class AndFilter(MultiFilter):
                 return False
         return True
 
+    def evaluate_batch(self, news_items):
+        if len(self._filters) == 0:
+            return [False] * len(news_items)
+        return _evaluate_any(self._filters, news_items, False)
+
 class AndFilterPlugin(SimpleFilterPlugin):
     FilterType = AndFilter
 
+_MATCH_COSTS = {'exact': 1, 'substring': 2, 'regex': 4}
+
 class BaseMatchFilter(object):
+
+    # subclasses that examine the details of
+    # the full item should set this to True
+    needs_full_item = False
     
     def __init__(self, config, context):
         self.config = config
         self.context = context
         
-        pat_str = ''
-        match_type = config.get('match_type', 'exact')
-        def rescape_char(match):
-            return '\%s' % match.group(0)
-        def rescape(val):
-            return re.sub(r'[\.\^\$\*\+\?\{\}\\\[\]\|\(\)]', rescape_char, val)
-        
-        if match_type == 'exact':
-            for val in config.get('values', []):
-                pat_str += '^%s$|' % rescape(val)
-            if pat_str.endswith('|'):
-                pat_str = pat_str[0:-1]
-        elif match_type == 'substring':
-            for val in config.get('values', []):
-                pat_str += '^.*?%s.*?$|' % rescape(val)
-            if pat_str.endswith('|'):
-                pat_str = pat_str[0:-1]
-        elif match_type == 'regex':
-            for val in config.get('values', []):
-                pat_str += '%s|' % val
-            if pat_str.endswith('|'):
-                pat_str = pat_str[0:-1]
+        self.match_type = config.get('match_type', 'exact')
+        self.case_sensitive = config.get('case_sensitive', False)
+        values = config.get('values', [])
+
+        self.pat = None
+        self.matcher = None
+        if self.match_type in ('exact', 'substring'):
+            # keyword lists are matched with a set or automaton, 
+            # which stays fast with thousands of values.
+            if values:
+                self.matcher = KeywordMatcher(values, self.match_type, 
+                                              self.case_sensitive)
+        elif self.match_type == 'regex':
+            pat_str = '|'.join(values)
+            if pat_str:
+                flags = re.M|re.S
+                if self.case_sensitive == False:
+                    flags |= re.I
+                self.pat = re.compile(pat_str, flags)
         else:
-            raise ValueError("unknown match type: %s" % match_type)
-        
-        if pat_str:
-            flags = re.M|re.S
-            if config.get('case_sensitive', False) == False:
-                flags |= re.I
-            self.pat = re.compile(pat_str, flags)
-        else:
-            self.pat = None
+            raise ValueError("unknown match type: %s" % self.match_type)
+
+    @property
+    def cost(self):
+        cost = _MATCH_COSTS[self.match_type]
+        if self.needs_full_item:
+            cost += FULL_ITEM_COST
+        return cost
             
     def _match(self, val):
         if not isinstance(val, basestring):
             return False
 
-        if self.pat is None:
-            return False
-        else:
+        if self.matcher is not None:
+            return self.matcher.match(val)
+        elif self.pat is not None:
             return self.pat.match(val) is not None
+        else:
+            return False
+
+    def _match_many(self, vals):
+        """
+        _match for a list of values, each distinct
+        value is only matched once.
+        """
+        if self.matcher is None and self.pat is None:
+            return [False] * len(vals)
+
+        seen = {}
+        results = []
+        for val in vals:
+            try:
+                matched = seen.get(val)
+            except TypeError: # unhashable
+                results.append(self._match(val))
+                continue
+            if matched is None:
+                matched = self._match(val)
+                seen[val] = matched
+            results.append(matched)
+        return results
+
+    def evaluate_batch(self, news_items):
+        return [self(item) for item in news_items]
 
 class AuthorFilter(BaseMatchFilter):
 
@@ -229,7 +540,13 @@ class AuthorFilter(BaseMatchFilter):
         item_author = self._norm_author(news_item.get('author', ''))
         return self._match(item_author)
 
+    def evaluate_batch(self, news_items):
+        return self._match_many([self._norm_author(item.get('author', ''))
+                                 for item in news_items])
+
     def _norm_author(self, author):
+        if not isinstance(author, basestring):
+            return author
         return author.lower().strip()
 
 class AuthorFilterPlugin(SimpleFilterPlugin):
@@ -242,6 +559,15 @@ class SourceFilter(BaseMatchFilter):
     def __call__(self, news_item):
         return self._match(canonical_url(news_item.get('source_url', '')))
 
+    def evaluate_batch(self, news_items):
+        urls = {}
+        for item in news_items:
+            url = item.get('source_url', '')
+            if not url in urls:
+                urls[url] = canonical_url(url)
+        return self._match_many([urls[item.get('source_url', '')]
+                                 for item in news_items])
+
 class SourceFilterPlugin(SimpleFilterPlugin):
     FilterType = SourceFilter
 
@@ -254,11 +580,15 @@ class TitleFilter(BaseMatchFilter):
         item_title = news_item.get('title', '')
         return self._match(item_title)
 
+    def evaluate_batch(self, news_items):
+        return self._match_many([item.get('title', '') for item in news_items])
+
 class TitleFilterPlugin(SimpleFilterPlugin):
     FilterType = TitleFilter
 
 class TagFilter(BaseMatchFilter):
     filter_type = 'match_tag'
+    needs_full_item = True
     
     def __call__(self, news_item):
         for t in self._get_tags(news_item):
@@ -267,9 +597,11 @@ class TagFilter(BaseMatchFilter):
         return False
 
     def _get_tags(self, news_item):
-        news_item = news_item.load_full_item(self.context.db)
-        item_details = news_item.details
         tags = set()
+        news_item = news_item.load_full_item()
+        if news_item is None:
+            return tags
+        item_details = news_item.details
 
         for t in item_details.get('tags', []):
             # XXX shady?
@@ -298,9 +630,17 @@ class TagFilterPlugin(SimpleFilterPlugin):
 class ContentFilter(BaseMatchFilter):
 
     filter_type = 'match_content'
+    needs_full_item = True
+
+    @property
+    def cost(self):
+        # stripping the content is the expensive part
+        return BaseMatchFilter.cost.fget(self) + FULL_ITEM_COST
 
     def __call__(self, news_item):
-        news_item = news_item.load_full_item(self.context.db)
+        news_item = news_item.load_full_item()
+        if news_item is None:
+            return False
         e = news_item.details
         content = e.get('content', [None])[0]
         if content is None:
@@ -317,9 +657,12 @@ class ContentFilterPlugin(SimpleFilterPlugin):
 class MatchFieldFilter(BaseMatchFilter):
     
     filter_type = 'match_field'
+    needs_full_item = True
     
     def __call__(self, news_item):
-        news_item = news_item.load_full_item(self.context.db)
+        news_item = news_item.load_full_item()
+        if news_item is None:
+            return False
         path = self.config.get('field', None)
         if path is None:
             return False
@@ -341,3 +684,189 @@ class MatchFieldFilter(BaseMatchFilter):
 
 class MatchFieldFilterPlugin(SimpleFilterPlugin):
     FilterType = MatchFieldFilter
+
+
+##################################
+# Optimization
+##################################
+
+def optimize_chain(chain):
+    """
+    returns a FilterChain which makes the same decisions as the 
+    chain given with less work:
+
+    * nested and/or filters are flattened and those with a 
+      single filter are replaced by it.
+    * match_all, match_none and double negations are folded away.
+    * match filters of the same type and settings under an 'or'
+      are merged into a single filter.
+    * consecutive filters with the same action are combined so 
+      that cheaper filters (and those that do not need the full 
+      item) are tried first.
+    * filters after one that matches everything are dropped.
+    """
+    optimized = FilterChain()
+    default = chain._default
+
+    entries = []
+    for filt, action in chain._filters:
+        filt = optimize_filter(filt)
+        if isinstance(filt, MatchNoneFilter):
+            continue
+        if isinstance(filt, MatchAllFilter):
+            # nothing after this can be reached
+            default = action
+            break
+        entries.append((filt, action))
+
+    # trailing filters with the default action decide nothing.
+    while entries and entries[-1][1] == default:
+        entries.pop()
+
+    # group consecutive filters with the same action, the first 
+    # match in a group is the same as any match in the group.
+    group = []
+    for i, (filt, action) in enumerate(entries):
+        group.append(filt)
+        if i + 1 == len(entries) or entries[i + 1][1] != action:
+            if len(group) == 1:
+                optimized.append(group[0], action)
+            else:
+                optimized.append(optimize_filter(OrFilter.of(group)), action)
+            group = []
+
+    optimized.set_default_action(default)
+    return optimized
+
+def optimize_filter(filt):
+    """
+    returns a filter equivalent to the filter given, see optimize_chain.
+    """
+    if isinstance(filt, Negation):
+        inner = optimize_filter(filt.filter)
+        if isinstance(inner, Negation):
+            return inner.filter
+        if isinstance(inner, MatchAllFilter):
+            return MatchNoneFilter()
+        if isinstance(inner, MatchNoneFilter):
+            return MatchAllFilter()
+        return Negation(inner)
+
+    if type(filt) is OrFilter:
+        return _optimize_multi(filt, OrFilter, MatchAllFilter, MatchNoneFilter)
+    if type(filt) is AndFilter:
+        return _optimize_multi(filt, AndFilter, MatchNoneFilter, MatchAllFilter)
+
+    return filt
+
+def _optimize_multi(filt, multi_type, absorbing, neutral):
+    """
+    optimize an 'or' or 'and'.  any 'absorbing' child decides the 
+    result, 'neutral' children do not affect it.
+    """
+    children = []
+    for child in filt._filters:
+        child = optimize_filter(child)
+        if type(child) is multi_type:
+            # already optimized
+            children += child._filters
+        else:
+            children.append(child)
+
+    for child in children:
+        if isinstance(child, absorbing):
+            return absorbing()
+
+    # N.B. an 'and' of no filters at all is false, like an 
+    # empty AndFilter, but one made only of match_alls is true.
+    remaining = [c for c in children if not isinstance(c, neutral)]
+    if len(remaining) == 0:
+        if len(children) > 0 and multi_type is AndFilter:
+            return MatchAllFilter()
+        return MatchNoneFilter()
+
+    if multi_type is OrFilter:
+        remaining = _merge_match_filters(remaining)
+
+    if len(remaining) == 1:
+        return remaining[0]
+
+    # stable, so equally cheap filters keep their order
+    remaining.sort(key=_filter_order)
+    return multi_type.of(remaining, filt.context)
+
+def _filter_order(filt):
+    return (needs_full_item(filt), filter_cost(filt))
+
+def _merge_key(filt):
+    if type(filt) not in _MERGEABLE or not 'values' in filt.config:
+        return None
+    cfg = dict(filt.config)
+    del cfg['values']
+    cfg['match_type'] = filt.match_type
+    cfg['case_sensitive'] = filt.case_sensitive
+    return (type(filt), dumps(cfg, sort_keys=True))
+
+def _merge_match_filters(filters):
+    """
+    replaces match filters in an 'or' that differ only 
+    by their values with one filter matching all the values.
+    """
+    groups = {}
+    order = []
+    for filt in filters:
+        key = _merge_key(filt)
+        if key is None:
+            order.append([filt])
+            continue
+        group = groups.get(key)
+        if group is None:
+            group = []
+            groups[key] = group
+            order.append(group)
+        group.append(filt)
+    
+    merged = []
+    for group in order:
+        if len(group) == 1:
+            merged.append(group[0])
+            continue
+        cfg = dict(group[0].config)
+        values = []
+        for filt in group:
+            for val in filt.config['values']:
+                if not val in values:
+                    values.append(val)
+        cfg['values'] = values
+        merged.append(type(group[0])(cfg, group[0].context))
+    return merged
+
+_MERGEABLE = set([AuthorFilter, SourceFilter, TitleFilter, TagFilter, 
+                  ContentFilter, MatchFieldFilter])
+
+def _describe(filt):
+    if isinstance(filt, BaseMatchFilter):
+        values = list(filt.config.get('values', []))
+        desc = '%s %s' % (filt.filter_type, filt.match_type)
+        if isinstance(filt, MatchFieldFilter):
+            desc += ' %s' % filt.config.get('field')
+        if len(values) > 5:
+            desc += ' %r ... (%d values)' % (values[:5], len(values))
+        else:
+            desc += ' %r' % values
+        return desc
+    return getattr(filt, 'filter_type', None) or type(filt).__name__
+
+def _explain(filt, prefix, indent):
+    if isinstance(filt, Negation):
+        return _explain(filt.filter, prefix + 'not ', indent)
+
+    desc = prefix + _describe(filt)
+    if isinstance(filt, MultiFilter):
+        desc += ' (cost %d%s)' % (filter_cost(filt), 
+                                  needs_full_item(filt) and ', full item' or '')
+        lines = [desc]
+        for child in filt._filters:
+            lines += [indent + l for l in _explain(child, '', '  ')]
+        return lines
+    return [desc]
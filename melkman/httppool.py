@@ -0,0 +1,166 @@
+# Copyright (C) 2009 The Open Planning Project
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the
+# Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor,
+# Boston, MA  02110-1301
+# USA
+
+from eventlet.semaphore import Semaphore
+from httplib2 import Http
+import logging
+import time
+import traceback
+from urlparse import urlparse
+
+log = logging.getLogger(__name__)
+
+__all__ = ['HTTPPool']
+
+DEFAULT_MAX_PER_HOST = 4
+DEFAULT_MAX_IDLE = 60
+DEFAULT_TIMEOUT = 15
+
+def _close_http(http):
+    for conn in http.connections.values():
+        try:
+            conn.close()
+        except:
+            log.error("Error closing http connection: %s" % traceback.format_exc())
+    http.connections.clear()
+
+class _HostPool(object):
+    """
+    the idle keep-alive clients and concurrency limit
+    for a single scheme://host:port
+    """
+    def __init__(self, max_connections):
+        self.max_connections = max_connections
+        self.sem = Semaphore(max_connections)
+        self.idle = [] # (last used, Http) most recently used last
+
+    @property
+    def in_use(self):
+        return self.max_connections - self.sem.balance
+
+    def checkout(self, make_http):
+        self.sem.acquire()
+        if self.idle:
+            last_used, http = self.idle.pop()
+            return http
+        return make_http()
+
+    def checkin(self, http, discard=False):
+        try:
+            if discard:
+                _close_http(http)
+            else:
+                self.idle.append((time.time(), http))
+        finally:
+            self.sem.release()
+
+    def evict_idle(self, cutoff):
+        keep = []
+        for last_used, http in self.idle:
+            if last_used < cutoff:
+                _close_http(http)
+            else:
+                keep.append((last_used, http))
+        self.idle = keep
+
+    def close(self):
+        for last_used, http in self.idle:
+            _close_http(http)
+        self.idle = []
+
+
+class HTTPPool(object):
+    """
+    A pool of keep-alive http clients shared by all greenlets
+    using a context.  Clients are kept per host, at most
+    max_per_host requests to a single host are made at once
+    (additional requests wait their turn) and clients that have
+    been idle for more than max_idle seconds are closed.
+
+    eg:
+
+    response, content = context.http_pool.request(url, 'GET')
+    """
+
+    def __init__(self, max_per_host=DEFAULT_MAX_PER_HOST,
+                 max_idle=DEFAULT_MAX_IDLE, cache=None,
+                 timeout=DEFAULT_TIMEOUT):
+        self.max_per_host = max_per_host
+        self.max_idle = max_idle
+        self.cache = cache
+        self.timeout = timeout
+        self._hosts = {}
+        self._last_sweep = time.time()
+
+    def request(self, uri, method='GET', body=None, headers=None,
+                timeout=None, force_exception_to_status_code=False):
+        """
+        perform an http request using a pooled client for the
+        host in the uri given.  accepts the same arguments as
+        httplib2.Http.request and returns (response, content).
+        """
+        self._sweep()
+
+        host_pool = self._host_pool(_host_key(uri))
+        http = host_pool.checkout(self._make_http)
+        discard = True
+        try:
+            http.timeout = timeout or self.timeout
+            http.force_exception_to_status_code = force_exception_to_status_code
+            result = http.request(uri, method=method, body=body, headers=headers)
+            discard = False
+            return result
+        finally:
+            host_pool.checkin(http, discard=discard)
+
+    def close(self):
+        hosts = self._hosts
+        self._hosts = {}
+        for host_pool in hosts.values():
+            host_pool.close()
+
+    def _make_http(self):
+        return Http(cache=self.cache, timeout=self.timeout)
+
+    def _host_pool(self, key):
+        host_pool = self._hosts.get(key)
+        if host_pool is None:
+            host_pool = _HostPool(self.max_per_host)
+            self._hosts[key] = host_pool
+        return host_pool
+
+    def _sweep(self):
+        """
+        close clients that have been idle for too long and
+        forget hosts that are not in use.
+        """
+        now = time.time()
+        if now - self._last_sweep < self.max_idle:
+            return
+        self._last_sweep = now
+
+        cutoff = now - self.max_idle
+        for key, host_pool in self._hosts.items():
+            host_pool.evict_idle(cutoff)
+            if host_pool.in_use == 0 and len(host_pool.idle) == 0:
+                del self._hosts[key]
+
+def _host_key(uri):
+    scheme, netloc = urlparse(uri)[0:2]
+    return '%s://%s' % (scheme.lower(), netloc.lower())
@@ -17,20 +17,387 @@
 # Boston, MA  02110-1301
 # USA
 
+from carrot import serialization
 from carrot.messaging import Publisher, Consumer
-from eventlet import spawn
+from eventlet import spawn, with_timeout, TimeoutError
 from eventlet.event import Event
-from eventlet.support.greenlets import GreenletExit
+from eventlet.semaphore import Semaphore
+from eventlet.support.greenlets import GreenletExit, getcurrent
 
 import logging
+import sys
 import traceback
 from uuid import uuid1
-
-from melkman.green import waitall
+import zlib
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
 
 log = logging.getLogger(__name__)
 
-__all__ = ['EventBus', 'MessageDispatch']
+__all__ = ['EventBus', 'MessageDispatch', 'PublisherPool', 'ConfirmedPublisher', 'PendingPublish',
+           'MessageEncoder', 'ConsumerMultiplexer']
+
+DEFAULT_SERIALIZER = 'json'
+DEFAULT_COMPRESS_LEVEL = 6
+
+DEFAULT_MAX_IDLE_PUBLISHERS = 4
+DEFAULT_CONFIRM_MAX_BATCH = 200
+DEFAULT_CONFIRM_MAX_DELAY = 0.01
+DEFAULT_CONFIRM_MAX_OUTSTANDING = 2000
+
+######################
+# Serialization
+######################
+#
+# bodies are serialized with carrot's serializer registry, 
+# which consumers use to decode messages by their content 
+# type.  compressed bodies have the content type of the 
+# serializer with '+zlib' appended.  every worker can decode 
+# every format registered here whichever one it sends, so 
+# the format can be changed while old and new workers run 
+# together by deploying first and then changing the setting.
+
+ZLIB_SUFFIX = '+zlib'
+
+# byte strings are packed as binary and unicode strings as 
+# utf-8 text, so both come back as they were sent.
+
+def _msgpack_dumps(data):
+    try:
+        return msgpack.packb(data, use_bin_type=True)
+    except TypeError:
+        # older msgpack
+        return msgpack.packb(data)
+
+def _msgpack_loads(data):
+    try:
+        try:
+            return msgpack.unpackb(data, raw=False)
+        except TypeError:
+            # older msgpack
+            return msgpack.unpackb(data, encoding='utf-8')
+    except UnicodeDecodeError:
+        # a text string which is not utf-8, from a packer 
+        # without binary types.  keep every string as sent.
+        try:
+            return msgpack.unpackb(data, raw=True)
+        except TypeError:
+            return msgpack.unpackb(data)
+
+def _serializer_content_type(name):
+    """
+    returns the (content_type, content_encoding) carrot sends 
+    with the serializer named, or None if it is not registered.
+    """
+    try:
+        content_type, content_encoding, body = serialization.encode({}, serializer=name)
+    except serialization.SerializerNotInstalled:
+        return None
+    return content_type, content_encoding
+
+def _zlib_decoder(content_type, content_encoding):
+    def decode(data):
+        return serialization.decode(zlib.decompress(data), content_type, content_encoding)
+    return decode
+
+def register_serializers():
+    """
+    register the message formats used by melkman with carrot.
+    """
+    if msgpack is not None:
+        serialization.registry.register('msgpack', _msgpack_dumps, _msgpack_loads,
+                                        content_type='application/x-msgpack',
+                                        content_encoding='binary')
+
+    for name in ('json', 'msgpack'):
+        registered = _serializer_content_type(name)
+        if registered is None:
+            continue
+        content_type, content_encoding = registered
+        serialization.registry.register(name + ZLIB_SUFFIX, None,
+                                        _zlib_decoder(content_type, content_encoding),
+                                        content_type=content_type + ZLIB_SUFFIX,
+                                        content_encoding='binary')
+register_serializers()
+
+class MessageEncoder(object):
+    """
+    serializes message bodies for sending with the 
+    serializer named (eg 'json' or 'msgpack').  bodies 
+    of more than compress_threshold bytes are compressed 
+    with zlib, a compress_threshold of 0 turns this off.
+    """
+
+    def __init__(self, serializer=DEFAULT_SERIALIZER, compress_threshold=0,
+                 compress_level=DEFAULT_COMPRESS_LEVEL):
+        if _serializer_content_type(serializer) is None:
+            raise ValueError("unknown message serializer: %s" % serializer)
+        self.serializer = serializer
+        self.compress_threshold = compress_threshold
+        self.compress_level = compress_level
+
+    def encode(self, data):
+        """
+        returns (body, content_type, content_encoding)
+        """
+        content_type, content_encoding, body = serialization.encode(data, serializer=self.serializer)
+        if self.compress_threshold > 0 and len(body) > self.compress_threshold:
+            if isinstance(body, unicode):
+                body = body.encode(content_encoding)
+            body = zlib.compress(body, self.compress_level)
+            content_type += ZLIB_SUFFIX
+            content_encoding = 'binary'
+        return body, content_type, content_encoding
+
+    def send(self, publisher, message, **kw):
+        """
+        send the message given with the publisher given, 
+        unless kw gives a content type or the message is 
+        a string (ie it is already serialized)
+        """
+        if kw.get('content_type') is None and not isinstance(message, basestring):
+            body, kw['content_type'], kw['content_encoding'] = self.encode(message)
+        else:
+            body = message
+        publisher.send(body, **kw)
+
+def message_encoder(context):
+    cfg = context.config.get('messaging', {})
+    return MessageEncoder(serializer=cfg.get('serializer', DEFAULT_SERIALIZER),
+                          compress_threshold=int(cfg.get('compress_threshold', 0)),
+                          compress_level=int(cfg.get('compress_level', DEFAULT_COMPRESS_LEVEL)))
+
+class PublisherPool(object):
+    """
+    keeps open Publishers (and their channels) for reuse 
+    by all greenlets using a context, so that sending a 
+    message does not open a channel and declare an exchange 
+    each time.  Publishers are kept per key, eg exchange and 
+    routing key, at most max_idle of each.  A publisher is 
+    only used by one greenlet at a time.
+
+    eg:
+
+    pool = context.publisher_pool
+    pub = pool.checkout(key, make_publisher)
+    try:
+        pub.send(message)
+    except:
+        pool.checkin(key, pub, discard=True)
+        raise
+    else:
+        pool.checkin(key, pub)
+    """
+
+    def __init__(self, max_idle=DEFAULT_MAX_IDLE_PUBLISHERS, encoder=None):
+        self.max_idle = max_idle
+        if encoder is None:
+            encoder = MessageEncoder()
+        self.encoder = encoder
+        self._idle = {}
+
+    def checkout(self, key, make_publisher):
+        """
+        returns an idle publisher for the key given, 
+        or a new one created with make_publisher()
+        """
+        idle = self._idle.get(key)
+        if idle:
+            return idle.pop()
+        return make_publisher()
+
+    def checkin(self, key, publisher, discard=False):
+        """
+        return a publisher from checkout.  if discard is True 
+        or there are enough idle publishers, it is closed.
+        """
+        idle = self._idle.setdefault(key, [])
+        if discard or len(idle) >= self.max_idle:
+            _close_publisher(publisher)
+        else:
+            idle.append(publisher)
+
+    def publish(self, key, make_publisher, messages, **kw):
+        """
+        send each of the messages given with a publisher for the 
+        key given.  keyword arguments are passed to Publisher.send.
+        """
+        publisher = self.checkout(key, make_publisher)
+        try:
+            for message in messages:
+                self.encoder.send(publisher, message, **kw)
+        except:
+            # the channel may be unusable
+            self.checkin(key, publisher, discard=True)
+            raise
+        else:
+            self.checkin(key, publisher)
+
+    def close(self):
+        idle = self._idle
+        self._idle = {}
+        for publishers in idle.values():
+            for publisher in publishers:
+                _close_publisher(publisher)
+
+def _close_publisher(publisher):
+    try:
+        publisher.close()
+    except:
+        log.error("Error closing publisher: %s" % traceback.format_exc())
+
+class PendingPublish(object):
+    """
+    a message submitted to a ConfirmedPublisher, 
+    see ConfirmedPublisher.submit
+    """
+    def __init__(self, message):
+        self.message = message
+        self._done = Event()
+        self._error = None
+
+    @classmethod
+    def sent(cls, message):
+        """
+        a PendingPublish for a message which has already 
+        been published.
+        """
+        pending = cls(message)
+        pending._finish()
+        return pending
+
+    def ready(self):
+        return self._done.ready()
+
+    def wait(self):
+        """
+        wait until the broker has accepted the message. 
+        raises the error if it was not.
+        """
+        self._done.wait()
+        if self._error is not None:
+            raise self._error[0], self._error[1], self._error[2]
+        return True
+
+    def _finish(self):
+        self._done.send(True)
+
+    def _fail(self, exc_info):
+        self._error = exc_info
+        self._done.send(True)
+
+class _PublishBatch(object):
+    def __init__(self, make_publisher):
+        self.make_publisher = make_publisher
+        self.sends = []
+        self.wakeup = Event()
+
+class ConfirmedPublisher(object):
+    """
+    Publishes messages from many greenlets in batches, each 
+    batch in a single AMQP transaction on a pooled channel.  
+    When the transaction commits the broker has taken 
+    responsibility for the messages (and written persistent 
+    ones to disk), so one round trip confirms the whole batch.
+
+    A batch is published once max_batch messages are waiting 
+    or max_delay seconds after the first arrived.  At most 
+    max_outstanding messages may be waiting for confirmation, 
+    further submits block until earlier batches are done.
+
+    eg:
+
+    pending = [context.confirmed_publisher.submit(key, make_publisher, m) 
+               for m in messages]
+    for p in pending:
+        p.wait()
+    """
+
+    def __init__(self, context, max_batch=DEFAULT_CONFIRM_MAX_BATCH, 
+                 max_delay=DEFAULT_CONFIRM_MAX_DELAY,
+                 max_outstanding=DEFAULT_CONFIRM_MAX_OUTSTANDING):
+        self.context = context
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.max_outstanding = max_outstanding
+        self._outstanding = Semaphore(max_outstanding)
+        self._batches = {}
+
+    def submit(self, key, make_publisher, message, **kw):
+        """
+        queue the message given to be published in the next batch
+        for the key given with a publisher from make_publisher. 
+        keyword arguments are passed to Publisher.send.  returns 
+        a PendingPublish which may be waited on for the outcome.
+        """
+        self._outstanding.acquire()
+        pending = PendingPublish(message)
+
+        batch = self._batches.get(key)
+        if batch is None:
+            batch = _PublishBatch(make_publisher)
+            self._batches[key] = batch
+            spawn(self._run_flush, key, batch)
+        batch.sends.append((message, kw, pending))
+        if len(batch.sends) >= self.max_batch:
+            # full, the next submit starts a new batch
+            del self._batches[key]
+            batch.wakeup.send(True)
+
+        return pending
+
+    def _run_flush(self, key, batch):
+        try:
+            with_timeout(self.max_delay, batch.wakeup.wait)
+        except TimeoutError:
+            pass
+
+        if self._batches.get(key) is batch:
+            del self._batches[key]
+
+        with self.context:
+            try:
+                self._publish_batch(key, batch)
+            except:
+                log.error("Error publishing batch of %d messages: %s" %
+                          (len(batch.sends), traceback.format_exc()))
+                exc_info = sys.exc_info()
+                for message, kw, pending in batch.sends:
+                    pending._fail(exc_info)
+            else:
+                for message, kw, pending in batch.sends:
+                    pending._finish()
+            for i in range(len(batch.sends)):
+                self._outstanding.release()
+
+    def _publish_batch(self, key, batch):
+        def make_publisher():
+            publisher = batch.make_publisher()
+            publisher.backend.channel.tx_select()
+            return publisher
+
+        pool = self.context.publisher_pool
+        pool_key = ('confirmed',) + tuple(key)
+        publisher = pool.checkout(pool_key, make_publisher)
+        try:
+            for message, kw, pending in batch.sends:
+                pool.encoder.send(publisher, message, **kw)
+            publisher.backend.channel.tx_commit()
+        except:
+            pool.checkin(pool_key, publisher, discard=True)
+            raise
+        else:
+            pool.checkin(pool_key, publisher)
+        log.debug("published batch of %d messages" % len(batch.sends))
+
+def confirm_dispatch(context):
+    """
+    whether MessageDispatch waits for the broker to 
+    confirm messages, see MessageDispatch.send
+    """
+    return context.config.get('messaging', {}).get('confirm_dispatch', False)
 
 
 def consumer_loop(make_consumer, context):
@@ -50,6 +417,203 @@ def consumer_loop(make_consumer, context):
             except:
                 log.error("error closing consumer: %s" % traceback.format_exc())
 
+class _MuxChannel(object):
+    """
+    an AMQP channel shared by some of the subscriptions 
+    of a ConsumerMultiplexer and the greenlet consuming it.
+    """
+    def __init__(self, context, prefetch_count):
+        self.context = context
+        self.backend = context.broker.create_backend()
+        if prefetch_count:
+            self.backend.qos(0, prefetch_count, False)
+        self.tags = set()
+        self.closing = False
+        self.done = Event()
+        self.proc = spawn(self._consume)
+
+    def _consume(self):
+        # callbacks are run in this greenlet
+        with self.context:
+            try:
+                it = self.backend.consume()
+                while not self.closing and it.next():
+                    pass
+            except GreenletExit:
+                log.debug("multiplexed consumer: killed")
+            except:
+                log.error("Error consuming messages: %s" % traceback.format_exc())
+
+            try:
+                if not self.backend.connection._closed:
+                    self.backend.close()
+            except:
+                log.error("error closing consumer channel: %s" % traceback.format_exc())
+        self.done.send(True)
+
+    def close(self):
+        self.closing = True
+        if getcurrent() is not self.proc and not self.proc.dead:
+            self.proc.kill()
+
+class ConsumerMultiplexer(object):
+    """
+    runs the queue subscriptions of a context over its 
+    broker connection.  each channel is consumed by a single 
+    greenlet which hands each message to the callback of the 
+    subscription it was delivered to (by consumer tag).
+
+    each subscription which acknowledges its messages gets a 
+    channel of its own: AMQP applies prefetch limits to a whole 
+    channel, and messages delivered to a cancelled consumer are 
+    only requeued when its channel is closed.  subscriptions 
+    with no_ack (the event bus) share one channel, their 
+    callbacks should not block.
+
+    event bus listeners share a single queue, which is bound 
+    to the exchange of each channel listened to.
+    """
+
+    def __init__(self, context):
+        self.context = context
+        self._channels = {}
+        self._tags = {}
+        self._event_queue = 'eb_%s' % uuid1().hex
+        self._event_tag = None
+        self._event_channels = set()
+        self._event_listeners = {}
+
+    def subscribe(self, consumer, callback, prefetch_count=None):
+        """
+        deliver messages from the queue of the carrot Consumer 
+        given to callback(message_data, message).  the consumer 
+        is only used to declare the queue and is closed.  returns 
+        a consumer tag for unsubscribe.
+        """
+        tag = '%s.%s' % (consumer.queue, uuid1().hex)
+        if consumer.no_ack:
+            group = None
+        else:
+            group = tag
+
+        chan = self._channels.get(group)
+        if chan is None or chan.closing:
+            chan = _MuxChannel(self.context, prefetch_count)
+            self._channels[group] = chan
+
+        backend = chan.backend
+        def receive(raw_message):
+            message = backend.message_to_python(raw_message)
+            callback(message.decode(), message)
+
+        queue, no_ack = consumer.queue, consumer.no_ack
+        consumer.close()
+
+        # nowait, the channel's greenlet is reading its replies
+        backend.channel.basic_consume(queue=queue, no_ack=no_ack, callback=receive,
+                                      consumer_tag=tag, nowait=True)
+        chan.tags.add(tag)
+        self._tags[tag] = (group, chan)
+        return tag
+
+    def unsubscribe(self, tag):
+        group, chan = self._tags.pop(tag, (None, None))
+        if chan is None:
+            return
+        chan.tags.discard(tag)
+        try:
+            if not chan.closing:
+                chan.backend.channel.basic_cancel(tag, nowait=True)
+        except:
+            log.error("Error cancelling consumer %s: %s" % (tag, traceback.format_exc()))
+
+        if len(chan.tags) == 0:
+            if self._channels.get(group) is chan:
+                del self._channels[group]
+            chan.close()
+
+    def wait(self, tag):
+        """
+        wait until the channel of the subscription 
+        given stops consuming.
+        """
+        group, chan = self._tags.get(tag, (None, None))
+        if chan is not None:
+            chan.done.wait()
+
+    def listen(self, channel, callback):
+        """
+        call callback(event) with each event sent 
+        to the event bus channel given.
+        """
+        if not channel in self._event_channels:
+            self._event_channels.add(channel)
+            # declares the exchange and binds the queue to it
+            consumer = EventConsumer(channel, self.context, queue=self._event_queue)
+            if self._event_tag is None:
+                self._event_tag = self.subscribe(consumer, self._dispatch_event)
+            else:
+                consumer.close()
+        self._event_listeners.setdefault(channel, []).append(callback)
+
+    def unlisten(self, channel, callback):
+        listeners = self._event_listeners.get(channel, [])
+        if callback in listeners:
+            listeners.remove(callback)
+        # AMQP 0-8 cannot unbind the queue, but the 
+        # subscription is dropped when nothing listens.
+        if self._event_tag is not None and not [l for l in self._event_listeners.values() if l]:
+            old_queue, old_tag = self._event_queue, self._event_tag
+            self._event_queue = 'eb_%s' % uuid1().hex
+            self._event_tag = None
+            self._event_channels = set()
+            self._event_listeners = {}
+            try:
+                backend = self.context.broker.create_backend()
+                backend.queue_delete(old_queue)
+                backend.close()
+            except:
+                log.error("Error deleting event queue %s: %s" % (old_queue, traceback.format_exc()))
+            # may close the channel and the context's shared resources
+            self.unsubscribe(old_tag)
+
+    def _dispatch_event(self, event, message):
+        exchange = message.delivery_info.get('exchange', '')
+        channel = exchange[len(_exchange_for_channel('')):]
+        for callback in list(self._event_listeners.get(channel, [])):
+            callback(event)
+
+    def close(self):
+        channels = self._channels.values()
+        self._channels = {}
+        self._tags = {}
+        self._event_tag = None
+        self._event_channels = set()
+        self._event_listeners = {}
+        for chan in channels:
+            chan.close()
+
+def multiplex_consumers(context):
+    """
+    whether workers consume through the context's
+    ConsumerMultiplexer, see MessageDispatch.start_worker
+    """
+    return context.config.get('messaging', {}).get('multiplex_consumers', False)
+
+def _run_subscription(make_consumer, callback, prefetch_count, context):
+    with context:
+        mux = context.consumer_multiplexer
+        tag = None
+        try:
+            tag = mux.subscribe(make_consumer(context), callback, 
+                                prefetch_count=prefetch_count)
+            mux.wait(tag)
+        except GreenletExit:
+            log.debug("subscription: killed")
+        finally:
+            if tag is not None:
+                mux.unsubscribe(tag)
+
 def _exchange_for_channel(channel):
     return 'eventbus.%s' % channel
 
@@ -67,8 +631,9 @@ class EventConsumer(Consumer):
     exclusive = True
     no_ack = True
 
-    def __init__(self, channel, context):
-        queue = 'eb_%s' % uuid1().hex
+    def __init__(self, channel, context, queue=None):
+        if queue is None:
+            queue = 'eb_%s' % uuid1().hex
         Consumer.__init__(self, context.broker,
                           exchange=_exchange_for_channel(channel),
                           queue=queue)
@@ -81,13 +646,18 @@ class EventBus(object):
     """
     def __init__(self, context):
         self.context = context
-        self._consumers = {}
-        self._procs = {}
+        self._listeners = []
 
     def send(self, channel, event):
-        pub = EventPublisher(channel, self.context)
-        pub.send(event)
-        pub.close()
+        self.send_many(channel, [event])
+
+    def send_many(self, channel, events):
+        """
+        send each of the events given to the channel specified.
+        """
+        def make_publisher():
+            return EventPublisher(channel, self.context)
+        self.context.publisher_pool.publish(('eventbus', channel), make_publisher, events)
 
     def add_listener(self, channel, callback):
         """
@@ -95,35 +665,31 @@ class EventBus(object):
         is sent to the channel specified. 
         
         callback - single argument function accepting the event.
+
+        events for all channels are received on a single queue 
+        shared by all EventBuses using the context, see 
+        ConsumerMultiplexer.
         """
-        consumer = self._consumers.get(channel)
-        if consumer is None:
-            consumer, proc = self._start_consumer(channel)
-            self._procs[channel] = proc
-        def cb(message_data, message):
+        def cb(event):
             try:
-                callback(message_data)
+                callback(event)
             except:
                 log.error("Unhandled exception in event callback for channel %s: %s" % (channel, traceback.format_exc()))
 
-        consumer.register_callback(cb)
-
-    def _start_consumer(self, channel):
-        ready = Event()
-        def make_consumer(ctx):
-            consumer = EventConsumer(channel, ctx)
-            self._consumers[channel] = consumer
-            if not ready.has_result():
-                ready.send(consumer)
-            return consumer
-        proc = spawn(consumer_loop, make_consumer, self.context)
-        consumer = ready.wait()
-        return consumer, proc
+        self.context.consumer_multiplexer.listen(channel, cb)
+        self._listeners.append((channel, cb))
 
     def kill(self):
-        for p in self._procs.values():
-            p.kill()
-        waitall(self._procs.values())
+        """
+        remove all listeners added to this EventBus.
+        """
+        listeners = self._listeners
+        self._listeners = []
+        if len(listeners) == 0:
+            return
+        mux = self.context.consumer_multiplexer
+        for channel, cb in listeners:
+            mux.unlisten(channel, cb)
 
 
 
@@ -167,12 +733,46 @@ class MessageDispatch(object):
         
         message - message to send
         type - type of message
+
+        with the setting:
+
+        messaging: {
+            confirm_dispatch: true
+        }
+
+        send does not return until the broker has accepted
+        the message, see submit.
         """
-        pub = MessageDispatchPublisher(message_type, self.context)
-        pub.send(message)
-        pub.close()
+        self.send_many([message], message_type)
+
+    def send_many(self, messages, message_type):
+        """
+        send each of the messages given to any worker 
+        queues listening to the type.
+        """
+        if confirm_dispatch(self.context):
+            pending = [self.submit(message, message_type) for message in messages]
+            for p in pending:
+                p.wait()
+            return
+
+        def make_publisher():
+            return MessageDispatchPublisher(message_type, self.context)
+        self.context.publisher_pool.publish(('dispatch', message_type), make_publisher, messages)
 
-    def start_worker(self, message_type, callback, queue=None):
+    def submit(self, message, message_type):
+        """
+        queue the message given to be sent in the next confirmed
+        batch, whether or not confirm_dispatch is set.  returns a 
+        PendingPublish, whose wait() returns once the broker has 
+        accepted the message.
+        """
+        def make_publisher():
+            return MessageDispatchPublisher(message_type, self.context)
+        return self.context.confirmed_publisher.submit(('dispatch', message_type), 
+                                                       make_publisher, message)
+
+    def start_worker(self, message_type, callback, queue=None, prefetch_count=None):
         """
         begin a worker process handling messages of the type specified.
         callback - a function accepting a job description and a message. 
@@ -190,6 +790,17 @@ class MessageDispatch(object):
         callback.
         
         Callbacks are executed on the consumer process greenlet.
+
+        If prefetch_count is given, the broker delivers at most that 
+        many unacknowledged messages to the worker at a time.
+
+        with the setting:
+
+        messaging: {
+            multiplex_consumers: true
+        }
+
+        workers are run over the context's ConsumerMultiplexer.
         """
         if queue is None:
             queue = _queue_id_for(message_type)
@@ -200,8 +811,15 @@ class MessageDispatch(object):
             except:
                 log.error("Unhandled exception handling work on queue %s (job=%s): %s" % (queue, message_data, traceback.format_exc()))
 
+        if multiplex_consumers(self.context):
+            def make_consumer(context):
+                return MessageDispatchConsumer(message_type, queue, context)
+            return spawn(_run_subscription, make_consumer, cb, prefetch_count, self.context)
+
         def create_consumer(context):
             consumer = MessageDispatchConsumer(message_type, queue, context)
+            if prefetch_count:
+                consumer.qos(prefetch_count=prefetch_count)
             consumer.register_callback(cb)
             return consumer
 
@@ -254,6 +872,10 @@ class pooled(object):
     @pooled(some_pool)
     def my_callback(md, m):
         ...
+
+    if the pool is full, the calling (consumer) greenlet 
+    blocks until a slot is free, so no further deliveries
+    are taken in the meantime.
     """
     def __init__(self, pool):
         self.pool = pool
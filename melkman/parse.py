@@ -36,14 +36,7 @@ class InvalidFeedError(Exception):
     pass
 
 def parse_feed(content, feed_url):
-    fake_headers = {
-        'content-location': feed_url,
-        'content-type': 'text/xml; charset=utf-8',
-    }
-    ff = feedparser.parse(content, header_defaults=fake_headers)
-
-    # make a clean copy composed of built-in types
-    ff = dibjectify(ff)
+    ff = dibjectify(_feedparse(content, feed_url))
 
     if ff is None or not 'feed' in ff:
         raise InvalidFeedError()
@@ -52,59 +45,154 @@ def parse_feed(content, feed_url):
     # perform some cleanup...
     #
     source_url = canonical_url(feed_url)
+    _clean_feed_info(ff.feed, source_url)
+
+    # create a structure holding the appropriate source information 
+    # from the feed.  This will be copied into each entry.
+    source_info = _source_info(ff.feed)
+
+    out_entries = []
+    for e in ff.get('entries', []):
+        if not _prepare_entry(e, source_url):
+            continue
+        e.source = deepcopy(source_info)
+        out_entries.append(e)
+
+    ff['entries'] = out_entries
+
+    return ff
+
+class StreamedEntry(object):
+    """
+    a single entry produced by StreamingFeed.iter_entries.
+    
+    details - the full (cleaned) entry
+    id - the entry's id
+    melk_id - the guid assigned to the entry
+    timestamp - the best timestamp given in the entry or None
+    fingerprint - the entry_fingerprint of the entry
+    trace - the item_trace of the entry, computed on first use
+    """
+    def __init__(self, details):
+        self.details = details
+        self.id = details['id']
+        self.melk_id = details['melk_id']
+        self.timestamp = find_best_timestamp(details)
+        self._fingerprint = None
+        self._trace = None
+
+    @property
+    def fingerprint(self):
+        if self._fingerprint is None:
+            self._fingerprint = entry_fingerprint(self.details)
+        return self._fingerprint
+
+    @property
+    def trace(self):
+        if self._trace is None:
+            self._trace = item_trace(self.details)
+        return self._trace
+
+class StreamingFeed(object):
+    """
+    The result of parse_feed_streaming.  Feed level information is 
+    available immediately as 'feed', while entries are cleaned up 
+    one at a time as they are iterated over with iter_entries.
+    
+    Unlike parse_feed, all entries share a single 'source' record, 
+    which must be treated as read-only.
+    """
+    def __init__(self, parsed, feed_url):
+        self.source_url = canonical_url(feed_url)
+        self.feed = dibjectify(parsed['feed'])
+        _clean_feed_info(self.feed, self.source_url)
+        self.source = _source_info(self.feed)
+
+        # released progressively by iter_entries
+        self._raw_entries = parsed.get('entries', [])
+
+    def iter_entries(self):
+        """
+        yields a StreamedEntry for each usable entry in the feed. 
+        The entries can only be iterated once.
+        """
+        raw_entries = self._raw_entries
+        self._raw_entries = []
+        raw_entries.reverse()
+        while raw_entries:
+            e = dibjectify(raw_entries.pop())
+            if not _prepare_entry(e, self.source_url):
+                continue
+            e.source = self.source
+            yield StreamedEntry(e)
+
+def parse_feed_streaming(content, feed_url):
+    """
+    parse the feed content given without building a full copy 
+    of the parsed document.  returns a StreamingFeed.
+    """
+    parsed = _feedparse(content, feed_url)
+    if parsed is None or not 'feed' in parsed:
+        raise InvalidFeedError()
+    return StreamingFeed(parsed, feed_url)
+
+def _feedparse(content, feed_url):
+    fake_headers = {
+        'content-location': feed_url,
+        'content-type': 'text/xml; charset=utf-8',
+    }
+    return feedparser.parse(content, header_defaults=fake_headers)
 
+def _clean_feed_info(feed, source_url):
     # make sure the feed has an id...
-    if not 'id' in ff.feed:
-        ff.feed['id'] = source_url.lower()
+    if not 'id' in feed:
+        feed['id'] = source_url.lower()
     
     # make sure the feed has a self referential link
     has_self_ref = False
-    ff.feed.setdefault('links', [])
-    for link in ff.feed.links:
+    feed.setdefault('links', [])
+    for link in feed.links:
         if link.rel == 'self':
             has_self_ref = True
             break
     if not has_self_ref:
-        ff.feed.links.append(Dibject(rel='self', href=source_url, title=''))
+        feed.links.append(Dibject(rel='self', href=source_url, title=''))
 
-    # create a structure holding the appropriate source information 
-    # from the feed.  This will be copied into each entry.
+def _source_info(feed):
     source_info = Dibject()
     for k in ['id', 'title', 'title_detail', 'link', 'links', 'icon']:
         try:
-            source_info[k] = deepcopy(ff.feed[k])
+            source_info[k] = deepcopy(feed[k])
         except KeyError:
             pass
+    return source_info
 
-    out_entries = []
-    for e in ff.get('entries', []):
-        # make sure it has an id
-        eid = e.get('id', None)
+def _prepare_entry(e, source_url):
+    """
+    assigns ids to the entry given and moves any existing 
+    source aside.  returns False if the entry is unusable.
+    """
+    # make sure it has an id
+    eid = e.get('id', None)
+    if eid is None:
+        eid = find_best_entry_id(e)
         if eid is None:
-            eid = find_best_entry_id(e)
-            if eid is None:
-                # throw this entry out, it has no 
-                # id, title, summary or content
-                # that is recognizable...
-                continue
-            e['id'] = eid
-
-        # assign a guid based on the id given and the source url
-        e['melk_id'] = melk_id(eid, source_url.lower())
-
-        # build a 'source' entry for each entry which points
-        # back to this feed. if there is already a source
-        # specified in the entry, we move it aside to 
-        # original_source.
-        if 'source' in e:
-            e['original_source'] = e.source
-        
-        e.source = deepcopy(source_info)
-        out_entries.append(e)
-
-    ff['entries'] = out_entries
-
-    return ff
+            # throw this entry out, it has no 
+            # id, title, summary or content
+            # that is recognizable...
+            return False
+        e['id'] = eid
+
+    # assign a guid based on the id given and the source url
+    e['melk_id'] = melk_id(eid, source_url.lower())
+
+    # a 'source' entry is built for each entry which points
+    # back to this feed. if there is already a source
+    # specified in the entry, we move it aside to 
+    # original_source.
+    if 'source' in e:
+        e['original_source'] = e.source
+    return True
 
 def find_best_entry_id(entry):
     if entry.has_key('id'):
@@ -146,6 +234,31 @@ def find_best_timestamp(thing, default=None):
     else:
         return default
 
+def entry_fingerprint(entry):
+    """
+    a compact digest of the id, timestamp and content of 
+    the entry given.  entries with equal fingerprints can
+    be considered unchanged.
+    """
+    timestamp = find_best_timestamp(entry)
+    if timestamp is not None:
+        timestamp = timestamp.isoformat()
+
+    parts = [entry.get('id'), timestamp, entry.get('title'), 
+             entry.get('link'), entry.get('author'), entry.get('summary')]
+    for content in entry.get('content', []):
+        parts.append(content.get('value'))
+
+    fp = md5()
+    for part in parts:
+        if part is None:
+            part = ''
+        elif isinstance(part, unicode):
+            part = part.encode('utf-8')
+        fp.update(part)
+        fp.update('\0')
+    return fp.hexdigest()
+
 def find_best_permalink(entry, default=''):
     links = entry.get('links', [])
     for link in links:
@@ -204,6 +317,8 @@ def item_trace(e):
         content = e.get('summary_detail', None)
     trace.summary = stripped_content(content, 256)
 
+    trace.fingerprint = entry_fingerprint(e)
+
     return trace
 
 def stripped_content(content, maxlen=None):
@@ -221,7 +336,7 @@ def stripped_content(content, maxlen=None):
 
     if content.type in HTML_TYPES:
         try:
-            outstr = strip_tags(content.value)
+            outstr = strip_tags(content.value, maxlen or None)
         except:
             # didn't parse, just escape it (gigo)... 
             outstr = cgi.escape(content.value)
@@ -241,32 +356,98 @@ def trimmed(text, maxlen):
     else:
         return text
 
-import HTMLParser
-class MLStripper(HTMLParser.HTMLParser):
-    def __init__(self):
-        self.reset()
-        self._text = []
-    def handle_data(self, d):
-        self._text.append(d)
-    def handle_charref(self, name):
-        self._text.append('&#%s;' % name)
-    def handle_entityref(self, name):
-        self._text.append('&%s;' % name)
-
-    @property
-    def text(self):
-        text = ''
-        for chunk in self._text:
-            if not chunk:
-                continue
-            if chunk.startswith(' '):
-                text += re.sub('^\s+', ' ', chunk)
+_MARKUP = re.compile(r"""
+      <!--.*?--\s*>                                # comment
+    | <!\[CDATA\[.*?\]\s*\]\s*>                    # marked section
+    | <!(?!--|\[CDATA\[)[^>]*>                     # declaration
+    | <\?[^>]*>                                    # processing instruction
+    | </[^>]*>                                     # end tag
+    | <(?P<tag>[a-zA-Z][^\t\n\r\f />\x00]*)        # start tag
+      (?:[^>=]|=+(?:\s*"[^"]*"|\s*'[^']*'|(?!=|\s*['"])))*>
+    | &\#(?P<charref>[0-9]+|[xX][0-9a-fA-F]+)(?:;|(?=[^0-9a-fA-F]))  # character reference
+    | &(?P<entityref>[a-zA-Z][-.a-zA-Z0-9]*)(?:;|(?=[^a-zA-Z0-9]))   # entity reference
+    | [<&]                                         # anything else
+""", re.S | re.X)
+
+_INCOMPLETE = re.compile(r'<(?:[a-zA-Z/!?]|\Z)|&(?:[a-zA-Z#]|\Z)')
+
+# the content of these is text, not markup
+_CDATA_CLOSE = {
+    'script': re.compile(r'</\s*script\s*>', re.I),
+    'style': re.compile(r'</\s*style\s*>', re.I),
+}
+
+_LEADING_SPACE = ' \t\n\r\f\v'
+
+def strip_tags(html, maxlen=None):
+    """
+    return the text in the html given with all markup removed, as
+    HTMLParser would find it.  the content of script and style 
+    elements is kept as text.  character and entity references are
+    kept (normalized to include the trailing ;) and a run of 
+    whitespace at the start of a text segment beginning with a 
+    space is collapsed to a single space.  a < or & which does not
+    start markup or a reference is a text segment of its own.
+    parsing stops at markup or a reference which is not complete 
+    and the rest is dropped.
+    
+    if maxlen is given, scanning stops once more than maxlen 
+    characters of text have been found; the result is then only 
+    a prefix of the full text, suitable for trimmed(text, maxlen).
+    """
+    out = []
+    length = 0
+    pos = 0
+    end = len(html)
+    cdata_close = None
+    while pos < end:
+        if cdata_close is not None:
+            match = cdata_close.search(html, pos)
+            if match is None:
+                break
+            chunk = html[pos:match.start()]
+            pos = match.start()
+            cdata_close = None
+            match = None
+        else:
+            match = _MARKUP.search(html, pos)
+            if match is None:
+                chunk = html[pos:]
+                pos = end
             else:
-                text += chunk
-            text.strip()
-        return text
+                chunk = html[pos:match.start()]
+                pos = match.end()
+
+        if chunk:
+            if chunk[0] == ' ':
+                chunk = ' ' + chunk.lstrip(_LEADING_SPACE)
+            out.append(chunk)
+            length += len(chunk)
+
+        if match is not None:
+            ref = None
+            if match.group('tag') is not None:
+                if not match.group().endswith('/>'):
+                    cdata_close = _CDATA_CLOSE.get(match.group('tag').lower())
+            elif match.group('charref') is not None:
+                ref = '&#%s;' % match.group('charref')
+            elif match.group('entityref') is not None:
+                ref = '&%s;' % match.group('entityref')
+            elif len(match.group()) == 1:
+                # a < or & which does not start complete markup
+                # or a reference ends the text, otherwise it is 
+                # text.
+                start = match.start()
+                if _INCOMPLETE.match(html, start):
+                    if html.startswith('&#', start) and ';' in html[start:]:
+                        out.append('&#')
+                    break
+                ref = match.group()
+            if ref is not None:
+                out.append(ref)
+                length += len(ref)
+
+        if maxlen is not None and length > maxlen:
+            break
 
-def strip_tags(html):
-    stripper = MLStripper()
-    stripper.feed(html)
-    return stripper.text
+    return ''.join(out)
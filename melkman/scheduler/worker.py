@@ -12,7 +12,7 @@ import logging
 import traceback
 
 from melkman.green import waitall, killall
-from melkman.messaging import MessageDispatch, always_ack
+from melkman.messaging import MessageDispatch, PendingPublish, always_ack, confirm_dispatch
 from melkman.scheduler.api import DeliveryOptions, DeferredAMQPMessage, view_deferred_messages_by_timestamp
 from melkman.scheduler.api import SCHEDULER_COMMAND, DEFER_MESSAGE_COMMAND, CANCEL_MESSAGE_COMMAND
 from melkman.worker import IWorkerProcess
@@ -256,35 +256,68 @@ class ScheduledMessageService(object):
             if len(batch) == 0:
                 break
             
-            dispatch_count = 0
+            # publish the whole batch before waiting on any of it
+            pending = []
             for message in batch:
                 try:
-                    if self._dispatch_message(message):
-                        dispatch_count += 1
+                    p = self._submit_message(message)
+                    if p is not None:
+                        pending.append((message, p))
                 except GreenletExit:
                     # asked to stop, go ahead and quit.
                     raise
                 except:
                     log.error("Unexected error dispatching message %s: %s" %
                               (message, traceback.format_exc()))
+
+            dispatch_count = 0
+            for message, p in pending:
+                try:
+                    if self._finish_dispatch(message, p):
+                        dispatch_count += 1
+                except GreenletExit:
+                    raise
+                except:
+                    log.error("Unexected error dispatching message %s: %s" %
+                              (message, traceback.format_exc()))
                     
             log.info("Dispatched %d messages" % dispatch_count)
             
         return now
 
-    def _dispatch_message(self, message):
+    def _submit_message(self, message):
+        """
+        claims and publishes the message given, returns a
+        PendingPublish or None if it was not published.
+        if messaging.confirm_dispatch is set, the message is 
+        confirmed by the broker before it is removed.
+        """
         if not message.claim(self.context.db):
-            return
+            return None
         
         try:
-            publisher = Publisher(self.context.broker, exchange=message.options.exchange,
-                                  exchange_type=message.options.exchange_type)
-            publisher.send(message.message,
-                           routing_key = message.options.routing_key,
-                           delivery_mode = message.options.delivery_mode,
-                           mandatory = message.options.mandatory,
-                           priority = message.options.priority)
-            publisher.close()
+            options = message.options
+            def make_publisher():
+                return Publisher(self.context.broker, exchange=options.exchange,
+                                 exchange_type=options.exchange_type)
+            key = ('exchange', options.exchange, options.exchange_type)
+            kw = dict(routing_key = options.routing_key,
+                      delivery_mode = options.delivery_mode,
+                      mandatory = options.mandatory,
+                      priority = options.priority)
+            if confirm_dispatch(self.context):
+                return self.context.confirmed_publisher.submit(key, make_publisher, 
+                                                               message.message, **kw)
+            self.context.publisher_pool.publish(key, make_publisher, [message.message], **kw)
+            return PendingPublish.sent(message.message)
+        except:
+            log.error("Error dispatching deferred message %s: %s" % (message, traceback.format_exc()))
+            self.error_reschedule(message)
+            return None
+
+    def _finish_dispatch(self, message, pending):
+        try:
+            pending.wait()
         except:
             log.error("Error dispatching deferred message %s: %s" % (message, traceback.format_exc()))
             self.error_reschedule(message)
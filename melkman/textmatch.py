@@ -0,0 +1,166 @@
+# Copyright (C) 2009 The Open Planning Project
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the
+# Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor,
+# Boston, MA  02110-1301
+# USA
+
+"""
+matching of text against large lists of keywords.
+"""
+
+__all__ = ['KeywordMatcher', 'AhoCorasick']
+
+# with fewer keywords than this, testing each keyword with 'in'
+# beats walking the automaton in python.
+SMALL_KEYWORD_COUNT = 16
+
+class AhoCorasick(object):
+    """
+    Aho-Corasick automaton over a fixed set of keywords,
+    answers whether any keyword occurs in a text in time
+    linear in the length of the text regardless of the
+    number of keywords.
+
+    >>> ac = AhoCorasick(['he', 'she', 'hers'])
+    >>> ac.search('ushers')
+    True
+    >>> ac.search('shoe')
+    False
+    """
+
+    def __init__(self, keywords):
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [False]
+
+        for keyword in keywords:
+            self._add(keyword)
+        self._link()
+
+    def search(self, text):
+        goto = self._goto
+        fail = self._fail
+        out = self._out
+
+        if out[0]:
+            return True
+
+        state = 0
+        for ch in text:
+            nxt = goto[state].get(ch)
+            while nxt is None and state != 0:
+                state = fail[state]
+                nxt = goto[state].get(ch)
+            if nxt is not None:
+                state = nxt
+                if out[state]:
+                    return True
+        return False
+
+    def _add(self, keyword):
+        state = 0
+        for ch in keyword:
+            nxt = self._goto[state].get(ch)
+            if nxt is None:
+                nxt = len(self._goto)
+                self._goto.append({})
+                self._fail.append(0)
+                self._out.append(False)
+                self._goto[state][ch] = nxt
+            state = nxt
+        self._out[state] = True
+
+    def _link(self):
+        # breadth first, so the failure state of each
+        # state's parent is already known.
+        queue = list(self._goto[0].values())
+        i = 0
+        while i < len(queue):
+            state = queue[i]
+            i += 1
+            for ch, nxt in self._goto[state].items():
+                queue.append(nxt)
+                f = self._fail[state]
+                while f != 0 and ch not in self._goto[f]:
+                    f = self._fail[f]
+                f = self._goto[f].get(ch, 0)
+                if f == nxt:
+                    f = 0
+                self._fail[nxt] = f
+                if self._out[f]:
+                    self._out[nxt] = True
+
+class KeywordMatcher(object):
+    """
+    tests whether a text matches any of a list of keywords.
+
+    match_type 'exact' matches text equal to a keyword,
+    'substring' matches text containing a keyword. unless
+    case_sensitive is True, keywords and text are compared
+    in lower case.
+
+    as with the regular expressions '^keyword$' in multiline mode,
+    an exact keyword also matches when it is followed by a newline.
+
+    >>> m = KeywordMatcher(['Foo', 'bar'], 'substring')
+    >>> m.match('a FOOL')
+    True
+    >>> m.match('baz')
+    False
+    """
+
+    def __init__(self, keywords, match_type='exact', case_sensitive=False):
+        self.match_type = match_type
+        self.case_sensitive = case_sensitive
+
+        keywords = [self._norm(k) for k in keywords]
+        if match_type == 'exact':
+            self._keywords = set(keywords)
+            self._match = self._match_exact
+        elif match_type == 'substring':
+            if len(keywords) < SMALL_KEYWORD_COUNT:
+                self._keywords = keywords
+                self._match = self._match_few
+            else:
+                self._automaton = AhoCorasick(keywords)
+                self._match = self._automaton.search
+        else:
+            raise ValueError("unsupported match type: %s" % match_type)
+
+    def match(self, text):
+        return self._match(self._norm(text))
+
+    def _norm(self, text):
+        if self.case_sensitive:
+            return text
+        return text.lower()
+
+    def _match_exact(self, text):
+        keywords = self._keywords
+        if text in keywords:
+            return True
+        end = text.find('\n')
+        while end >= 0:
+            if text[:end] in keywords:
+                return True
+            end = text.find('\n', end + 1)
+        return False
+
+    def _match_few(self, text):
+        for keyword in self._keywords:
+            if keyword in text:
+                return True
+        return False
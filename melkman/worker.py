@@ -12,4 +12,24 @@ class IWorkerProcess(ExtensionInterface):
         run the background process in the context given.  
         This function should not return unless the background process is complete.
         """
-    
\ No newline at end of file
+    
+
+DEFAULT_POOL_SIZE = 50
+
+def pool_settings(context, worker_type):
+    """
+    returns the (pool_size, prefetch_count) configured for the 
+    worker type given, eg for worker_type 'aggregator':
+    
+    aggregator: {
+        pool_size: 50,
+        prefetch_count: 50
+    }
+    
+    the prefetch count defaults to the pool size so that a worker
+    holds no more unacknowledged messages than it can work on.
+    """
+    cfg = context.config.get(worker_type, {})
+    pool_size = int(cfg.get('pool_size', DEFAULT_POOL_SIZE))
+    prefetch_count = int(cfg.get('prefetch_count', pool_size))
+    return pool_size, prefetch_count
@@ -58,6 +58,7 @@ setup(
     aggregator_worker = melkman.aggregator.worker
     filters = melkman.filters
     pubsub = melkman.fetch.pubsubhubbub
+    claimcheck = melkman.claimcheck
     
     [console_scripts]
     melkman=melkman.runner:main
@@ -0,0 +1,63 @@
+"""
+compares the running time of BaseMatchFilter keyword matching
+with the single regular expression alternation it replaced, 
+for lists of 10, 100 and 10000 values.
+
+    python bench_match.py [repeat]
+"""
+from helpers import *
+
+import random
+import re
+import sys
+import time
+
+from melkman.textmatch import KeywordMatcher
+
+def old_pattern(values, match_type):
+    def rescape_char(match):
+        return '\%s' % match.group(0)
+    def rescape(val):
+        return re.sub(r'[\.\^\$\*\+\?\{\}\\\[\]\|\(\)]', rescape_char, val)
+    
+    if match_type == 'exact':
+        pat_str = '|'.join(['^%s$' % rescape(val) for val in values])
+    else:
+        pat_str = '|'.join(['^.*?%s.*?$' % rescape(val) for val in values])
+    return re.compile(pat_str, re.M|re.S|re.I)
+
+def random_word():
+    return ''.join([random.choice('abcdefghijklmnopqrstuvwxyz') 
+                    for i in range(random.randint(4, 10))])
+
+def bench(match, texts, repeat):
+    start = time.time()
+    for i in range(repeat):
+        for text in texts:
+            match(text)
+    return time.time() - start
+
+if __name__ == '__main__':
+    repeat = 3
+    if len(sys.argv) > 1:
+        repeat = int(sys.argv[1])
+
+    random.seed(0)
+    keywords = [random_word() for i in range(10000)]
+    vocabulary = [random_word() for i in range(10000)] + keywords[:10]
+    texts = [' '.join([random.choice(vocabulary) for i in range(12)]) 
+             for j in range(500)]
+
+    print "%d texts, %d repetitions" % (len(texts), repeat)
+    for count in (10, 100, 10000):
+        values = keywords[:count]
+        for match_type in ('exact', 'substring'):
+            pat = old_pattern(values, match_type)
+            matcher = KeywordMatcher(values, match_type)
+            for text in texts:
+                assert (pat.match(text) is not None) == matcher.match(text)
+
+            old_time = bench(pat.match, texts, repeat)
+            new_time = bench(matcher.match, texts, repeat)
+            print "%5d values %-9s: regex %0.3fs, KeywordMatcher %0.3fs (%0.1fx)" % (
+                count, match_type, old_time, new_time, old_time / max(new_time, 1e-6))
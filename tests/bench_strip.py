@@ -0,0 +1,86 @@
+"""
+compares the running time of melkman.parse.strip_tags with 
+the HTMLParser based implementation it replaced, using the 
+feeds in tests/data and some generated long content.
+
+    python bench_strip.py [repeat]
+"""
+from helpers import *
+
+import HTMLParser
+import glob
+import os
+import re
+import sys
+import time
+
+from melkman.parse import parse_feed, strip_tags, trimmed
+
+class MLStripper(HTMLParser.HTMLParser):
+    def __init__(self):
+        self.reset()
+        self._text = []
+    def handle_data(self, d):
+        self._text.append(d)
+    def handle_charref(self, name):
+        self._text.append('&#%s;' % name)
+    def handle_entityref(self, name):
+        self._text.append('&%s;' % name)
+
+    @property
+    def text(self):
+        text = ''
+        for chunk in self._text:
+            if not chunk:
+                continue
+            if chunk.startswith(' '):
+                text += re.sub('^\s+', ' ', chunk)
+            else:
+                text += chunk
+            text.strip()
+        return text
+
+def old_strip_tags(html, maxlen=None):
+    stripper = MLStripper()
+    stripper.feed(html)
+    return stripper.text
+
+def sample_documents():
+    docs = []
+    for filename in glob.glob(os.path.join(data_path(), 'www', '*.xml')):
+        url = 'file://%s' % filename
+        fp = parse_feed(open(filename).read(), url)
+        for e in fp.entries:
+            for field in ('title', 'summary'):
+                if field in e:
+                    docs.append(e[field])
+            for content in e.get('content', []):
+                docs.append(content.value)
+
+    paragraph = ('<p>Some <b>bold</b> text &amp; a <a href="http://example.org/?a=1&amp;b=2">link</a>'
+                 '<br/>   and some more text&#8230;</p>\n')
+    for n in (10, 100, 1000, 5000):
+        docs.append(paragraph * n)
+    return docs
+
+def bench(strip, docs, repeat, maxlen=None):
+    start = time.time()
+    for i in range(repeat):
+        for doc in docs:
+            trimmed(strip(doc, maxlen), maxlen or len(doc) + 1)
+    return time.time() - start
+
+if __name__ == '__main__':
+    repeat = 3
+    if len(sys.argv) > 1:
+        repeat = int(sys.argv[1])
+
+    docs = sample_documents()
+    for doc in docs:
+        assert strip_tags(doc) == old_strip_tags(doc)
+
+    print "%d documents, %d characters, %d repetitions" % (len(docs), sum([len(d) for d in docs]), repeat)
+    for maxlen in (None, 256):
+        old_time = bench(old_strip_tags, docs, repeat, maxlen)
+        new_time = bench(strip_tags, docs, repeat, maxlen)
+        print "maxlen=%s: HTMLParser %0.3fs, strip_tags %0.3fs (%0.1fx)" % (maxlen, old_time, new_time, old_time / max(new_time, 1e-6))
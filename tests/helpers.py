@@ -125,7 +125,7 @@ def make_atom_entry(id, title='This is the title',
 
 class DummyItem(Dibject):
 
-    def load_full_item(self, db):
+    def load_full_item(self):
         return self
         
 def dummy_news_item(d):
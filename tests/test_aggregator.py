@@ -162,3 +162,280 @@ def test_init_subscription(ctx):
     agg.kill()
     agg.wait()
     
+
+@contextual
+def test_subscriber_index(ctx):
+    from melkman.aggregator.index import SubscriberIndex
+    from melkman.db.bucket import NewsBucket
+    from melkman.db.composite import Composite
+
+    bucket = NewsBucket.create(ctx)
+    bucket.save()
+
+    index = SubscriberIndex(ctx)
+    assert index.subscribers(bucket.id) == []
+
+    composites = []
+    for i in range(3):
+        comp = Composite.create(ctx)
+        comp.subscribe(bucket)
+        comp.save()
+        composites.append(comp)
+
+    # still cached
+    assert index.subscribers(bucket.id) == []
+    assert index.hits == 1
+
+    index.invalidate([bucket.id])
+    assert sorted(index.subscribers(bucket.id)) == sorted([c.id for c in composites])
+
+    # the least recently used bucket is forgotten first
+    index = SubscriberIndex(ctx, max_buckets=2)
+    index.subscribers('b1')
+    index.subscribers('b2')
+    index.subscribers('b1')
+    index.subscribers('b3')
+    assert index.evictions == 1
+    hits = index.hits
+    index.subscribers('b1')
+    assert index.hits == hits + 1
+    index.subscribers('b2')
+    assert index.hits == hits + 1
+
+@contextual
+def test_fanout_to_many_composites(ctx):
+    _check_fanout_to_many_composites(ctx)
+
+def test_batched_fanout():
+    from melkman.context import Context
+    ctx = Context.from_dict({'aggregator': {'batched_fanout': True, 'fanout_batch_size': 10}},
+                            defaults=Context.from_yaml(test_yaml_file()).config)
+    ctx.bootstrap(purge=True)
+    with ctx:
+        _check_fanout_to_many_composites(ctx)
+    assert ctx._broker is None
+
+def _check_fanout_to_many_composites(ctx):
+    from eventlet import sleep, spawn
+    from melkman.aggregator.worker import run_aggregator
+    from melkman.db.bucket import NewsBucket
+    from melkman.db.composite import Composite
+
+    agg = spawn(run_aggregator, ctx)
+
+    bucket = NewsBucket.create(ctx)
+    bucket.save()
+
+    composites = []
+    for i in range(25):
+        comp = Composite.create(ctx)
+        comp.subscribe(bucket)
+        comp.save()
+        composites.append(comp)
+    sleep(.5)
+    
+    item_id = random_id()
+    bucket.add_news_item(item_id)
+    bucket.save()
+    sleep(1)
+
+    for comp in composites:
+        comp.reload()
+        assert comp.has_news_item(item_id)
+
+    agg.kill()
+    agg.wait()
+
+@contextual
+def test_coalesced_updates(ctx):
+    from datetime import datetime, timedelta
+    from melkman.aggregator.worker import UpdateCoalescer
+    from melkman.db.bucket import NewsBucket, NewsItemRef
+    from melkman.db.composite import Composite
+
+    b1 = NewsBucket.create(ctx)
+    b1.save()
+    b2 = NewsBucket.create(ctx)
+    b2.save()
+    comp = Composite.create(ctx)
+    comp.subscribe(b1)
+    comp.subscribe(b2)
+    comp.save()
+
+    shared_id = random_id()
+    now = datetime.utcnow()
+    old_ref = NewsItemRef.create_from_info(ctx, b1.id, item_id=shared_id,
+                                           title='old', timestamp=now - timedelta(hours=1))
+    new_ref = NewsItemRef.create_from_info(ctx, b2.id, item_id=shared_id,
+                                           title='new', timestamp=now)
+    other_ref = NewsItemRef.create_from_info(ctx, b1.id, item_id=random_id(), timestamp=now)
+
+    coalescer = UpdateCoalescer(ctx, window=0.1)
+    p1 = coalescer.update(comp.id, b2.id, [new_ref])
+    p2 = coalescer.update(comp.id, b1.id, [old_ref, other_ref])
+    # both updates are applied together
+    assert p1 is p2
+    assert p1.wait()
+
+    comp.reload()
+    assert comp.has_news_item(shared_id)
+    assert comp.has_news_item(other_ref.item_id)
+    assert comp.entries[shared_id].title == 'new'
+
+@contextual
+def test_coalesced_update_failed(ctx):
+    from melkman.aggregator.worker import UpdateCoalescer
+    from melkman.db.composite import Composite
+
+    class BrokenCache(object):
+        def lock(self, composite_id):
+            raise RuntimeError('broken')
+
+    comp = Composite.create(ctx)
+    comp.save()
+
+    coalescer = UpdateCoalescer(ctx, window=0.01, cache=BrokenCache())
+    pending = coalescer.update(comp.id, random_id(), [])
+    assert not pending.wait()
+
+def test_assign_partitions():
+    from melkman.aggregator.partition import assign_partitions, partition_for
+
+    members = ['m%d' % i for i in range(4)]
+    before = assign_partitions(members, 64)
+    owned = []
+    for m in members:
+        owned += before[m]
+    # every partition has exactly one owner
+    assert sorted(owned) == range(64)
+
+    # a new member only takes partitions, others keep the rest
+    after = assign_partitions(members + ['m4'], 64)
+    assert len(after['m4']) > 0
+    for m in members:
+        assert set(after[m]).issubset(set(before[m]))
+
+    # a composite always maps to the same partition
+    cid = random_id()
+    assert partition_for(cid, 64) == partition_for(cid, 64)
+    assert 0 <= partition_for(cid, 64) < 64
+
+@contextual
+def test_composite_cache(ctx):
+    from melkman.aggregator.cache import CompositeCache
+    from melkman.db.composite import Composite
+
+    comp = Composite.create(ctx)
+    comp.save()
+
+    cache = CompositeCache(ctx, max_composites=2)
+    c1 = cache.get(comp.id)
+    assert cache.misses == 1
+    assert cache.get(comp.id) is c1
+    assert cache.hits == 1
+
+    # saving through the cache keeps the copy valid
+    c1.add_news_item(random_id())
+    cache.save(c1)
+    assert cache.get(comp.id) is c1
+    assert cache.hits == 2
+
+    # changes made elsewhere are noticed
+    other = Composite.get(comp.id, ctx)
+    other.add_news_item(random_id())
+    other.save()
+    c2 = cache.get(comp.id)
+    assert c2 is not c1
+    assert cache.stale == 1
+    assert len(c2.entries) == 2
+
+    # bounded
+    for i in range(3):
+        comp = Composite.create(ctx)
+        comp.save()
+        cache.get(comp.id)
+    assert len(cache._composites) == 2
+    assert cache.evictions == 2
+
+@contextual
+def test_composite_cache_write_back(ctx):
+    from eventlet import sleep
+    from melkman.aggregator.cache import CompositeCache
+    from melkman.db.composite import Composite
+
+    comp = Composite.create(ctx)
+    comp.save()
+
+    cache = CompositeCache(ctx, write_back=0.2)
+    c1 = cache.get(comp.id)
+    item_id = random_id()
+    c1.add_news_item(item_id)
+    cache.save(c1)
+
+    comp.reload()
+    assert not comp.has_news_item(item_id)
+
+    sleep(0.5)
+    comp.reload()
+    assert comp.has_news_item(item_id)
+    assert cache.get(comp.id) is c1
+
+@contextual
+def test_composite_cache_locked_not_evicted(ctx):
+    from melkman.aggregator.cache import CompositeCache
+    from melkman.db.composite import Composite
+
+    comps = []
+    for i in range(3):
+        comp = Composite.create(ctx)
+        comp.save()
+        comps.append(comp)
+
+    cache = CompositeCache(ctx, max_composites=2)
+    c0 = cache.get(comps[0].id)
+    cache.get(comps[1].id)
+
+    # the least recently used is being updated, the other goes
+    cache.lock(c0.id)
+    try:
+        cache.get(comps[2].id)
+        assert cache.get(c0.id) is c0
+        assert cache.stats()['evictions'] == 1
+    finally:
+        cache.unlock(c0.id)
+
+@contextual
+def test_init_many_subscriptions(ctx):
+    from eventlet import sleep, spawn
+    from melkman.aggregator.worker import run_aggregator
+    from melkman.db.bucket import NewsBucket
+    from melkman.db.composite import Composite
+
+    agg = spawn(run_aggregator, ctx)
+
+    c = Composite.create(ctx)
+    c.save()
+
+    entries = []
+    buckets = []
+    for i in range(20):
+        bucket = NewsBucket.create(ctx)
+        for j in range(3):
+            eid = random_id()
+            entries.append(eid)
+            bucket.add_news_item(eid)
+        bucket.save()
+        buckets.append(bucket)
+    sleep(.5)
+
+    for bucket in buckets:
+        c.subscribe(bucket)
+    c.save()
+    sleep(1)
+
+    c.reload()
+    for eid in entries:
+        assert c.has_news_item(eid)
+
+    agg.kill()
+    agg.wait()
@@ -381,6 +381,45 @@ def test_bucket_maxlen(ctx):
     bucket = check_before_and_after_save(bucket)
     
 
+@contextual
+def test_partial_entries_trimmed_on_save(ctx):
+    from melkman.db.bucket import NewsBucket
+
+    bucket = NewsBucket.create(ctx, maxlen=2)
+    now = datetime.utcnow()
+    for i in range(2):
+        bucket.add_news_item({'item_id': random_id(), 'timestamp': now - timedelta(hours=i)})
+    bucket.save()
+
+    events = []
+    bucket = NewsBucket.get(bucket.id, ctx)
+    bucket._send_modified_event = lambda **kw: events.append(kw)
+    old_id = random_id()
+    # only loads the entry looked up
+    bucket.lookup_entries([old_id])
+    bucket.add_news_item({'item_id': old_id, 'timestamp': now - timedelta(days=1)})
+    bucket.save()
+
+    # too old to keep, so it is only reported removed
+    assert len(events) == 1
+    assert not 'updated_items' in events[0]
+    assert [x['item_id'] for x in events[0]['removed_items']] == [old_id]
+
+@contextual
+def test_lookup_entries_after_reload(ctx):
+    from melkman.db.bucket import NewsBucket
+
+    bucket = NewsBucket.create(ctx)
+    item_id = random_id()
+    bucket.add_news_item(item_id)
+    bucket.save()
+
+    bucket = NewsBucket.get(bucket.id, ctx)
+    assert item_id in bucket.lookup_entries([item_id])
+    bucket.reload()
+    # looked up again, not remembered as checked
+    assert item_id in bucket.lookup_entries([item_id])
+
 @contextual
 def test_direct_entries_access(ctx):
     from melkman.db.bucket import NewsBucket, NewsItemRef
@@ -438,4 +477,26 @@ def test_direct_entries_access(ctx):
     bucket.save()
     bucket.reload()
     assert len(bucket.entries) == 1
-    
\ No newline at end of file
+    
+@contextual
+def test_prefetch_full_items(ctx):
+    from melkman.db.bucket import NewsItem, NewsItemRef, prefetch_full_items
+
+    items = []
+    for i in range(3):
+        item = NewsItem.create(ctx, random_id(), title='item %d' % i)
+        item.save()
+        items.append(item)
+
+    refs = [NewsItemRef.create_from_info(ctx, random_id(), item_id=item.item_id)
+            for item in items]
+    missing = NewsItemRef.create_from_info(ctx, random_id(), item_id=random_id())
+    refs.append(missing)
+
+    prefetch_full_items(refs, ctx)
+    for ref in refs:
+        assert ref._full_item_loaded
+
+    for item, ref in zip(items, refs):
+        assert ref.load_full_item().title == item.title
+    assert missing.load_full_item() is None
@@ -0,0 +1,81 @@
+from helpers import *
+
+def claim_context(**settings):
+    from melkman.context import Context
+    settings.setdefault('claim_check_threshold', 100)
+    ctx = Context.from_dict({'messaging': settings},
+                            defaults=Context.from_yaml(test_yaml_file()).config)
+    ctx.bootstrap(purge=True)
+    return ctx
+
+def test_claim_check_couchdb():
+    from melkman.claimcheck import check_in, claimed, has_claimed, release_claims, CLAIMS
+
+    ctx = claim_context(claim_check_store='couchdb')
+    with ctx:
+        big = 'x' * 1000
+        message = check_in({'url': 'http://example.org', 'content': big, 'small': 'y'},
+                           ['content', 'small'], ctx)
+        assert not 'content' in message
+        assert message['small'] == 'y'
+        assert has_claimed(message, 'content')
+        key = message[CLAIMS]['content']
+
+        # the same content is stored once and counted twice
+        other = check_in({'content': big}, ['content'], ctx)
+        assert other[CLAIMS]['content'] == key
+
+        assert claimed(message, 'content', ctx) == big
+        assert claimed(message, 'missing', ctx, 'default') == 'default'
+
+        release_claims(message, ctx)
+        assert claimed(other, 'content', ctx) == big
+        release_claims(other, ctx)
+        assert ctx.db.get('claim_check:%s' % key) is None
+
+def test_claim_check_filesystem():
+    import os, shutil, tempfile, time
+    from melkman.claimcheck import check_in, claimed, claim_store, CLAIMS
+
+    path = tempfile.mkdtemp()
+    try:
+        ctx = claim_context(claim_check_store='filesystem',
+                            claim_check_path=path,
+                            claim_check_ttl=60)
+        with ctx:
+            items = [{'item_id': str(i), 'title': 'item %d' % i} for i in range(20)]
+            message = check_in({'updated_items': items}, ['updated_items'], ctx)
+            assert not 'updated_items' in message
+
+            # loaded as if it had been sent in the message
+            received = {CLAIMS: dict(message[CLAIMS])}
+            assert claimed(received, 'updated_items', ctx) == items
+
+            store = claim_store(ctx)
+            assert store.reclaim() == 0
+            key = message[CLAIMS]['updated_items']
+            old = time.time() - 120
+            os.utime(os.path.join(path, key), (old, old))
+            assert store.reclaim() == 1
+            assert store.get(key) is None
+    finally:
+        shutil.rmtree(path)
+
+def test_claim_check_read_when_off():
+    from melkman.context import Context
+    from melkman.claimcheck import check_in, claimed, release_claims
+
+    ctx = claim_context(claim_check_store='couchdb')
+    # a worker with claim checks turned off, sharing the database
+    off = Context.from_dict({'messaging': {'claim_check_threshold': 0}},
+                            defaults=Context.from_yaml(test_yaml_file()).config)
+    with ctx:
+        big = 'x' * 1000
+        message = check_in({'content': big}, ['content'], ctx)
+        assert not 'content' in message
+    with off:
+        # nothing is checked in
+        assert check_in({'content': big}, ['content'], off)['content'] == big
+        # but messages in flight can still be read
+        assert claimed(message, 'content', off) == big
+        release_claims(message, off)
@@ -133,3 +133,44 @@ def test_composite_filtered_update(ctx):
         assert not cc.has_news_item(item)
     
     
+
+@contextual
+def test_resumable_backfill(ctx):
+    import time
+    from melkman.db import NewsBucket, Composite
+
+    bucket = NewsBucket.create(ctx)
+    item_ids = []
+    for i in range(25):
+        item_id = random_id()
+        bucket.add_news_item(item_id)
+        item_ids.append(item_id)
+    bucket.save()
+
+    cc = Composite.create(ctx)
+    cc.subscribe(bucket)
+    cc.save()
+
+    # with no time left, one page is read at a time
+    calls = 0
+    done = False
+    while not done:
+        done, updates = cc.backfill_subscription(bucket.id, depth=20, page_size=5, 
+                                                 deadline=time.time() - 1)
+        calls += 1
+        if not done:
+            assert bucket.id in cc.backfill_progress
+            # progress survives a save and reload
+            cc.save()
+            cc.reload()
+    assert calls == 4
+    assert not bucket.id in cc.backfill_progress
+
+    cc.save()
+    cc.reload()
+    assert len(cc.entries) == 20
+
+    # more than 50 items when asked
+    cc2 = Composite.create(ctx)
+    cc2.subscribe(bucket)
+    assert cc2.init_subscription(bucket.id, depth=100, page_size=10) == 25
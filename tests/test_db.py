@@ -456,3 +456,30 @@ class MappingFieldTestCase(unittest.TestCase):
 # if __name__ == '__main__':
 #     unittest.main(defaultTest='suite')
 
+
+@contextual
+def test_bulk_writer(ctx):
+    from eventlet import spawn
+    from melkman.db.bulk import BulkWriter
+
+    writer = BulkWriter(ctx, max_docs=100, max_delay=0.1)
+
+    def write(i):
+        with ctx:
+            return writer.update([{'_id': 'bulk_%d_%d' % (i, j), 'i': i} for j in range(3)])
+
+    procs = [spawn(write, i) for i in range(5)]
+    for i, proc in enumerate(procs):
+        results = proc.wait()
+        assert len(results) == 3
+        for j, (ok, docid, rev) in enumerate(results):
+            assert ok
+            assert docid == 'bulk_%d_%d' % (i, j)
+            assert ctx.db[docid]['i'] == i
+
+    # conflicts are reported unless resolution is requested
+    results = writer.update([{'_id': 'bulk_0_0', 'i': 10}])
+    assert results[0][0] == False
+    results = writer.update([{'_id': 'bulk_0_0', 'i': 10}], resolve_conflicts=True)
+    assert results[0][0] == True
+    assert ctx.db['bulk_0_0']['i'] == 10
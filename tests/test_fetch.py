@@ -114,3 +114,56 @@ def test_push_index(ctx):
         indexer.kill()
         indexer.wait()
         
+
+def test_host_throttle():
+    from melkman.fetch.worker import HostThrottle
+
+    throttle = HostThrottle(max_concurrent=1, min_interval=0, saturated_delay=120)
+    url1 = 'http://example.org/feed1'
+    url2 = 'http://example.org/feed2'
+    other = 'http://example.com/feed'
+
+    assert throttle.admit(url1) == True
+    # other hosts are unaffected
+    assert throttle.admit(other) == True
+
+    # a second fetch of the same host is put off, not held
+    assert throttle.admit(url2) == False
+    assert throttle.defer_delay(url2) == 120
+    assert throttle.stats()['example.org']['deferred'] == 1
+
+    throttle.release(url1)
+    assert throttle.admit(url2) == True
+    throttle.release(url2)
+    throttle.release(other)
+
+    stats = throttle.stats()['example.org']
+    assert stats['active'] == 0
+    assert stats['admitted'] == 2
+
+def test_host_throttle_interval():
+    import time
+    from melkman.fetch.worker import HostThrottle
+
+    throttle = HostThrottle(max_concurrent=5, min_interval=10)
+    url = 'http://example.org/feed'
+
+    assert throttle.admit(url) == True
+    throttle.release(url)
+    assert throttle.admit(url) == False
+
+    # successive deferred fetches get successive start slots
+    first = throttle.defer_delay(url)
+    second = throttle.defer_delay(url)
+    assert 9 < first <= 10
+    assert 19 < second <= 20
+
+    stats = throttle.stats()['example.org']
+    assert stats['waiting'] == 2
+    assert 19 < stats['max_delay'] <= 20
+
+    # deferred fetches coming back are counted with their wait
+    throttle.returned(url, time.time() - 15)
+    stats = throttle.stats()['example.org']
+    assert stats['waiting'] == 1
+    assert 14 < stats['max_wait'] < 20
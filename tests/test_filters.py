@@ -289,3 +289,302 @@ def test_content_filter(ctx):
     assert not filt(dummy_news_item({'details': {'summary': '', 'summary_detail': content_field}}))
 
 
+
+@contextual
+def test_filter_needs_full_item(ctx):
+    from melk.util.dibject import dibjectify
+    from melkman.filters import NewsItemFilterFactory, needs_full_item
+
+    filter_factory = NewsItemFilterFactory(ctx.component_manager)
+
+    # filters that only look at the item ref
+    chain = [
+        {'op': 'match_author',
+         'config': {'values': ['fred']},
+         'action': 'reject'},
+        {'op': 'match_title',
+         'config': {'values': ['foo']},
+         'negative': True,
+         'action': 'reject'},
+        {'op': 'match_all',
+         'config': {},
+         'action': 'accept'}
+    ]
+    chain = filter_factory.create_chain([dibjectify(x) for x in chain])
+    assert not chain.needs_full_item
+
+    # any filter needing the full item taints the chain
+    chain = [
+        {'op': 'or',
+         'config': {
+            'filters': [
+                {'op': 'match_author',
+                 'config': {'values': ['barney']}},
+                {'op': 'match_tag',
+                 'config': {'values': ['bar']}}]},
+         'action': 'accept'}
+    ]
+    chain = filter_factory.create_chain([dibjectify(x) for x in chain])
+    assert chain.needs_full_item
+
+    # undeclared filters are assumed to need the full item
+    assert needs_full_item(lambda item: True)
+
+@contextual
+def test_cached_chain(ctx):
+    from melk.util.dibject import dibjectify
+    from melkman.filters import NewsItemFilterFactory, ACCEPT_ITEM, REJECT_ITEM
+
+    filter_factory = NewsItemFilterFactory(ctx.component_manager)
+    cache = filter_factory.chain_cache
+    cache.clear()
+    
+    chain_cfg = [dibjectify({'op': 'match_author',
+                             'config': {'values': ['fred']},
+                             'action': 'reject'})]
+    hits = cache.hits
+    misses = cache.misses
+
+    chain = filter_factory.cached_chain('composite1', chain_cfg)
+    assert chain(dummy_news_item({'author': 'fred'})) == REJECT_ITEM
+    assert cache.misses == misses + 1
+
+    # same configuration reuses the compiled chain
+    assert filter_factory.cached_chain('composite1', chain_cfg) is chain
+    assert cache.hits == hits + 1
+
+    # a changed configuration replaces it
+    chain_cfg[0].config['values'] = ['barney']
+    chain2 = filter_factory.cached_chain('composite1', chain_cfg)
+    assert chain2 is not chain
+    assert chain2(dummy_news_item({'author': 'fred'})) == ACCEPT_ITEM
+    assert chain2(dummy_news_item({'author': 'barney'})) == REJECT_ITEM
+    assert len(cache) == 1
+
+@contextual
+def test_cached_chain_shared(ctx):
+    from eventlet import spawn
+    from melk.util.dibject import dibjectify
+    from melkman.filters import NewsItemFilterFactory
+
+    chain_cfg = [dibjectify({'op': 'match_author',
+                             'config': {'values': ['fred']},
+                             'action': 'reject'})]
+    cache = ctx.filter_chain_cache
+    cache.clear()
+
+    def compile_chain():
+        # each greenlet gets its own components
+        with ctx:
+            filter_factory = NewsItemFilterFactory(ctx.component_manager)
+            return filter_factory.cached_chain('composite1', chain_cfg)
+
+    hits = cache.hits
+    chain = spawn(compile_chain).wait()
+    assert spawn(compile_chain).wait() is chain
+    assert cache.hits == hits + 1
+
+@contextual
+def test_uncached_chain_optimized(ctx):
+    from melk.util.dibject import dibjectify
+    from melkman.filters import NewsItemFilterFactory, AuthorFilter
+
+    filter_factory = NewsItemFilterFactory(ctx.component_manager)
+    cache = filter_factory.chain_cache
+    filter_factory.chain_cache = None
+    try:
+        chain_cfg = [dibjectify({'op': 'match_author',
+                                 'config': {'values': ['fred']},
+                                 'action': 'reject'}),
+                     dibjectify({'op': 'match_author',
+                                 'config': {'values': ['barney']},
+                                 'action': 'reject'})]
+        chain = filter_factory.cached_chain('composite1', chain_cfg)
+        # the two authors are merged even without a cache
+        assert len(chain._filters) == 1
+        assert isinstance(chain._filters[0][0], AuthorFilter)
+    finally:
+        filter_factory.chain_cache = cache
+
+def test_filter_chain_cache_bounds():
+    from melkman.filters import FilterChainCache
+
+    cache = FilterChainCache(3, 100)
+    for i in range(5):
+        cache.put(i, 'digest', 'chain%d' % i, 10)
+    # only the 3 most recently used are kept
+    assert len(cache) == 3
+    assert cache.get(0, 'digest') is None
+    assert cache.get(2, 'digest') == 'chain2'
+
+    cache.put(5, 'digest', 'chain5', 10)
+    assert cache.get(3, 'digest') is None
+    assert cache.get(2, 'digest') == 'chain2'
+
+    # size bound evicts least recently used
+    cache.put(6, 'digest', 'chain6', 80)
+    assert cache.size <= 100
+    assert cache.get(6, 'digest') == 'chain6'
+    assert cache.get(4, 'digest') is None
+
+    # too large to cache at all
+    cache.put(7, 'digest', 'chain7', 200)
+    assert cache.get(7, 'digest') is None
+    assert cache.evictions > 0
+
+def test_keyword_matcher():
+    from melkman.textmatch import KeywordMatcher
+
+    # enough keywords to use the automaton
+    keywords = ['keyword%d' % i for i in range(1000)] + ['he', 'she', 'hers']
+
+    m = KeywordMatcher(keywords, 'substring')
+    assert m.match('USHERS')
+    assert m.match('some text with Keyword999 in it')
+    assert not m.match('nothing to see')
+    assert not m.match('keywor')
+
+    m = KeywordMatcher(keywords, 'substring', case_sensitive=True)
+    assert not m.match('USHERS')
+    assert m.match('ushers')
+
+    m = KeywordMatcher(keywords, 'exact')
+    assert m.match('Keyword12')
+    assert m.match('keyword12\nmore lines')
+    assert not m.match('keyword12 and more')
+
+@contextual
+def test_match_filter_many_values(ctx):
+    from melkman.filters import NewsItemFilterFactory
+
+    filter_factory = NewsItemFilterFactory(ctx.component_manager)
+    values = ['word%d' % i for i in range(10000)]
+
+    cfg = {'values': values, 'match_type': 'substring'}
+    filt = filter_factory.create_filter('match_title', cfg)
+    assert filt(dummy_news_item({'title': 'The Word9999 of the day'}))
+    assert not filt(dummy_news_item({'title': 'No words here'}))
+
+    cfg = {'values': values, 'match_type': 'exact'}
+    filt = filter_factory.create_filter('match_title', cfg)
+    assert filt(dummy_news_item({'title': 'word42'}))
+    assert not filt(dummy_news_item({'title': 'word42 and more'}))
+
+@contextual
+def test_evaluate_batch(ctx):
+    from melk.util.dibject import dibjectify
+    from melkman.filters import NewsItemFilterFactory, evaluate_batch
+
+    filter_factory = NewsItemFilterFactory(ctx.component_manager)
+    
+    chain = [
+        {'op': 'match_author',
+         'config': {'values': ['fred']},
+         'action': 'reject'},
+        {'op': 'or',
+         'config': {
+            'filters': [
+                {'op': 'match_title',
+                 'config': {'values': ['dino'], 'match_type': 'substring'}},
+                {'op': 'and',
+                 'config': {
+                    'filters': [
+                        {'op': 'match_author',
+                         'config': {'values': ['barney']}},
+                        {'op': 'match_field',
+                         'negative': True,
+                         'config': {'field': 'foo',
+                                    'values': ['bar']}}]}}]},
+         'action': 'accept'},
+        {'op': 'match_source',
+         'config': {'values': ['http://example.org/']},
+         'action': 'accept'},
+        {'op': 'match_all',
+         'config': {},
+         'action': 'reject'}
+    ]
+    chain = filter_factory.create_chain([dibjectify(x) for x in chain])
+
+    items = []
+    for author in ('fred', 'Barney', 'wilma'):
+        for title in ('dino', 'Dinosaur', 'bedrock'):
+            for details in ({}, {'foo': 'bar'}):
+                for source in ('http://example.org', 'http://example.com'):
+                    items.append(dummy_news_item({'author': author, 
+                                                  'title': title, 
+                                                  'details': details,
+                                                  'source_url': source}))
+    
+    # batches give the same results as single items
+    assert chain.evaluate_batch(items) == [chain(item) for item in items]
+    assert chain.evaluate_batch([]) == []
+
+    for filt, action in chain._filters:
+        assert evaluate_batch(filt, items) == [filt(item) for item in items]
+
+@contextual
+def test_optimize_chain(ctx):
+    from melk.util.dibject import dibjectify
+    from melkman.filters import NewsItemFilterFactory, optimize_chain
+    from melkman.filters import AuthorFilter, OrFilter, TagFilter
+
+    filter_factory = NewsItemFilterFactory(ctx.component_manager)
+    
+    chain = [
+        {'op': 'match_none',
+         'config': {},
+         'action': 'accept'},
+        {'op': 'or',
+         'config': {
+            'filters': [
+                {'op': 'match_tag',
+                 'config': {'values': ['bedrock']}},
+                {'op': 'or',
+                 'config': {
+                    'filters': [
+                        {'op': 'match_author',
+                         'config': {'values': ['fred']}},
+                        {'op': 'match_none',
+                         'config': {}}]}},
+                {'op': 'match_author',
+                 'config': {'values': ['barney']}}]},
+         'action': 'reject'},
+        {'op': 'and',
+         'config': {
+            'filters': [
+                {'op': 'match_all',
+                 'negative': True,
+                 'config': {}},
+                {'op': 'match_title',
+                 'config': {'values': ['dino']}}]},
+         'action': 'accept'},
+        {'op': 'match_all',
+         'config': {},
+         'action': 'reject'},
+        {'op': 'match_title',
+         'config': {'values': ['dino']},
+         'action': 'accept'},
+    ]
+    chain = filter_factory.create_chain([dibjectify(x) for x in chain])
+    optimized = optimize_chain(chain)
+
+    # a single 'or' with the authors merged and tried before tags.
+    assert len(optimized._filters) == 1
+    filt, action = optimized._filters[0]
+    assert action == 'reject'
+    assert isinstance(filt, OrFilter)
+    assert len(filt._filters) == 2
+    assert isinstance(filt._filters[0], AuthorFilter)
+    assert filt._filters[0].config['values'] == ['fred', 'barney']
+    assert isinstance(filt._filters[1], TagFilter)
+    assert optimized._default == 'reject'
+    assert 'match_author' in optimized.explain()
+
+    items = []
+    for author in ('fred', 'barney', 'wilma'):
+        for title in ('dino', 'bedrock'):
+            for tag in ('bedrock', 'quarry'):
+                items.append(dummy_news_item({'author': author, 
+                                              'title': title,
+                                              'details': {'tags': [{'term': tag}]}}))
+    assert [optimized(item) for item in items] == [chain(item) for item in items]
@@ -0,0 +1,59 @@
+from melkman.green import green_init
+green_init()
+
+from eventlet import sleep, spawn
+import os
+from helpers import *
+
+def test_http_pool_reuses_clients():
+    from melkman.httppool import HTTPPool
+
+    www = os.path.join(data_path(), 'www')
+    ts = FileServer(www)
+    ts_proc = spawn(ts.run)
+    sleep(0)
+
+    pool = HTTPPool(max_per_host=2)
+    try:
+        url = ts.url_for('good.xml')
+        response, content = pool.request(url, 'GET')
+        assert response.status == 200
+
+        host_pool = pool._hosts.values()[0]
+        assert len(host_pool.idle) == 1
+        first_client = host_pool.idle[0][1]
+
+        response, content = pool.request(url, 'GET')
+        assert response.status == 200
+        assert len(host_pool.idle) == 1
+        assert host_pool.idle[0][1] is first_client
+        assert host_pool.in_use == 0
+    finally:
+        pool.close()
+        ts_proc.kill()
+        ts_proc.wait()
+
+def test_http_pool_limits_per_host():
+    from melkman.httppool import HTTPPool
+
+    www = os.path.join(data_path(), 'www')
+    ts = FileServer(www)
+    ts_proc = spawn(ts.run)
+    sleep(0)
+
+    pool = HTTPPool(max_per_host=2)
+    try:
+        url = ts.url_for('good.xml')
+        procs = [spawn(pool.request, url, 'GET') for i in range(6)]
+        sleep(0)
+        host_pool = pool._hosts.values()[0]
+        assert host_pool.in_use <= 2
+        for proc in procs:
+            response, content = proc.wait()
+            assert response.status == 200
+        assert len(host_pool.idle) <= 2
+        assert ts.requests == 6
+    finally:
+        pool.close()
+        ts_proc.kill()
+        ts_proc.wait()
@@ -188,4 +188,256 @@ def test_dispatch_one_receiver(ctx):
         worker1.wait()
         worker2.kill()
         worker2.wait()
-        
\ No newline at end of file
+        
+@contextual
+def test_dispatch_send_many(ctx):
+    from eventlet import sleep
+    from melkman.messaging import MessageDispatch, always_ack
+
+    w = MessageDispatch(ctx)
+    message_type = 'test_dispatch_send_many'
+
+    got = []
+    @always_ack
+    def handler(job, message):
+        got.append(job['n'])
+
+    worker = w.start_worker(message_type, handler)
+    try:
+        w.send_many([{'n': i} for i in range(10)], message_type)
+        w.send({'n': 10}, message_type)
+        sleep(1)
+
+        assert sorted(got) == range(11)
+        # the publisher was reused rather than reopened
+        assert len(ctx.publisher_pool._idle[('dispatch', message_type)]) == 1
+    finally:
+        worker.kill()
+        worker.wait()
+
+def test_publisher_pool():
+    from melkman.messaging import PublisherPool
+
+    class FakePublisher(object):
+        def __init__(self, fail=False):
+            self.sent = []
+            self.closed = False
+            self.fail = fail
+        def send(self, message, **kw):
+            if self.fail:
+                raise IOError('boom')
+            self.sent.append(message)
+        def close(self):
+            self.closed = True
+
+    pool = PublisherPool(max_idle=1)
+    made = []
+    def make(fail=False):
+        pub = FakePublisher(fail)
+        made.append(pub)
+        return pub
+
+    pool.publish('a', make, [1, 2])
+    pool.publish('a', make, [3])
+    assert len(made) == 1
+    assert made[0].sent == [1, 2, 3]
+
+    # two checked out at once, only one is kept
+    p1 = pool.checkout('a', make)
+    p2 = pool.checkout('a', make)
+    assert len(made) == 2
+    pool.checkin('a', p1)
+    pool.checkin('a', p2)
+    assert not p1.closed and p2.closed
+
+    # a publisher that fails is discarded
+    pool.close()
+    assert p1.closed
+    try:
+        pool.publish('b', lambda: make(True), [1])
+        assert False, 'expected IOError'
+    except IOError:
+        pass
+    assert made[-1].closed
+    assert pool._idle.get('b') == []
+
+@contextual
+def test_dispatch_submit(ctx):
+    from eventlet import sleep
+    from melkman.messaging import MessageDispatch, always_ack
+
+    w = MessageDispatch(ctx)
+    message_type = 'test_dispatch_submit'
+    w.declare(message_type)
+    w.clear(message_type)
+
+    got = []
+    @always_ack
+    def handler(job, message):
+        got.append(job['n'])
+
+    pending = [w.submit({'n': i}, message_type) for i in range(50)]
+    for p in pending:
+        assert p.wait() == True
+
+    worker = w.start_worker(message_type, handler)
+    try:
+        sleep(1)
+        assert sorted(got) == range(50)
+    finally:
+        worker.kill()
+        worker.wait()
+
+def test_confirmed_publisher():
+    from melkman.messaging import ConfirmedPublisher, PendingPublish, PublisherPool
+
+    class FakeChannel(object):
+        def __init__(self, fail):
+            self.fail = fail
+            self.commits = 0
+        def tx_select(self):
+            pass
+        def tx_commit(self):
+            if self.fail:
+                raise IOError('boom')
+            self.commits += 1
+
+    class FakePublisher(object):
+        def __init__(self, fail=False):
+            self.backend = FakeBackend()
+            self.backend.channel = FakeChannel(fail)
+            self.sent = []
+        def send(self, message, **kw):
+            self.sent.append(message)
+        def close(self):
+            pass
+
+    class FakeBackend(object):
+        pass
+
+    class FakeContext(object):
+        def __init__(self):
+            self.publisher_pool = PublisherPool()
+        def __enter__(self):
+            pass
+        def __exit__(self, *args):
+            return False
+
+    made = []
+    def make(fail=False):
+        pub = FakePublisher(fail)
+        made.append(pub)
+        return pub
+
+    cp = ConfirmedPublisher(FakeContext(), max_batch=10, max_delay=0.5, max_outstanding=25)
+    pending = [cp.submit('a', make, i) for i in range(25)]
+    for p in pending:
+        assert p.wait() == True
+    assert len(made) == 1
+    assert made[0].sent == range(25)
+    # batches of at most max_batch, even without yielding
+    assert made[0].backend.channel.commits == 3
+
+    # a failed commit fails every message in the batch
+    pending = [cp.submit('b', lambda: make(True), i) for i in range(3)]
+    for p in pending:
+        try:
+            p.wait()
+            assert False, 'expected IOError'
+        except IOError:
+            pass
+
+    assert PendingPublish.sent('c').wait() == True
+
+def test_message_encoder():
+    from carrot import serialization
+    from melkman.messaging import MessageEncoder, msgpack
+
+    message = {'content': u'x' * 5000, 'items': [{'item_id': u'a\u1234', 'n': 1}]}
+
+    serializers = ['json']
+    if msgpack is not None:
+        serializers.append('msgpack')
+
+    for serializer in serializers:
+        for threshold in (0, 1000):
+            encoder = MessageEncoder(serializer=serializer, compress_threshold=threshold)
+            body, content_type, content_encoding = encoder.encode(message)
+            if threshold:
+                assert content_type.endswith('+zlib')
+                assert len(body) < 1000
+            assert serialization.decode(body, content_type, content_encoding) == message
+
+    if msgpack is not None:
+        # byte strings need not be utf-8
+        message = {'content': 'caf\xe9', 'title': u'caf\xe9'}
+        body, content_type, content_encoding = MessageEncoder(serializer='msgpack').encode(message)
+        assert serialization.decode(body, content_type, content_encoding) == message
+
+        # nor from packers without binary types
+        body = msgpack.packb({'content': 'caf\xe9'}, use_bin_type=False)
+        assert serialization.decode(body, content_type, content_encoding) == {'content': 'caf\xe9'}
+
+    # the default is what carrot sends on its own
+    body, content_type, content_encoding = MessageEncoder().encode(message)
+    assert content_type == 'application/json'
+
+    try:
+        MessageEncoder(serializer='nosuchthing')
+        assert False, 'expected ValueError'
+    except ValueError:
+        pass
+
+def test_multiplexed_consumers():
+    from melkman.context import Context
+    ctx = Context.from_dict({'messaging': {'multiplex_consumers': True}},
+                            defaults=Context.from_yaml(test_yaml_file()).config)
+    ctx.bootstrap(purge=True)
+    with ctx:
+        _check_multiplexed_consumers(ctx)
+    assert ctx._broker is None
+
+def _check_multiplexed_consumers(ctx):
+    from eventlet import sleep
+    from melkman.messaging import EventBus, MessageDispatch, always_ack
+
+    w = MessageDispatch(ctx)
+    got = {'a': 0, 'b': 0, 'c': 0, 'events': 0}
+
+    def handler_for(key):
+        @always_ack
+        def handler(job, message):
+            got[key] += 1
+        return handler
+
+    workers = [w.start_worker('test_mux_a', handler_for('a')),
+               w.start_worker('test_mux_b', handler_for('b')),
+               w.start_worker('test_mux_c', handler_for('c'), prefetch_count=5)]
+    event_bus = EventBus(ctx)
+    try:
+        def got_event(event):
+            got['events'] += 1
+        event_bus.add_listener('test_mux_one', got_event)
+        event_bus.add_listener('test_mux_two', got_event)
+        sleep(0.1)
+
+        mux = ctx.consumer_multiplexer
+        # each worker has a channel of its own, the 
+        # event bus has one queue on one channel.
+        assert len(mux._channels) == 4
+        assert len(mux._tags) == 4
+
+        for t in ('a', 'b', 'c'):
+            w.send_many([{}] * 3, 'test_mux_%s' % t)
+        event_bus.send('test_mux_one', {})
+        event_bus.send('test_mux_two', {})
+        sleep(1)
+
+        assert got == {'a': 3, 'b': 3, 'c': 3, 'events': 2}
+    finally:
+        event_bus.kill()
+        for worker in workers:
+            worker.kill()
+            worker.wait()
+
+    assert len(ctx.consumer_multiplexer._channels) == 0
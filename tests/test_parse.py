@@ -0,0 +1,57 @@
+from helpers import *
+
+def test_parse_feed_streaming():
+    """
+    test that the streaming parse produces the same entries 
+    as parse_feed, sharing a single source record.
+    """
+    from melkman.parse import parse_feed, parse_feed_streaming
+
+    feed_url = 'http://example.org/%s' % random_id()
+    content = random_atom_feed(feed_url, 10)
+
+    fp = parse_feed(content, feed_url)
+    sf = parse_feed_streaming(content, feed_url)
+
+    assert sf.feed.id == fp.feed.id
+    assert sf.feed.title == fp.feed.title
+
+    entries = list(sf.iter_entries())
+    assert [e.melk_id for e in entries] == [e.melk_id for e in fp.entries]
+    for e, pe in zip(entries, fp.entries):
+        assert e.id == pe.id
+        assert e.details.source is sf.source
+        assert e.trace.title == pe.title
+        assert e.timestamp == e.trace.timestamp
+
+    # entries are consumed by iteration
+    assert list(sf.iter_entries()) == []
+
+def test_strip_tags():
+    from melkman.parse import strip_tags, trimmed
+
+    assert strip_tags('<p>Hello <b>world</b></p>') == 'Hello world'
+    assert strip_tags('<a href="x>y">link</a>   \n text') == 'link text'
+    assert strip_tags('AT&amp;T &#169; caf&eacute;') == 'AT&amp;T &#169; caf&eacute;'
+    assert strip_tags('<!-- comment --><p>  \n\n  lead</p>') == ' lead'
+    assert strip_tags('<br/>line1<br />  line2') == 'line1 line2'
+    assert strip_tags('plain text') == 'plain text'
+
+    # as HTMLParser parses it
+    assert strip_tags('<script>if (a < b) { x = "<b>"; }</script>after') == 'if (a < b) { x = "<b>"; }after'
+    assert strip_tags('<STYLE>p { }</Style >  x') == 'p { } x'
+    assert strip_tags('fish &   chips') == 'fish & chips'
+    assert strip_tags('a <  b') == 'a < b'
+    assert strip_tags('fish &chips and more') == 'fish &chips; and more'
+    assert strip_tags('fish &chips') == 'fish '
+    assert strip_tags('x &#169') == 'x '
+    assert strip_tags('x <b unterminated') == 'x '
+    assert strip_tags('<!-- unterminated > x') == ''
+    assert strip_tags('Tom & Jerry &\n') == 'Tom & Jerry &\n'
+    assert strip_tags('a <\n') == 'a <\n'
+
+    html = '<p>word word</p>' * 1000
+    full = strip_tags(html)
+    partial = strip_tags(html, 20)
+    assert full.startswith(partial)
+    assert trimmed(partial, 20) == trimmed(full, 20)
@@ -175,14 +175,20 @@ def test_item_trace_update(ctx):
 
     check_item(feed, melk_id, info1)
 
-    # change the info, but not the timestamp, should stay the same
+    # change the info, but not the timestamp, the changed 
+    # fingerprint should still cause an update.
     info2 = dict(info1)
     info2['title'] = 'Title 2'
     feed_v2 = make_atom_feed(feed_url, [make_atom_entry(**info2)])
-    feed.update_from_feed(feed_v2, method='test')
+    assert feed.update_from_feed(feed_v2, method='test') == 1
     feed.save()
-    # should still match info1. (no update)
-    check_item(feed, melk_id, info1)
+    check_item(feed, melk_id, info2)
+
+    # the same entry again is not an update
+    feed_v2 = make_atom_feed(feed_url, [make_atom_entry(**info2)], title='Retitled')
+    assert feed.update_from_feed(feed_v2, method='test') == 0
+    feed.save()
+    check_item(feed, melk_id, info2)
 
     # now update the timestamp along with other fields
     time3 = no_micro(time1 + timedelta(seconds=1))
@@ -285,4 +291,66 @@ def test_max_history_len(ctx):
         else:
             assert len(rf.update_history) == MAX_HISTORY
         assert rf.update_history[0].reason == reason
-    
\ No newline at end of file
+    
+@contextual
+def test_unchanged_content_skips_parse(ctx):
+    """
+    test that content identical to the last indexed content
+    is not parsed again, and that fetch validators are kept.
+    """
+    from melkman.db import RemoteFeed
+    import melkman.db.remotefeed as remotefeed
+
+    feed_url = 'http://example.org/%s' % random_id()
+    content = random_atom_feed(feed_url, 5)
+
+    feed = RemoteFeed.create_from_url(feed_url, ctx)
+    assert feed.conditional_headers() == {}
+
+    assert feed.update_from_feed(content, method='test') == 5
+    feed.record_validators({'etag': '"abc"', 'last-modified': 'Sat, 01 Jan 2000 00:00:00 GMT'})
+    feed.save()
+
+    feed = RemoteFeed.get_by_url(feed_url, ctx)
+    headers = feed.conditional_headers()
+    assert headers['if-none-match'] == '"abc"'
+    assert headers['if-modified-since'] == 'Sat, 01 Jan 2000 00:00:00 GMT'
+
+    def explode(*args, **kw):
+        assert False, 'unchanged content should not be parsed'
+    real_update = remotefeed._update_feed
+    remotefeed._update_feed = explode
+    try:
+        assert feed.update_from_feed(content, method='test') == 0
+    finally:
+        remotefeed._update_feed = real_update
+    assert feed.update_history[0].success == True
+    assert feed.update_history[0].updates == 0
+
+@contextual
+def test_update_loads_only_feed_entries(ctx):
+    """
+    test that updating a saved feed only looks up the entries
+    in the update and trims to maxlen incrementally.
+    """
+    from melkman.db import RemoteFeed
+
+    feed_url = 'http://example.org/%s' % random_id()
+    base = datetime.utcnow() - timedelta(hours=1)
+    entries1 = dummy_atom_entries(5, base)
+    feed = RemoteFeed.create_from_url(feed_url, ctx, maxlen=5)
+    assert feed.update_from_feed(make_atom_feed(feed_url, entries1), method='test') == 5
+    feed.save()
+
+    feed = RemoteFeed.get_by_url(feed_url, ctx)
+    entries2 = dummy_atom_entries(3, base + timedelta(minutes=5))
+    content = make_atom_feed(feed_url, entries2 + entries1)
+    assert feed.update_from_feed(content, method='test') == 3
+    assert feed._partial_entries == True
+    assert len(feed._entries) == 8
+    feed.save()
+
+    feed = RemoteFeed.get_by_url(feed_url, ctx)
+    assert len(feed.entries) == 5
+    for iid in melk_ids_in(make_atom_feed(feed_url, entries2), feed_url):
+        assert feed.has_news_item(iid)